@@ -1,6 +1,43 @@
+"""Admin of Quickpay payments
+
+The payment list is made for millions of payments:
+
+- A number finds the payment with that Quickpay ID or the payments of the order with that ID, a term with '@' finds
+  payments by the start of the billing email (case insensitive), other terms by the start of the order reference or
+  username (case sensitive). 'qp:', 'order:', 'email:', 'ref:', 'user:' or 'member:' before the term picks the
+  field. Quickpay and order IDs are indexed. Cartridge doesn't index the order columns, so on large tables add
+  indexes usable for prefix searches, on PostgreSQL e.g.
+
+      CREATE INDEX shop_order_email_prefix ON shop_order (UPPER(billing_detail_email::text) text_pattern_ops);
+      CREATE INDEX shop_order_reference_prefix ON shop_order (reference text_pattern_ops);
+      CREATE INDEX shop_order_username_prefix ON shop_order (username text_pattern_ops);
+
+- Payments aren't counted exactly. Unfiltered lists use the database's estimate of the table size, filtered lists
+  are counted up to QUICKPAY_ADMIN_COUNT_LIMIT (default 10000).
+- Bulk capture, refund and sync of the selected payments run in the background, see jobs.py. Refunds are confirmed
+  on an intermediate page first.
+"""
+from functools import lru_cache
+
 import django
-from django.core.urlresolvers import reverse
-from django.contrib import admin
+from django.core.paginator import Paginator
+from django.urls import reverse
+try:
+    from django.urls import re_path
+except ImportError:  # Django < 2.0
+    from django.conf.urls import url as re_path
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.db import connections
+from django.db.models import Count, Q, Sum
+from django.http import Http404, HttpResponseRedirect
+from django.template.response import TemplateResponse
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+from mezzanine.conf import settings
+from .bulk import eligible_payments
+from .currency import from_minor_units
+from .jobs import get_job, start_job
 from .models import QuickpayPayment
 
 
@@ -8,55 +45,184 @@ try:
     from cartridge_subscription.models import Subscription, SubscriptionPeriod
 except ImportError:
     Subscription, SubscriptionPeriod = None, None
-    
+
+
+def _is_id(value: str) -> bool:
+    """Whether value is a number that fits in an integer column"""
+    return value.isdigit() and int(value) < 2 ** 31
+
+
+# Search modes: prefix -> function from the search term to the filter. See the module docstring for indexes
+SEARCH_MODES = {
+    'qp': lambda term: Q(qp_id=int(term)) if _is_id(term) else None,
+    'order': lambda term: Q(order_id=int(term)) if _is_id(term) else None,
+    'email': lambda term: Q(order__billing_detail_email__istartswith=term),
+    'ref': lambda term: Q(order__reference__startswith=term),
+    'user': lambda term: Q(order__username__startswith=term),
+    'member': lambda term: Q(order__membership_id=term),
+}
+
+
+def search_filter(search_term: str):
+    """Filter of payments for a search term in the admin. None if nothing can match"""
+    mode, sep, term = search_term.partition(':')
+    if sep and mode.strip().lower() in SEARCH_MODES:
+        return SEARCH_MODES[mode.strip().lower()](term.strip())
+    term = search_term
+    if term.isdigit():
+        if not _is_id(term):
+            return None
+        return SEARCH_MODES['qp'](term) | SEARCH_MODES['order'](term)
+    if '@' in term:
+        return SEARCH_MODES['email'](term)
+    return SEARCH_MODES['ref'](term) | SEARCH_MODES['user'](term)
+
+
+@lru_cache(maxsize=None)
+def _change_url_format(model) -> str:
+    """Admin change URL of model with '{}' for the object ID. Reversed once per process"""
+    admin_url = reverse("admin:%s_%s_change" % (model._meta.app_label, model._meta.model_name), args=(0,))
+    head, _, tail = admin_url.rpartition('/0/')
+    return head + '/{}/' + tail
+
+
+def change_url(model, object_id) -> str:
+    """Admin change URL of an object"""
+    return _change_url_format(model).format(object_id)
+
+
+def estimated_table_size(model, using: str) -> int:
+    """The database's estimate of the number of rows of model's table, -1 if unknown"""
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        sql = "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass"
+    elif connection.vendor == 'mysql':
+        sql = "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s"
+    else:
+        return -1
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [model._meta.db_table])
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] is not None else -1
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that doesn't count all rows. See the module docstring"""
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        limit = getattr(settings, 'QUICKPAY_ADMIN_COUNT_LIMIT', 10000)
+        if not queryset.query.where:
+            estimate = estimated_table_size(queryset.model, queryset.db)
+            if estimate > limit:
+                return estimate
+        # Counting a slice stops at the limit
+        return queryset[:limit].count()
+
 
 class QuickpayPaymentAdmin(admin.ModelAdmin):
     list_display = ['qp_id', 'shop_order', 'requested_amount', 'requested_currency', 'accepted',
                     'state', 'balance', 'accepted_date', 'captured_date', 'test_mode']
     list_select_related = ('order',)
-        
-    search_fields = ['order__username', 'order__reference', 'order__billing_detail_email',
-                     'order__membership_id', 'qp_id']
+    ordering = ['-id']
+
+    # Only shows the search box, the search is done by search_filter()
+    search_fields = ['qp_id']
 
     list_filter = ['state', 'accepted_date', 'accepted', 'test_mode']
-    
+    date_hierarchy = 'accepted_date'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
     readonly_fields = ['qp_id', 'shop_order', 'requested_amount', 'requested_currency', 'accepted', 'test_mode',
                        'type', 'text_on_statement', 'acquirer', 'state', 'balance',
                        'last_qp_status', 'last_qp_status_msg', 'last_aq_status', 'last_aq_status_msg',
                        'accepted_date', 'captured_date']
 
+    actions = ['capture_in_background', 'refund_in_background', 'sync_in_background']
+
     def has_add_permission(self, request):
         return False
 
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        search = search_filter(search_term)
+        if search is None:
+            return queryset.none(), False
+        return queryset.filter(search), False
+
+    def get_urls(self):
+        opts = self.model._meta
+        return [
+            re_path(r'^job/(?P<job_id>[0-9a-f]{32})/$', self.admin_site.admin_view(self.job_view),
+                name='%s_%s_job' % (opts.app_label, opts.model_name)),
+        ] + super().get_urls()
+
+    def job_view(self, request, job_id):
+        job = get_job(job_id)
+        if job is None:
+            raise Http404("Unknown or expired job")
+        context = dict(self.admin_site.each_context(request), opts=self.model._meta, job=job,
+                       title="Quickpay {} of payments".format(job['operation']))
+        return TemplateResponse(request, 'admin/cartridge_quickpay/quickpaypayment/job.html', context)
+
+    def _start_job(self, request, operation, queryset):
+        job_id = start_job(operation, queryset, request.user.get_username())
+        opts = self.model._meta
+        messages.info(request, "Started {} of the selected payments".format(operation))
+        return HttpResponseRedirect(reverse('admin:%s_%s_job' % (opts.app_label, opts.model_name),
+                                            args=(job_id,)))
+
+    def capture_in_background(self, request, queryset):
+        return self._start_job(request, 'capture', queryset)
+
+    capture_in_background.short_description = "Capture selected payments in Quickpay"
+
+    def refund_in_background(self, request, queryset):
+        """Ask for confirmation like delete_selected, then refund in the background"""
+        if request.POST.get('post'):
+            return self._start_job(request, 'refund', queryset)
+        refunds = (eligible_payments('refund').filter(pk__in=queryset.values('pk'))
+                   .values('requested_currency').annotate(count=Count('pk'), balance=Sum('balance'))
+                   .order_by('requested_currency'))
+        totals = [(row['count'], from_minor_units(row['balance'], row['requested_currency']),
+                   row['requested_currency']) for row in refunds]
+        context = dict(self.admin_site.each_context(request), opts=self.model._meta, totals=totals,
+                       select_across=request.POST.get('select_across') == '1',
+                       action_checkbox_name=helpers.ACTION_CHECKBOX_NAME,
+                       selected=request.POST.getlist(helpers.ACTION_CHECKBOX_NAME),
+                       title="Refund payments in Quickpay")
+        return TemplateResponse(request, 'admin/cartridge_quickpay/quickpaypayment/refund_confirmation.html',
+                                context)
+
+    refund_in_background.short_description = "Refund selected payments in Quickpay"
+
+    def sync_in_background(self, request, queryset):
+        return self._start_job(request, 'sync', queryset)
+
+    sync_in_background.short_description = "Update selected payments from Quickpay"
+
     def shop_order(self, item: QuickpayPayment):
         from cartridge.shop.models import Order
         order_id = item.order_id
         if order_id is not None:
-            admin_url = reverse("admin:%s_%s_change"
-                                    % (Order._meta.app_label, Order._meta.model_name), args=(order_id,))
-
-            return "<a href='{}'>{}</a>".format(admin_url, order_id)
+            return format_html("<a href='{}'>{}</a>", change_url(Order, order_id), order_id)
         else:
             return "-"
 
-    shop_order.allow_tags = True
-
     def subscription(self, item: QuickpayPayment):
         try:
             subscription_id = item.order.subscriptionperiod.subscription_id
         except (AttributeError, SubscriptionPeriod.DoesNotExist):
             subscription_id = None
         if subscription_id is not None:
-            admin_url = reverse(
-                "admin:%s_%s_change"
-                % (Subscription._meta.app_label, Subscription._meta.model_name), args=(subscription_id,))
-
-            return "<a href='{}'>{}</a>".format(admin_url, subscription_id)
+            return format_html("<a href='{}'>{}</a>", change_url(Subscription, subscription_id), subscription_id)
         else:
             return "-"
 
-    subscription.allow_tags = True
-
 
 if Subscription is not None:
     QuickpayPaymentAdmin.list_select_related = QuickpayPaymentAdmin.list_select_related + ('order__subscriptionperiod',)
@@ -0,0 +1,121 @@
+"""Quickpay agreements
+
+A shop may have a Quickpay agreement per currency. The agreements are read from settings once:
+
+SETTINGS:
+    QUICKPAY_API_KEY     = API key of the default agreement
+    QUICKPAY_PRIVATE_KEY = Private key of the default agreement
+    QUICKPAY_ACCOUNT_ID  = Quickpay merchant ID of the default agreement, optional
+    QUICKPAY_AGREEMENTS  = Agreements for specific currencies, e.g.
+                           {'DKK': {'api_key': '...', 'private_key': '...', 'account_id': 12345},
+                            'EUR': {'api_key': '...', 'private_key': '...', 'account_id': 23456}}
+                           account_id is the Quickpay merchant ID of the agreement. It identifies the agreement
+                           of callbacks. Currencies not listed use the default agreement.
+
+Each agreement keeps its HMAC key schedule for signing, and has its own pooled client.
+"""
+import hashlib
+import hmac
+import threading
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .client import QuickpayClient, get_client
+
+
+__author__ = 'jfk@metation.dk'
+
+
+class Agreement:
+    """Keys of a Quickpay agreement"""
+
+    def __init__(self, api_key: Optional[str], private_key: Optional[str], account_id: Optional[int] = None):
+        self.api_key = api_key
+        self.private_key = private_key
+        self.account_id = account_id
+        self._hmac = hmac.new(private_key.encode('utf-8'), digestmod=hashlib.sha256) if private_key else None
+
+    def sign(self, base: bytes) -> str:
+        """HMAC-SHA256 signature of base with the private key"""
+        if self._hmac is None:
+            raise ImproperlyConfigured("QUICKPAY_PRIVATE_KEY missing or empty in settings")
+        signature = self._hmac.copy()
+        signature.update(base)
+        return signature.hexdigest()
+
+    def client(self) -> QuickpayClient:
+        """Pooled API client for the agreement"""
+        if not self.api_key:
+            raise ImproperlyConfigured("QUICKPAY_API_KEY missing or empty in settings")
+        return get_client(":{0}".format(self.api_key))
+
+
+class AgreementRegistry:
+    """Agreements by currency and by account ID"""
+
+    def __init__(self, default: Agreement, by_currency: Dict[str, Agreement]):
+        self.default = default
+        self.by_currency = by_currency
+        self.by_account = {str(a.account_id): a for a in [default] + list(by_currency.values())
+                           if a.account_id is not None}
+
+    def for_currency(self, currency: Optional[str] = None) -> Agreement:
+        """Get the agreement for the currency. The default agreement if currency is None or has no agreement"""
+        agreement = self.by_currency.get(currency.upper()) if currency else None
+        return agreement or self.default
+
+    def for_account(self, account_id) -> Optional[Agreement]:
+        """Get the agreement with the Quickpay account ID. None if unknown"""
+        return self.by_account.get(str(account_id)) if account_id else None
+
+    def all(self) -> List[Agreement]:
+        """All agreements, each once"""
+        agreements = {a.api_key: a for a in self.by_currency.values()}
+        if self.default.api_key:
+            agreements.setdefault(self.default.api_key, self.default)
+        return list(agreements.values())
+
+
+_registry = None  # type: Optional[AgreementRegistry]
+_registry_lock = threading.Lock()
+
+
+def get_agreements() -> AgreementRegistry:
+    """Get the agreement registry. Loaded from settings on first use"""
+    global _registry
+    registry = _registry
+    if registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = _load_agreements()
+            registry = _registry
+    return registry
+
+
+def get_agreement(currency: Optional[str] = None) -> Agreement:
+    """Get the agreement for the currency"""
+    return get_agreements().for_currency(currency)
+
+
+def _load_agreements() -> AgreementRegistry:
+    default = Agreement(getattr(settings, 'QUICKPAY_API_KEY', None), getattr(settings, 'QUICKPAY_PRIVATE_KEY', None),
+                        getattr(settings, 'QUICKPAY_ACCOUNT_ID', None))
+    by_currency = {}
+    for currency, keys in getattr(settings, 'QUICKPAY_AGREEMENTS', {}).items():
+        try:
+            by_currency[currency.upper()] = Agreement(keys['api_key'], keys['private_key'], keys.get('account_id'))
+        except KeyError as e:
+            raise ImproperlyConfigured("QUICKPAY_AGREEMENTS['{}'] missing {}".format(currency, e))
+    return AgreementRegistry(default, by_currency)
+
+
+@receiver(setting_changed)
+def _reset_agreements(setting, **kwargs):
+    """Reload agreements when settings are changed in tests"""
+    global _registry
+    if setting in ('QUICKPAY_API_KEY', 'QUICKPAY_PRIVATE_KEY', 'QUICKPAY_ACCOUNT_ID', 'QUICKPAY_AGREEMENTS'):
+        _registry = None
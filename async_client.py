@@ -0,0 +1,179 @@
+"""Asyncio Quickpay API client
+
+AsyncQuickpayClient has the same surface as client.QuickpayClient, with coroutines:
+
+    client = aquickpay_client(currency)
+    res = await client.post('/payments', currency='DKK', order_id='1234_000001')
+
+DEPENDENCIES:
+    aiohttp
+        pip install aiohttp
+
+Uses the same settings as the synchronous client (QUICKPAY_API_URL, QUICKPAY_POOL_SIZE,
+QUICKPAY_CONNECT_TIMEOUT, QUICKPAY_READ_TIMEOUT), and the same timeouts, deadlines, retries and circuit breakers
+(see resilience.py) and shared rate limit (see ratelimit.py). aiohttp sessions are bound to an event loop, so there is
+one pooled client per agreement and event loop. The clients of a loop are closed when it shuts down, e.g. at the end
+of an async_to_sync() call.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from typing import AsyncGenerator, Dict, Optional, Tuple
+
+from django.core.exceptions import ImproperlyConfigured
+from quickpay_api_client.exceptions import ApiError
+
+from . import metrics, ratelimit, resilience
+from .client import api_headers, client_settings, error_body
+from .models import get_api_key
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+__author__ = 'jfk@metation.dk'
+
+
+class AsyncQuickpayClient:
+    """Quickpay API client for asyncio with a keep-alive connection pool"""
+
+    def __init__(self, secret: str):
+        if aiohttp is None:
+            raise ImproperlyConfigured("aiohttp is required for the asyncio Quickpay client")
+        base_url, pool_size, timeout = client_settings()
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.breaker = resilience.get_breaker(secret)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size),
+            timeout=aiohttp.ClientTimeout(connect=timeout[0], sock_read=timeout[1]),
+            headers=api_headers(secret))
+
+    async def perform(self, method: str, path: str, **kwargs):
+        """Make API call. Return the decoded JSON result. Raise ApiError if Quickpay returns an error, and
+        QuickpayUnavailable if Quickpay doesn't answer or is failing. Idempotent calls are retried"""
+        raw = kwargs.pop('raw', False)
+        headers = kwargs.pop('headers', None)
+        url = self.base_url + path
+        if method in ('get', 'delete'):
+            request_args = {'params': _query_params(kwargs), 'headers': headers}
+        else:
+            request_args = {'data': json.dumps(kwargs, default=str),
+                            'headers': dict(headers or {}, **{'Content-Type': 'application/json'})}
+        endpoint = metrics.endpoint(path)
+        timeout = resilience.endpoint_timeout(endpoint, self.timeout)
+        retries = resilience.max_retries() if resilience.is_idempotent(method, endpoint) else 0
+        for attempt in range(retries + 1):
+            if attempt:
+                metrics.api_retries.inc(endpoint=endpoint)
+            await ratelimit.aacquire()
+            connect_timeout, read_timeout = resilience.call_timeout(timeout)
+            trial = self.breaker.before_call()
+            start = time.monotonic()
+            status, error = 'error', None
+            try:
+                async with self.session.request(
+                        method, url, timeout=aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout),
+                        **request_args) as response:
+                    text = await response.text()
+                    status = response.status
+                    response_headers = response.headers
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            except BaseException:
+                self.breaker.record(False, trial)
+                raise
+            finally:
+                metrics.api_calls.observe(time.monotonic() - start, method=method, endpoint=endpoint, status=status)
+            failed = error is not None or resilience.is_failure(status)
+            self.breaker.record(not failed, trial)
+            if not failed:
+                break
+            delay = resilience.retry_delay(attempt + 1)
+            if attempt == retries or not resilience.may_wait(delay):
+                break
+            logging.warning("cartridge_quickpay.async_client: %s %s failed (%s), retrying", method.upper(),
+                            endpoint, error or status)
+            await asyncio.sleep(delay)
+        if error is not None:
+            raise resilience.no_answer() from error
+        if not 200 <= status < 300:
+            raise ApiError(error_body(text.encode('utf-8')), status)
+        body = json.loads(text) if text else None
+        if raw:
+            return [status, body, response_headers]
+        return body
+
+    async def get(self, path: str, **kwargs):
+        return await self.perform('get', path, **kwargs)
+
+    async def post(self, path: str, **kwargs):
+        return await self.perform('post', path, **kwargs)
+
+    async def put(self, path: str, **kwargs):
+        return await self.perform('put', path, **kwargs)
+
+    async def patch(self, path: str, **kwargs):
+        return await self.perform('patch', path, **kwargs)
+
+    async def delete(self, path: str, **kwargs):
+        return await self.perform('delete', path, **kwargs)
+
+    async def close(self):
+        await self.session.close()
+
+
+def _query_params(args: dict) -> Dict[str, str]:
+    """aiohttp only takes str query values. Encode booleans like requests does"""
+    return {k: (str(v).lower() if isinstance(v, bool) else str(v)) for k, v in args.items() if v is not None}
+
+
+# Clients of each event loop by id(loop): (loop, {secret: client}, guard closing them, see _close_on_shutdown())
+_clients = {}  # type: Dict[int, Tuple[asyncio.AbstractEventLoop, Dict[str, AsyncQuickpayClient], AsyncGenerator]]
+_clients_lock = threading.Lock()  # Event loops may run in several threads
+
+
+def aquickpay_client(currency: Optional[str] = None) -> AsyncQuickpayClient:
+    """Get the pooled asyncio client for the agreement of the currency on the running event loop.
+    Must be called from a coroutine"""
+    secret = ":{0}".format(get_api_key(currency))
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        _drop_closed_loops()
+        entry = _clients.get(id(loop))
+        if entry is None or entry[0] is not loop:
+            loop_clients = {}  # type: Dict[str, AsyncQuickpayClient]
+            guard = _close_on_shutdown(id(loop), loop_clients)
+            asyncio.ensure_future(guard.__anext__())  # Runs it up to its yield
+            entry = _clients[id(loop)] = (loop, loop_clients, guard)
+        loop_clients = entry[1]
+        client = loop_clients.get(secret)
+        if client is None:
+            logging.debug("cartridge_quickpay.async_client.aquickpay_client: new client")
+            client = loop_clients[secret] = AsyncQuickpayClient(secret)
+    return client
+
+
+async def _close_on_shutdown(loop_id: int, loop_clients: Dict[str, AsyncQuickpayClient]):
+    """Async generator closing the clients of an event loop when the loop shuts down its async generators, as
+    asyncio.run() and async_to_sync() do before closing it. Otherwise each loop would leave its sessions and their
+    connections open"""
+    try:
+        yield
+    finally:
+        with _clients_lock:
+            _clients.pop(loop_id, None)
+        for client in list(loop_clients.values()):
+            await client.close()
+
+
+def _drop_closed_loops():
+    """Forget the clients of event loops closed without shutting down their async generators, so they can be
+    garbage collected with their connections. Call with _clients_lock held"""
+    for loop_id, (loop, _, _) in list(_clients.items()):
+        if loop.is_closed():
+            del _clients[loop_id]
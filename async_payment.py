@@ -0,0 +1,180 @@
+"""Asyncio versions of the Quickpay calls in payment.py and models.py
+
+Database work runs in Django's thread-sensitive executor through asgiref's sync_to_async, Quickpay calls are
+made with the asyncio client, so no thread is blocked while waiting for Quickpay. Requires Django >= 3.1
+(asgiref) and aiohttp.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+from decimal import Decimal
+from typing import Dict, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.utils.timezone import now
+from mezzanine.conf import settings
+from cartridge.shop.models import Order, OrderItem
+from quickpay_api_client.exceptions import ApiError
+
+from .async_client import aquickpay_client
+from .currency import to_minor_units
+from .models import QuickpayPayment, QuickpayPaymentEvent
+from .payment import order_currency, payment_link_args, subscription_link_args, reserve_subscription_payment, \
+    quickpay_cache, Subscription
+
+
+__author__ = 'jfk@metation.dk'
+
+
+def _create_payment(order: Order, amount: Decimal, currency: str) -> QuickpayPayment:
+    with transaction.atomic():
+        return QuickpayPayment.create_card_payment(order, amount, currency, '9999')
+
+
+@asynccontextmanager
+async def asingle_flight(key: str, timeout: Optional[float] = None):
+    """Asyncio version of payment.single_flight()"""
+    timeout = timeout or getattr(settings, 'QUICKPAY_SINGLE_FLIGHT_TIMEOUT', 30)
+    cache = quickpay_cache()
+    cache_key = 'cartridge_quickpay:lock:' + key
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + timeout
+    delay = 0.02
+    acquired = await sync_to_async(cache.add)(cache_key, token, timeout)
+    while not acquired and time.monotonic() < deadline:
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.25)
+        acquired = await sync_to_async(cache.add)(cache_key, token, timeout)
+    if not acquired:
+        logging.warning("cartridge_quickpay.async_payment.asingle_flight({}) - timed out waiting, going ahead"
+                        .format(key))
+    try:
+        yield
+    finally:
+        if acquired and await sync_to_async(cache.get)(cache_key) == token:
+            await sync_to_async(cache.delete)(cache_key)
+
+
+async def aget_quickpay_link(order: Order, acquirer: Optional[str] = None) -> Dict[str, str]:
+    """Asyncio version of payment.get_quickpay_link()"""
+    currency = order_currency(order)
+    reuse_ttl = getattr(settings, 'QUICKPAY_LINK_REUSE_TTL', 900)
+    if not reuse_ttl:
+        return await _acreate_quickpay_link(order, currency, acquirer)
+
+    async with asingle_flight('quickpay_link:{}'.format(order.pk)):
+        payment = await sync_to_async(QuickpayPayment.get_reusable_link_payment)(
+            order, to_minor_units(order.total, currency), currency, acquirer, reuse_ttl)
+        if payment is not None:
+            return {'id': payment.qp_id, 'url': payment.link_url}
+        return await _acreate_quickpay_link(order, currency, acquirer)
+
+
+async def _acreate_quickpay_link(order: Order, currency: str, acquirer: Optional[str]) -> Dict[str, str]:
+    payment = await sync_to_async(_create_payment)(order, order.total, currency)
+
+    client = aquickpay_client(currency)
+    qp_order_id = '%s_%06d' % (order.id, payment.id)
+    res = await client.post('/payments', currency=currency, order_id=qp_order_id)
+    payment_id = res['id']
+    await sync_to_async(payment.set_qp_id)(payment_id)
+    logging.debug("cartridge_quickpay.async_payment.aget_quickpay_link: created payment {}, order_id={}"
+                  .format(payment_id, qp_order_id))
+
+    res = await client.put("/payments/%s/link" % payment_id, **payment_link_args(order, payment, acquirer))
+    logging.debug("cartridge_quickpay.async_payment.aget_quickpay_link: got link {}".format(res))
+    await sync_to_async(payment.set_link)(res['url'], acquirer)
+    return {'id': payment_id, 'url': res['url']}  # Same as for a reused link
+
+
+async def astart_subscription(order: Order, order_item: OrderItem) -> Tuple[int, str]:
+    """Asyncio version of payment.start_subscription()"""
+    currency = order_currency(order)
+    amount: Decimal = order_item.total_price + getattr(order_item, 'tax_amount', 0)
+    await sync_to_async(_create_payment)(order, amount, currency)
+
+    client = aquickpay_client(currency)
+    qp_order_id = "%04d" % order.id  # Quickpay requires 4..20 chars in order ID
+    res = await client.post("/subscriptions", order_id=qp_order_id, currency=currency,
+                            description=order_item.description)
+    subscription_id = res['id']
+
+    res = await client.put('/subscriptions/{}/link'.format(subscription_id),
+                           **subscription_link_args(order, to_minor_units(amount, currency)))
+    logging.debug("cartridge_quickpay.async_payment.astart_subscription: subscription {}, link {}"
+                  .format(subscription_id, res))
+    url = res['url']
+
+    if Subscription is not None:
+        await sync_to_async(Order.objects.filter(pk=order.pk).update)(membership_id=subscription_id)
+        order.membership_id = subscription_id
+
+    return subscription_id, url
+
+
+async def acapture_subscription_order(order: Order, synchronized: bool = True):
+    """Asyncio version of payment.capture_subscription_order()"""
+    payment = await sync_to_async(reserve_subscription_payment)(order)
+    if payment is None:
+        return
+    client = aquickpay_client(payment.requested_currency)
+    args = {'order_id': '%s_%06d' % (order.id, payment.id),
+            'amount': to_minor_units(order.total, payment.requested_currency), 'auto_capture': True}
+    if synchronized:
+        args['synchronized'] = True
+    res = await client.post("/subscriptions/{}/recurring".format(order.membership_id), **args)
+    await sync_to_async(payment.set_qp_id)(res['id'])
+
+
+async def aupdate_from_quickpay(payment: QuickpayPayment):
+    """Asyncio version of QuickpayPayment.update_from_quickpay(). Doesn't save"""
+    if payment.qp_id is None:
+        return
+    try:
+        qp_res = await aquickpay_client(payment.requested_currency).get('/payments/%s' % payment.qp_id)
+    except ApiError as e:
+        logging.error("QuickPay API error: %s" % e.body)
+        return
+    payment.update_from_res(qp_res)
+
+
+async def acapture(payment: QuickpayPayment, amount: Optional[Decimal] = None) -> bool:
+    """Asyncio version of QuickpayPayment.capture()"""
+    assert amount is None or isinstance(amount, Decimal)
+    await aupdate_from_quickpay(payment)
+    int_amount = payment.capture_amount(amount)
+    try:
+        qp_res = await aquickpay_client(payment.requested_currency).post(
+            '/payments/%s/capture' % payment.qp_id, amount=int_amount)
+        await sync_to_async(QuickpayPaymentEvent.record)(payment, qp_res, QuickpayPaymentEvent.SOURCE_OPERATION)
+        payment.captured_date = now()
+        await aupdate_from_quickpay(payment)
+        res = True
+    except ApiError as e:
+        logging.error("QuickPay API error: %s" % e.body)
+        res = False
+    await sync_to_async(payment.save)()
+    return res
+
+
+async def arefund(payment: QuickpayPayment, amount: Optional[Decimal] = None) -> bool:
+    """Asyncio version of QuickpayPayment.refund()"""
+    assert amount is None or isinstance(amount, Decimal)
+    await aupdate_from_quickpay(payment)
+    int_amount = payment.refund_amount(amount)
+    try:
+        qp_res = await aquickpay_client(payment.requested_currency).post(
+            '/payments/%s/refund' % payment.qp_id, amount=int_amount)
+        await sync_to_async(QuickpayPaymentEvent.record)(payment, qp_res, QuickpayPaymentEvent.SOURCE_OPERATION)
+        await aupdate_from_quickpay(payment)
+        if payment.balance == 0:
+            payment.captured_date = None
+        res = True
+    except ApiError as e:
+        logging.error("QuickPay API error: %s" % e.body)
+        res = False
+    await sync_to_async(payment.save)()
+    return res
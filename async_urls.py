@@ -0,0 +1,14 @@
+try:
+    from django.urls import re_path
+except ImportError:  # Django < 2.0
+    from django.conf.urls import url as re_path
+from .async_views import *
+
+
+urlpatterns = [
+    re_path("^checkout/$", quickpay_checkout, name='quickpay_checkout'),
+    re_path("^callback/$", callback, name='quickpay_callback'),
+    re_path("^success/$", success, name='quickpay_success'),
+    re_path("^failed/$", failed, name='quickpay_failed'),
+    re_path("^metrics/$", quickpay_metrics, name='quickpay_metrics'),
+]
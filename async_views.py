@@ -0,0 +1,62 @@
+"""Asyncio versions of the views for ASGI deployments. Requires Django >= 3.1 and aiohttp.
+
+Quickpay is called with the asyncio client, so no worker thread waits for Quickpay during checkout. Database
+work, including waiting for row locks in callback() and success(), runs in Django's thread-sensitive executor.
+
+urls.py setup: include("cartridge_quickpay.async_urls") in place of "cartridge_quickpay.urls". The URL names
+are the same, so templates and settings need no changes.
+"""
+from asgiref.sync import sync_to_async
+from django.http import HttpRequest, HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+
+import logging
+
+from . import views
+from .async_payment import aget_quickpay_link, astart_subscription
+from .resilience import QuickpayUnavailable, deadline
+from .views import quickpay_metrics
+
+
+__author__ = 'jfk@metation.dk'
+
+
+def _first_order_item(order):
+    return order.items.all().order_by('id')[0]
+
+
+async def quickpay_checkout(request: HttpRequest) -> HttpResponse:
+    """Asyncio version of views.quickpay_checkout()"""
+    acquirer = request.POST.get('acquirer', None)
+    logging.debug("quickpay_checkout (async): using acquirer {}".format(acquirer or '<any>'))
+    form, order = await sync_to_async(views.checkout_order)(request)
+    if order is None:
+        return await sync_to_async(views.checkout_form_invalid)(request, form)
+
+    try:
+        with deadline(views.checkout_deadline()):
+            if await sync_to_async(views.is_subscription_checkout)(order, acquirer):
+                order_item = await sync_to_async(_first_order_item)(order)
+                quickpay_subs_id, quickpay_link = await astart_subscription(order, order_item)
+            else:
+                quickpay_link = (await aget_quickpay_link(order, acquirer))['url']
+    except QuickpayUnavailable as e:
+        return await sync_to_async(views.checkout_unavailable)(request, e)
+    logging.debug("quickpay_checkout (async): payment link {}".format(quickpay_link))
+    return await sync_to_async(views.checkout_redirect)(request, quickpay_link, acquirer)
+
+
+async def success(request: HttpRequest) -> HttpResponse:
+    """Asyncio version of views.success()"""
+    return await sync_to_async(views.success)(request)
+
+
+async def failed(request: HttpRequest) -> HttpResponse:
+    """Asyncio version of views.failed()"""
+    return await sync_to_async(views.failed)(request)
+
+
+@csrf_exempt
+async def callback(request: HttpRequest) -> HttpResponse:
+    """Asyncio version of views.callback()"""
+    return await sync_to_async(views.callback)(request)
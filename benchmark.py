@@ -0,0 +1,353 @@
+"""Benchmarks of checkout, callbacks, success and bulk operations against a local Quickpay stand-in
+
+    python manage.py quickpay_benchmark --requests 200 --concurrency 8
+
+Runs in a test database made from the shop's settings, like the test runner does. Quickpay is replaced by
+the in-memory simulator (simulator.py) with the given latency per call. Each scenario reports throughput,
+p50/p95/p99 latency and database queries per call:
+
+    checkout           POST to quickpay_checkout with a new cart per request
+    callback           Signed 'processed' callbacks for different orders
+    callback_burst     Bursts of concurrent identical callbacks for the same order, fighting over the Order lock
+    success            The success page while a callback holds the Order lock (--hold seconds)
+    bulk_capture       run_bulk_operation('capture'). Latency is per chunk of --chunk-size payments
+    renewal            Recurring subscription captures as made by run_renewals(). Needs Order.membership_id
+    payment_flow       Checkout, payment by the customer and the callbacks until the order is paid. Throughput
+                       is paid orders per second. Runs with QUICKPAY_AUTO_CAPTURE
+
+Scenarios with concurrency need a database with row locks (PostgreSQL, MySQL). SQLite serializes all writes,
+so the numbers only make sense with --concurrency 1 there.
+
+SETTINGS:
+    QUICKPAY_BENCHMARK_ORDER_DATA = Checkout form data merged into the default billing and shipping details.
+                                    Set it if the shop's order form has other required fields.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Callable, List, Optional
+
+from django.urls import reverse
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from mezzanine.conf import settings
+from cartridge.shop.models import Cart, Order, Product
+
+from .agreements import get_agreement
+from .bulk import run_bulk_operation
+from .models import QuickpayPayment
+from .payment import capture_subscription_order, sign_order
+from .simulator import QuickpaySimulator, set_simulator
+
+
+__author__ = 'jfk@metation.dk'
+
+
+SCENARIOS = ('checkout', 'callback', 'callback_burst', 'success', 'bulk_capture', 'renewal', 'payment_flow')
+
+ORDER_DATA = {
+    'billing_detail_first_name': 'Bench', 'billing_detail_last_name': 'Mark',
+    'billing_detail_street': 'Benchmark Street 1', 'billing_detail_city': 'Copenhagen',
+    'billing_detail_state': '', 'billing_detail_postcode': '1000', 'billing_detail_country': 'Denmark',
+    'billing_detail_phone': '12345678', 'billing_detail_email': 'benchmark@example.com',
+    'same_billing_shipping': 'on',
+    'shipping_detail_first_name': 'Bench', 'shipping_detail_last_name': 'Mark',
+    'shipping_detail_street': 'Benchmark Street 1', 'shipping_detail_city': 'Copenhagen',
+    'shipping_detail_state': '', 'shipping_detail_postcode': '1000', 'shipping_detail_country': 'Denmark',
+    'shipping_detail_phone': '12345678',
+}
+
+
+# -- Measurements
+
+class ScenarioResult:
+    """Latencies and query counts of the calls of a scenario"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []  # type: List[float]
+        self.queries = []  # type: List[int]
+        self.errors = 0
+        self.elapsed = 0.0
+        self.note = ''
+
+    @property
+    def calls(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def throughput(self) -> float:
+        """Calls per second"""
+        return self.calls / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, p: float) -> float:
+        """Latency percentile in seconds, nearest rank"""
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(max(int(round(p / 100 * len(latencies) + 0.5)) - 1, 0), len(latencies) - 1)]
+
+    def as_dict(self) -> dict:
+        return {'scenario': self.name, 'calls': self.calls, 'errors': self.errors, 'elapsed': self.elapsed,
+                'throughput': self.throughput, 'p50': self.percentile(50), 'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'queries': sum(self.queries) / len(self.queries) if self.queries else 0.0,
+                'max_queries': max(self.queries) if self.queries else 0, 'note': self.note}
+
+    def __str__(self):
+        if self.note and not self.calls:
+            return '{:<16} {}'.format(self.name, self.note)
+        d = self.as_dict()
+        return ('{scenario:<16} {calls:>6} {errors:>6} {throughput:>9.1f} {p50_ms:>8.1f} {p95_ms:>8.1f} {p99_ms:>8.1f} '
+                '{queries:>7.1f} {max_queries:>5} {note}'
+                .format(p50_ms=d['p50'] * 1000, p95_ms=d['p95'] * 1000, p99_ms=d['p99'] * 1000, **d))
+
+    HEADER = '{:<16} {:>6} {:>6} {:>9} {:>8} {:>8} {:>8} {:>7} {:>5}'.format(
+        'scenario', 'calls', 'errors', 'calls/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'max')
+
+
+def run_concurrent(name: str, calls: List[Callable[[], bool]], concurrency: int) -> ScenarioResult:
+    """Run the calls on concurrency threads. Each call returns whether it succeeded"""
+    result = ScenarioResult(name)
+    result_lock = threading.Lock()
+
+    def measure(call: Callable[[], bool]):
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                start = time.monotonic()
+                try:
+                    ok = call()
+                except Exception:
+                    ok = False
+                latency = time.monotonic() - start
+            with result_lock:
+                result.latencies.append(latency)
+                result.queries.append(len(queries))
+                result.errors += not ok
+        finally:
+            connection.close()  # Each worker thread has its own connection
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(measure, calls))
+    result.elapsed = time.monotonic() - start
+    return result
+
+
+# -- Fixtures
+
+def make_order(**fields) -> Order:
+    return Order.objects.create(key='benchmark', total=Decimal('100.00'), item_total=Decimal('100.00'),
+                                billing_detail_email='benchmark@example.com', **fields)
+
+
+def make_paid_order(simulator: QuickpaySimulator, accepted: bool = False) -> QuickpayPayment:
+    """Order with a Quickpay payment authorized in Quickpay. Return the payment"""
+    order = make_order()
+    payment = QuickpayPayment.create_card_payment(order, order.total, 'DKK', '0008')
+    resource = simulator.create('Payment', '%s_%06d' % (order.id, payment.id))
+    resource = simulator.operate(resource['id'], 'authorize', payment.requested_amount)
+    if accepted:
+        payment.update_from_res(resource)
+        payment.save()
+    else:
+        payment.set_qp_id(resource['id'])
+    return payment
+
+
+def checkout_client() -> Client:
+    """Client with a session and a cart with one item"""
+    product = Product.objects.filter(title='Benchmark').first()
+    if product is None:
+        product = Product.objects.create(title='Benchmark', available=True)
+        product.variations.create(unit_price=Decimal('100.00'), sku='BENCHMARK')
+    client = Client()
+    cart = Cart.objects.create()
+    cart.add_item(product.variations.all()[0], 1)
+    session = client.session
+    session['cart'] = cart.id
+    session.save()
+    return client
+
+
+def callback_call(body: bytes, currency: str = 'DKK') -> Callable[[], bool]:
+    signature = get_agreement(currency).sign(body)
+
+    def call() -> bool:
+        response = Client().post(reverse('quickpay_callback'), data=body, content_type='application/json',
+                                 HTTP_QUICKPAY_CHECKSUM_SHA256=signature)
+        return response.status_code == 200
+    return call
+
+
+# -- Scenarios
+
+def bench_checkout(simulator: QuickpaySimulator, requests: int, concurrency: int, **kwargs) -> ScenarioResult:
+    data = dict(ORDER_DATA, **getattr(settings, 'QUICKPAY_BENCHMARK_ORDER_DATA', {}))
+    url = reverse('quickpay_checkout')
+
+    def call(client: Client) -> Callable[[], bool]:
+        def checkout() -> bool:
+            response = client.post(url, data)
+            return (response.status_code == 302 and response['Location'].startswith(simulator.LINK_URL)
+                    or response.status_code == 200 and simulator.LINK_URL.encode('utf-8') in response.content)
+        return checkout
+
+    return run_concurrent('checkout', [call(checkout_client()) for _ in range(requests)], concurrency)
+
+
+def bench_callback(simulator: QuickpaySimulator, requests: int, concurrency: int, **kwargs) -> ScenarioResult:
+    calls = []
+    for _ in range(requests):
+        payment = make_paid_order(simulator)
+        simulator.operate(payment.qp_id, 'capture', payment.requested_amount)
+        calls.append(callback_call(simulator.callback_body(payment.qp_id)))
+    return run_concurrent('callback', calls, concurrency)
+
+
+def bench_callback_burst(simulator: QuickpaySimulator, requests: int, concurrency: int, **kwargs) -> ScenarioResult:
+    calls = []
+    burst = max(concurrency, 2)
+    for _ in range(max(requests // burst, 1)):
+        payment = make_paid_order(simulator)
+        simulator.operate(payment.qp_id, 'capture', payment.requested_amount)
+        calls += [callback_call(simulator.callback_body(payment.qp_id))] * burst
+    result = run_concurrent('callback_burst', calls, burst)
+    result.note = '{} callbacks per order'.format(burst)
+    return result
+
+
+def bench_success(simulator: QuickpaySimulator, requests: int, concurrency: int, hold: float = 0.1,
+                  **kwargs) -> ScenarioResult:
+    url = reverse('quickpay_success')
+
+    def hold_lock(order: Order, locked: threading.Event):
+        try:
+            with transaction.atomic():
+                Order.objects.filter(pk=order.pk).select_for_update()[0]
+                locked.set()
+                time.sleep(hold)
+        finally:
+            locked.set()
+            connection.close()
+
+    def call(order: Order, client: Client) -> Callable[[], bool]:
+        def success() -> bool:
+            locked = threading.Event()
+            holder = threading.Thread(target=hold_lock, args=(order, locked))
+            holder.start()
+            locked.wait()
+            response = client.get(url, {'id': order.pk, 'hash': sign_order(order)})
+            holder.join()
+            return response.status_code == 302
+        return success
+
+    calls = []
+    for _ in range(requests):
+        payment = make_paid_order(simulator, accepted=True)
+        Order.objects.filter(pk=payment.order_id).update(transaction_id=str(payment.qp_id))
+        calls.append(call(Order.objects.get(pk=payment.order_id), checkout_client()))
+    result = run_concurrent('success', calls, concurrency)
+    result.note = 'lock held {:.0f} ms'.format(hold * 1000)
+    return result
+
+
+def bench_bulk_capture(simulator: QuickpaySimulator, requests: int, concurrency: int, chunk_size: int = 100,
+                       **kwargs) -> ScenarioResult:
+    payment_ids = [make_paid_order(simulator, accepted=True).pk for _ in range(requests)]
+    result = ScenarioResult('bulk_capture')
+    last = [time.monotonic()]
+
+    def progress(bulk_result):
+        result.latencies.append(time.monotonic() - last[0])
+        last[0] = time.monotonic()
+
+    with CaptureQueriesContext(connection) as queries:
+        start = last[0] = time.monotonic()
+        bulk_result = run_bulk_operation(QuickpayPayment.objects.filter(pk__in=payment_ids), 'capture',
+                                         workers=concurrency, chunk_size=chunk_size, progress=progress)
+        result.elapsed = time.monotonic() - start
+    result.errors = bulk_result.failed
+    result.queries = [len(queries) // max(len(result.latencies), 1)] * len(result.latencies)
+    result.note = '{} payments/s, per chunk of {}'.format(round(bulk_result.done / result.elapsed), chunk_size)
+    return result
+
+
+def bench_renewal(simulator: QuickpaySimulator, requests: int, concurrency: int, **kwargs) -> ScenarioResult:
+    if 'membership_id' not in [f.name for f in Order._meta.get_fields()]:
+        result = ScenarioResult('renewal')
+        result.note = 'skipped, Order has no membership_id'
+        return result
+
+    def call(order: Order) -> Callable[[], bool]:
+        def renew() -> bool:
+            capture_subscription_order(order, synchronized=False)
+            return True
+        return renew
+
+    orders = []
+    for _ in range(requests):
+        subscription = simulator.create('Subscription')
+        simulator.operate(subscription['id'], 'authorize', 10000)
+        orders.append(make_order(membership_id=str(subscription['id'])))
+    return run_concurrent('renewal', [call(order) for order in orders], concurrency)
+
+
+def bench_payment_flow(simulator: QuickpaySimulator, requests: int, concurrency: int, **kwargs) -> ScenarioResult:
+    paid_before = Order.objects.filter(transaction_id__isnull=False).count()
+    simulator.auto_pay = simulator.callbacks = True
+    try:
+        with override_settings(QUICKPAY_AUTO_CAPTURE=True):
+            start = time.monotonic()
+            result = bench_checkout(simulator, requests, concurrency)
+            simulator.wait()
+            result.elapsed = time.monotonic() - start
+    finally:
+        simulator.auto_pay = simulator.callbacks = False
+    paid = Order.objects.filter(transaction_id__isnull=False).count() - paid_before
+    result.name = 'payment_flow'
+    result.note = '{} orders paid, {:.0f} orders/min'.format(paid, paid / result.elapsed * 60)
+    return result
+
+
+BENCHMARKS = {
+    'checkout': bench_checkout,
+    'callback': bench_callback,
+    'callback_burst': bench_callback_burst,
+    'success': bench_success,
+    'bulk_capture': bench_bulk_capture,
+    'renewal': bench_renewal,
+    'payment_flow': bench_payment_flow,
+}
+
+
+def run_benchmarks(scenarios=SCENARIOS, requests: int = 100, concurrency: int = 8, latency: float = 0.02,
+                   hold: float = 0.1, chunk_size: int = 100,
+                   report: Optional[Callable[[ScenarioResult], None]] = None) -> List[ScenarioResult]:
+    """Run the scenarios against the simulator. Must be run in a test database, the scenarios create orders.
+
+    # Args:
+    requests : int = Calls per scenario
+    concurrency : int = Concurrent calls
+    latency : float = Mean seconds per Quickpay call
+    hold : float = Seconds a callback holds the Order lock in the success scenario
+    report : callable | None = Called with the result of each scenario when done
+    """
+    simulator = QuickpaySimulator(latency, callbacks=False, callback_workers=concurrency)
+    results = []
+    try:
+        with override_settings(QUICKPAY_TRANSPORT='cartridge_quickpay.simulator.SimulatorTransport',
+                               QUICKPAY_API_KEY='benchmark', QUICKPAY_PRIVATE_KEY='benchmark',
+                               QUICKPAY_ACCOUNT_ID=None, QUICKPAY_AGREEMENTS={}, QUICKPAY_CALLBACK_INBOX=False):
+            set_simulator(simulator)
+            for name in scenarios:
+                result = BENCHMARKS[name](simulator, requests, concurrency, hold=hold, chunk_size=chunk_size)
+                results.append(result)
+                if report is not None:
+                    report(result)
+    finally:
+        set_simulator(None)
+        simulator.close()
+    return results
@@ -0,0 +1,186 @@
+"""Bulk capture, refund and cancel of Quickpay payments
+
+    from cartridge_quickpay.bulk import eligible_payments, run_bulk_operation
+    result = run_bulk_operation(eligible_payments('capture'), 'capture', workers=8, rate=20)
+
+The Quickpay calls are made concurrently on a bounded thread pool and throttled to the given rate, in the batch lane
+of the shared rate limit (see ratelimit.py). The
+operation's response from Quickpay is applied to the payment, so each payment takes one API call instead of
+the three made by QuickpayPayment.capture() and refund(). The final state arrives with Quickpay's callback.
+Results are saved in chunks with bulk updates, except for payments whose rows got a later Quickpay state
+meanwhile, e.g. from that callback, which are left as they are.
+
+With a checkpoint file, the IDs of succeeded payments are appended to the file once they are saved, and
+payments listed there are skipped. An interrupted run is resumed by running it again with the same file.
+
+Also available as the quickpay_bulk management command.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from django.db import connection
+from django.db.models import QuerySet
+from django.utils.timezone import now
+from quickpay_api_client.exceptions import ApiError
+
+from .models import QuickpayPayment, QuickpayPaymentEvent, quickpay_client
+from .ratelimit import BATCH, TokenBucket, priority
+
+
+__author__ = 'jfk@metation.dk'
+
+
+OPERATIONS = ('capture', 'refund', 'cancel')
+
+
+class BulkResult:
+    """Outcome of a bulk operation"""
+
+    def __init__(self):
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.errors = {}  # type: Dict[int, str]  # payment id -> error message
+
+    @property
+    def done(self) -> int:
+        return self.succeeded + self.failed + self.skipped
+
+    def __str__(self):
+        return "{} succeeded, {} failed, {} skipped".format(self.succeeded, self.failed, self.skipped)
+
+
+def eligible_payments(operation: str) -> QuerySet:
+    """Payments the operation may be applied to"""
+    payments = QuickpayPayment.objects.filter(qp_id__isnull=False)
+    if operation in ('capture', 'cancel'):
+        # As QuickpayPayment.may_capture, but without payments Quickpay rejected or that were cancelled already
+        return (payments.filter(accepted_date__isnull=False, captured_date__isnull=True)
+                .exclude(state__in=('rejected', 'cancelled')))
+    elif operation == 'refund':
+        return payments.filter(captured_date__isnull=False, balance__gt=0)
+    raise ValueError("Unknown operation '{}'".format(operation))
+
+
+def run_bulk_operation(payments: QuerySet, operation: str, amount: Optional[Decimal] = None, workers: int = 8,
+                       rate: Optional[float] = None, checkpoint: Optional[str] = None, chunk_size: int = 500,
+                       progress: Optional[Callable[[BulkResult], None]] = None) -> BulkResult:
+    """Apply operation ('capture', 'refund' or 'cancel') to the payments.
+
+    # Args:
+    payments : QuerySet = The payments, e.g. eligible_payments('capture')
+    amount : Decimal | None = Amount to capture or refund per payment, default the full amount
+    workers : int = Max. concurrent Quickpay calls
+    rate : float | None = Max. Quickpay calls per second, None for no limit
+    checkpoint : str | None = Path of checkpoint file for resuming
+    chunk_size : int = Payments read and saved at a time
+    progress : callable | None = Called with the result so far after each chunk
+    """
+    if operation not in OPERATIONS:
+        raise ValueError("Unknown operation '{}'".format(operation))
+    done = _read_checkpoint(checkpoint)
+    limiter = TokenBucket(rate, burst=workers) if rate else None
+    result = BulkResult()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in payment_chunks(payments, chunk_size):
+            todo = [p for p in chunk if p.pk not in done]
+            result.skipped += len(chunk) - len(todo)
+            outcomes = list(executor.map(lambda p: _apply(p, operation, amount, limiter), todo))
+
+            QuickpayPayment.bulk_save([p for p, error, _ in outcomes if error is None],
+                                      QuickpayPayment.QUICKPAY_FIELDS, later_only=True)
+            QuickpayPaymentEvent.record_many([event for _, error, event in outcomes if error is None])
+            succeeded = []
+            for payment, error, _ in outcomes:
+                if error is None:
+                    result.succeeded += 1
+                    succeeded.append(payment.pk)
+                else:
+                    result.failed += 1
+                    result.errors[payment.pk] = error
+            _write_checkpoint(checkpoint, succeeded)
+            logging.info("cartridge_quickpay.bulk: %s %s", operation, result)
+            if progress is not None:
+                progress(result)
+    return result
+
+
+def _apply(payment: QuickpayPayment, operation: str, amount: Optional[Decimal], limiter: Optional[TokenBucket]
+           ) -> Tuple[QuickpayPayment, Optional[str], Optional[QuickpayPaymentEvent]]:
+    """Make the Quickpay call for one payment and apply the response. Doesn't touch the database.
+    Return (payment, error message or None, unsaved event or None)"""
+    if operation == 'capture':
+        int_amount = payment.capture_amount(amount)
+    elif operation == 'refund':
+        int_amount = payment.refund_amount(amount)
+    else:
+        int_amount = None
+    args = {'amount': int_amount} if int_amount is not None else {}
+    if limiter is not None:
+        limiter.acquire()
+    try:
+        with priority(BATCH):
+            res = quickpay_client(payment.requested_currency).post(
+                '/payments/{}/{}'.format(payment.qp_id, operation), **args)
+    except ApiError as e:
+        logging.error("QuickPay API error: %s" % e.body)
+        return payment, e.body, None
+    except Exception as e:  # Network errors etc. must not stop the run
+        logging.exception("cartridge_quickpay.bulk: %s of payment %s failed", operation, payment.pk)
+        return payment, str(e), None
+
+    balance = payment.balance or 0
+    payment.update_from_res(res)
+    if operation == 'capture':
+        payment.captured_date = now()
+    elif operation == 'refund':
+        # The response may be from before the refund was processed
+        payment.balance = max(balance - int_amount, 0)
+        if payment.balance == 0:
+            payment.captured_date = None
+    return payment, None, QuickpayPaymentEvent.from_res(payment, res, QuickpayPaymentEvent.SOURCE_OPERATION)
+
+
+def payment_chunks(payments: QuerySet, chunk_size: int) -> Iterator[List[QuickpayPayment]]:
+    """Iterate over payments in chunks by primary key. Doesn't hold a cursor open between chunks"""
+    last_pk = 0
+    while True:
+        chunk = list(payments.filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def close_worker_connections(executor: ThreadPoolExecutor, workers: int):
+    """Close the database connection of each of the executor's worker threads. Call when no other work is
+    left, e.g. instead of closing the connection after each task"""
+    # Each call waits for the others, so each runs on a thread of its own
+    barrier = threading.Barrier(workers)
+
+    def close():
+        barrier.wait()
+        connection.close()
+
+    for future in [executor.submit(close) for _ in range(workers)]:
+        future.result()
+
+
+def _read_checkpoint(path: Optional[str]) -> Set[int]:
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {int(line) for line in f if line.strip()}
+
+
+def _write_checkpoint(path: Optional[str], payment_ids: List[int]):
+    if path and payment_ids:
+        with open(path, 'a') as f:
+            f.write(''.join('{}\n'.format(pk) for pk in payment_ids))
+            f.flush()
+            os.fsync(f.fileno())
@@ -0,0 +1,243 @@
+"""Pooled Quickpay API client
+
+QuickpayClient has the same calling convention as quickpay_api_client.QPClient (client.get(path, **args),
+client.post(path, **args), ...) but keeps its HTTP connections alive between calls. Clients are kept in a
+process-wide registry, one per agreement (API key), so the sequential API calls made during checkout, capture
+and callbacks reuse warm TLS connections instead of doing a new handshake per call.
+
+SETTINGS:
+    QUICKPAY_API_URL         = Base URL of the Quickpay API, defaults to 'https://api.quickpay.net'
+    QUICKPAY_POOL_SIZE       = Max. number of keep-alive connections per agreement, defaults to 10.
+                               Set it to at least the number of threads per process calling Quickpay.
+    QUICKPAY_CONNECT_TIMEOUT = Connect timeout in seconds, defaults to 5
+    QUICKPAY_READ_TIMEOUT    = Read timeout in seconds, defaults to 30
+    QUICKPAY_TRANSPORT       = Dotted path to the Transport class sending the requests, defaults to
+                               'cartridge_quickpay.client.RequestsTransport'. Set it to
+                               'cartridge_quickpay.simulator.SimulatorTransport' to run against the in-memory
+                               Quickpay simulator.
+
+Calls are made with the per-endpoint timeouts, deadlines, retries and circuit breaker of resilience.py, and take a
+token from the shared rate limit of ratelimit.py first.
+
+The registry is thread safe. Connections are never shared between processes: a forked child (e.g. a
+pre-forking WSGI server worker) discards the clients inherited from its parent and builds its own.
+"""
+import abc
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Mapping, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from quickpay_api_client.exceptions import ApiError
+
+from . import metrics, ratelimit, resilience
+
+
+__author__ = 'jfk@metation.dk'
+
+
+DEFAULT_API_URL = 'https://api.quickpay.net'
+
+
+def api_headers(secret: str) -> Dict[str, str]:
+    """HTTP headers sent with every API call"""
+    return {
+        'Accept-Version': 'v%s' % QuickpayClient.api_version,
+        'Accept': 'application/json',
+        'User-Agent': 'cartridge-quickpay',
+        'Authorization': 'Basic {0}'.format(base64.b64encode(secret.encode('utf-8')).decode('utf-8')),
+    }
+
+
+def client_settings() -> Tuple[str, int, Tuple[float, float]]:
+    """Get (base URL, pool size, (connect timeout, read timeout)) for clients from settings"""
+    return (getattr(settings, 'QUICKPAY_API_URL', DEFAULT_API_URL),
+            getattr(settings, 'QUICKPAY_POOL_SIZE', 10),
+            (getattr(settings, 'QUICKPAY_CONNECT_TIMEOUT', 5), getattr(settings, 'QUICKPAY_READ_TIMEOUT', 30)))
+
+
+class Transport(abc.ABC):
+    """Sends the HTTP requests of a QuickpayClient"""
+
+    @abc.abstractmethod
+    def send(self, method: str, url: str, params: Optional[dict], data: Optional[bytes], headers: Dict[str, str],
+             timeout: Tuple[float, float]) -> Tuple[int, bytes, Mapping[str, str]]:
+        """Send request. Return (status code, body, response headers).
+        Raise OSError or requests.RequestException on network errors"""
+
+    def close(self):
+        pass
+
+
+class RequestsTransport(Transport):
+    """Transport over a requests session with a keep-alive connection pool"""
+
+    def __init__(self, pool_size: int = 10):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def send(self, method, url, params, data, headers, timeout):
+        response = self.session.request(method, url, params=params, data=data, headers=headers, timeout=timeout)
+        return response.status_code, response.content, response.headers
+
+    def close(self):
+        self.session.close()
+
+
+class QuickpayClient:
+    """Quickpay API client with a keep-alive connection pool. Drop-in replacement for QPClient"""
+    api_version = '10'
+
+    def __init__(self, secret: str, base_url: str = DEFAULT_API_URL, pool_size: int = 10,
+                 timeout: Tuple[float, float] = (5, 30), transport: Optional[Transport] = None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.headers = api_headers(secret)
+        self.transport = transport or RequestsTransport(pool_size)
+        self.breaker = resilience.get_breaker(secret)
+
+    def perform(self, method: str, path: str, **kwargs):
+        """Make API call. Return the decoded JSON result. Raise ApiError if Quickpay returns an error, and
+        QuickpayUnavailable if Quickpay doesn't answer or is failing. Idempotent calls are retried.
+        Pass raw=True to get [status code, body, headers] as QPClient does"""
+        raw = kwargs.pop('raw', False)
+        headers = dict(self.headers, **kwargs.pop('headers', None) or {})
+        url = self.base_url + path
+        if method in ('get', 'delete'):
+            params, data = kwargs, None
+        else:
+            params, data = None, json.dumps(kwargs, default=str).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        endpoint = metrics.endpoint(path)
+        timeout = resilience.endpoint_timeout(endpoint, self.timeout)
+        retries = resilience.max_retries() if resilience.is_idempotent(method, endpoint) else 0
+        for attempt in range(retries + 1):
+            if attempt:
+                metrics.api_retries.inc(endpoint=endpoint)
+            ratelimit.acquire()
+            call_timeout = resilience.call_timeout(timeout)
+            trial = self.breaker.before_call()
+            start = time.monotonic()
+            status, error = 'error', None
+            try:
+                status, content, response_headers = self.transport.send(method, url, params, data, headers,
+                                                                        call_timeout)
+            except (OSError, requests.RequestException) as e:
+                error = e
+            except BaseException:
+                self.breaker.record(False, trial)
+                raise
+            finally:
+                metrics.api_calls.observe(time.monotonic() - start, method=method, endpoint=endpoint, status=status)
+            failed = error is not None or resilience.is_failure(status)
+            self.breaker.record(not failed, trial)
+            if not failed:
+                break
+            delay = resilience.retry_delay(attempt + 1)
+            if attempt == retries or not resilience.may_wait(delay):
+                break
+            logging.warning("cartridge_quickpay.client: %s %s failed (%s), retrying", method.upper(), endpoint,
+                            error or status)
+            time.sleep(delay)
+        if error is not None:
+            raise resilience.no_answer() from error
+        if not 200 <= status < 300:
+            raise ApiError(error_body(content), status)
+        body = json.loads(content.decode('utf-8')) if content else None
+        if raw:
+            return [status, body, response_headers]
+        return body
+
+    def get(self, path: str, **kwargs):
+        return self.perform('get', path, **kwargs)
+
+    def post(self, path: str, **kwargs):
+        return self.perform('post', path, **kwargs)
+
+    def put(self, path: str, **kwargs):
+        return self.perform('put', path, **kwargs)
+
+    def patch(self, path: str, **kwargs):
+        return self.perform('patch', path, **kwargs)
+
+    def delete(self, path: str, **kwargs):
+        return self.perform('delete', path, **kwargs)
+
+    def close(self):
+        self.transport.close()
+
+
+def error_body(content: bytes):
+    """Body of an error response for ApiError: the decoded JSON error if any, as QPClient does, else the text"""
+    text = content.decode('utf-8', 'replace')
+    try:
+        body = json.loads(text)
+    except ValueError:
+        return text
+    return body if not isinstance(body, dict) or 'message' in body else text
+
+
+_clients: Dict[str, QuickpayClient] = {}
+_clients_lock = threading.Lock()
+_clients_pid = os.getpid()
+
+
+def get_client(secret: str) -> QuickpayClient:
+    """Get the pooled client for the agreement with the given API secret. Create it on first use"""
+    global _clients_pid
+    client = _clients.get(secret)
+    if client is not None and _clients_pid == os.getpid():
+        return client
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            # Forked since the clients were made. Don't touch the parent's sockets, just forget them
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(secret)
+        if client is None:
+            base_url, pool_size, timeout = client_settings()
+            transport = import_string(getattr(settings, 'QUICKPAY_TRANSPORT',
+                                              'cartridge_quickpay.client.RequestsTransport'))(pool_size)
+            client = QuickpayClient(secret, base_url=base_url, pool_size=pool_size, timeout=timeout,
+                                    transport=transport)
+            logging.debug("cartridge_quickpay.client.get_client: new client, pool size {}".format(pool_size))
+            _clients[secret] = client
+        return client
+
+
+def close_clients():
+    """Close all pooled clients. They are recreated on next use"""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def _after_fork_in_child():
+    global _clients_pid, _clients_lock
+    _clients.clear()
+    _clients_pid = os.getpid()
+    _clients_lock = threading.Lock()  # May have been held by another thread in the parent at fork time
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+@receiver(setting_changed)
+def _reset_clients(setting, **kwargs):
+    """Make new clients when settings are changed in tests"""
+    if setting in ('QUICKPAY_API_URL', 'QUICKPAY_POOL_SIZE', 'QUICKPAY_CONNECT_TIMEOUT', 'QUICKPAY_READ_TIMEOUT',
+                   'QUICKPAY_TRANSPORT'):
+        close_clients()
@@ -0,0 +1,101 @@
+"""Currencies and amounts in minor units
+
+Quickpay takes amounts as integers in the minor unit of the currency: øre for DKK, cent for EUR, yen for JPY
+(no decimals) and fils for KWD (three decimals). The number of decimals of each currency is looked up in a table
+from ISO 4217, so converting amounts doesn't depend on the process' locale.
+
+The shop's currency is found from SHOP_CURRENCY_LOCALE once per process, or set directly:
+
+SETTINGS:
+    QUICKPAY_CURRENCY = ISO 4217 code of the shop's currency, e.g. 'DKK'. Default the currency of
+                        SHOP_CURRENCY_LOCALE
+"""
+import locale
+import threading
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Optional
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from mezzanine.conf import settings
+
+
+__author__ = 'jfk@metation.dk'
+
+
+# Decimals of ISO 4217 currencies that don't have 2
+MINOR_UNITS = {
+    # No decimals
+    'BIF': 0, 'CLP': 0, 'DJF': 0, 'GNF': 0, 'ISK': 0, 'JPY': 0, 'KMF': 0, 'KRW': 0, 'PYG': 0, 'RWF': 0,
+    'UGX': 0, 'UYI': 0, 'VND': 0, 'VUV': 0, 'XAF': 0, 'XOF': 0, 'XPF': 0,
+    # Three decimals
+    'BHD': 3, 'IQD': 3, 'JOD': 3, 'KWD': 3, 'LYD': 3, 'OMR': 3, 'TND': 3,
+    # Four decimals
+    'CLF': 4, 'UYW': 4,
+}
+
+# Decimal to scale an amount by, per number of decimals
+_SCALES = {decimals: Decimal(10) ** decimals for decimals in set(MINOR_UNITS.values()) | {2}}
+
+
+def minor_unit_decimals(currency: str) -> int:
+    """Number of decimals of the currency"""
+    return MINOR_UNITS.get(currency.upper(), 2)
+
+
+def to_minor_units(amount: Decimal, currency: str) -> int:
+    """Amount in minor units of the currency, e.g. Decimal('12.50') DKK -> 1250.
+    Amounts with more decimals than the currency has are rounded half up"""
+    return int((amount * _SCALES[minor_unit_decimals(currency)]).to_integral_value(ROUND_HALF_UP))
+
+
+def from_minor_units(int_amount: int, currency: str) -> Decimal:
+    """Amount in minor units of the currency as a Decimal, e.g. 1250 DKK -> Decimal('12.50')"""
+    decimals = minor_unit_decimals(currency)
+    return Decimal(int_amount).scaleb(-decimals).quantize(Decimal(1).scaleb(-decimals))
+
+
+_default_currency = None  # type: Optional[str]
+_default_currency_lock = threading.Lock()
+
+
+def default_currency() -> str:
+    """The shop's currency. Found once per process"""
+    global _default_currency
+    currency = _default_currency
+    if currency is None:
+        with _default_currency_lock:
+            if _default_currency is None:
+                _default_currency = _resolve_default_currency()
+            currency = _default_currency
+    return currency
+
+
+def _resolve_default_currency() -> str:
+    currency = getattr(settings, 'QUICKPAY_CURRENCY', None)
+    if currency:
+        return currency.upper()
+    # The locale is process wide, so it's only switched here, once, and switched back right away
+    shop_locale = str(settings.SHOP_CURRENCY_LOCALE)
+    previous = locale.setlocale(locale.LC_MONETARY)
+    try:
+        locale.setlocale(locale.LC_MONETARY, shop_locale)
+        currency = locale.localeconv()['int_curr_symbol'][0:3]
+    except locale.Error:
+        raise ImproperlyConfigured("Locale '{}' in SHOP_CURRENCY_LOCALE isn't available, set QUICKPAY_CURRENCY"
+                                   .format(shop_locale))
+    finally:
+        locale.setlocale(locale.LC_MONETARY, previous)
+    if not currency.strip():
+        raise ImproperlyConfigured("Locale '{}' in SHOP_CURRENCY_LOCALE has no currency, set QUICKPAY_CURRENCY"
+                                   .format(shop_locale))
+    return currency
+
+
+@receiver(setting_changed)
+def _reset_default_currency(setting, **kwargs):
+    """Find the currency again when settings are changed in tests"""
+    global _default_currency
+    if setting in ('QUICKPAY_CURRENCY', 'SHOP_CURRENCY_LOCALE'):
+        _default_currency = None
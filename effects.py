@@ -0,0 +1,165 @@
+"""Side effects of payments run after commit
+
+With QUICKPAY_DEFER_SIDE_EFFECTS, order_handler doesn't send order_authorized and order_captured (and so
+doesn't create subscriptions) while it holds the Order lock, and the success page doesn't wait for the order
+mail. They are run when the transaction has been committed, on a bounded pool of threads:
+
+- The side effects of an order run one at a time, in the order they were registered.
+- A failing side effect is retried with backoff, QUICKPAY_SIDE_EFFECT_RETRIES times. Retries resend a signal to
+  all its receivers, so receivers must tolerate being called again. The order mail isn't retried, as it may have
+  been sent before the failure.
+- Signal receivers get the Order re-read and locked in a transaction of their own.
+- Side effects don't use the request, which is done with by then. They get a detached_request() copy instead.
+
+Side effects are kept in memory, so they are lost if the process is killed before they have run. Without
+QUICKPAY_DEFER_SIDE_EFFECTS, they run immediately as before.
+
+SETTINGS:
+    QUICKPAY_DEFER_SIDE_EFFECTS      = Whether to run side effects after commit in the background, default False
+    QUICKPAY_SIDE_EFFECT_WORKERS     = Threads running side effects per process, default 4
+    QUICKPAY_SIDE_EFFECT_RETRIES     = Retries of a failing side effect, default 3
+    QUICKPAY_SIDE_EFFECT_RETRY_DELAY = Seconds before the first retry, doubled for each retry, default 1
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection, transaction
+from django.dispatch import Signal
+from django.http import HttpRequest
+from django.utils import translation
+from mezzanine.conf import settings
+from cartridge.shop.models import Order
+
+from . import metrics
+
+
+__author__ = 'jfk@metation.dk'
+
+
+Effect = Callable[[], None]
+
+
+def deferred() -> bool:
+    """Whether side effects are run after commit in the background"""
+    return getattr(settings, 'QUICKPAY_DEFER_SIDE_EFFECTS', False)
+
+
+def run_after_commit(order_id: int, name: str, effect: Effect, retry: bool = True):
+    """Run effect in the background when the current transaction has been committed, after the side effects
+    registered earlier for the same order. Runs it right away in the background if no transaction is open.
+    Without retry, a failing effect isn't run again, e.g. because it may have taken effect before failing"""
+    transaction.on_commit(lambda: get_dispatcher().submit(order_id, name, effect, retry))
+
+
+def send_signal_after_commit(signal: Signal, name: str, order_id: int, **kwargs):
+    """Send signal for the Order when the current transaction has been committed. The receivers get the Order
+    locked in a transaction"""
+    def send():
+        with transaction.atomic():
+            order = Order.objects.select_for_update().get(pk=order_id)
+            signal.send(sender=Order, instance=order, **kwargs)
+    run_after_commit(order_id, name, send)
+
+
+class _DetachedRequest(HttpRequest):
+    """Copy of a request without its session, user and body. See detached_request()"""
+
+    def __init__(self, request: HttpRequest):
+        super().__init__()
+        self.META = {key: value for key, value in request.META.items() if isinstance(value, str)}
+        self.method, self.path, self.path_info = request.method, request.path, request.path_info
+        self.GET = request.GET.copy()
+        self.LANGUAGE_CODE = getattr(request, 'LANGUAGE_CODE', translation.get_language())
+        self.user = AnonymousUser()
+        self._scheme = request.scheme
+
+    def _get_scheme(self):
+        return self._scheme
+
+
+def detached_request(request: HttpRequest) -> HttpRequest:
+    """Copy of request with what templates and mails need (host, scheme, path, query and language) for use after
+    the response has been returned. Its session and user aren't copied, so they aren't loaded on another thread"""
+    return _DetachedRequest(request)
+
+
+class EffectDispatcher:
+    """Runs side effects on a thread pool, one at a time per order"""
+
+    def __init__(self, workers: int = 4, retries: int = 3, retry_delay: float = 1.0):
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._queues = {}  # type: Dict[int, Deque[Tuple[str, Effect, bool]]]
+        self._waiting = 0  # Orders submitted to the executor whose side effects haven't started
+        self._lock = threading.Lock()
+
+    def submit(self, order_id: int, name: str, effect: Effect, retry: bool = True):
+        with self._lock:
+            queue = self._queues.get(order_id)
+            if queue is not None:
+                # The order's side effects are being run, the runner picks this one up when done with the others
+                queue.append((name, effect, retry))
+                return
+            self._queues[order_id] = deque([(name, effect, retry)])
+            self._waiting += 1
+        self._executor.submit(self._run_queue, order_id)
+
+    def _run_queue(self, order_id: int):
+        with self._lock:
+            self._waiting -= 1
+        try:
+            while True:
+                with self._lock:
+                    queue = self._queues[order_id]
+                    if not queue:
+                        del self._queues[order_id]
+                        return
+                    name, effect, retry = queue[0]
+                self._run(order_id, name, effect, self.retries if retry else 0)
+                with self._lock:
+                    queue.popleft()
+        finally:
+            with self._lock:
+                idle = not self._waiting
+            if idle:
+                # The connection is kept while more orders are waiting, and not held open by an idle thread
+                connection.close()
+
+    def _run(self, order_id: int, name: str, effect: Effect, retries: int):
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                effect()
+                metrics.side_effects.inc(effect=name, outcome='done')
+                return
+            except Exception:
+                logging.exception("cartridge_quickpay.effects: %s for order %s failed, attempt %d",
+                                  name, order_id, attempt + 1)
+                metrics.side_effects.inc(effect=name, outcome='retried' if attempt < retries else 'failed')
+                connection.close()  # May be broken
+        logging.error("cartridge_quickpay.effects: giving up %s for order %s", name, order_id)
+
+
+_dispatcher = None  # type: Optional[EffectDispatcher]
+_dispatcher_pid = None  # type: Optional[int]
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher() -> EffectDispatcher:
+    """Get the dispatcher of this process. Made on first use, and again in a forked child"""
+    global _dispatcher, _dispatcher_pid
+    with _dispatcher_lock:
+        if _dispatcher is None or _dispatcher_pid != os.getpid():
+            _dispatcher = EffectDispatcher(getattr(settings, 'QUICKPAY_SIDE_EFFECT_WORKERS', 4),
+                                           getattr(settings, 'QUICKPAY_SIDE_EFFECT_RETRIES', 3),
+                                           getattr(settings, 'QUICKPAY_SIDE_EFFECT_RETRY_DELAY', 1))
+            _dispatcher_pid = os.getpid()
+        return _dispatcher
@@ -0,0 +1,88 @@
+"""Asynchronous processing of Quickpay callbacks
+
+With QUICKPAY_CALLBACK_INBOX = True, views.callback() only verifies the callback, stores it as a
+QuickpayCallback and returns. The callbacks are processed by the quickpay_callback_worker management command:
+
+    python manage.py quickpay_callback_worker
+
+Any number of workers may run side by side, on one node or several. A worker claims a batch of callbacks with
+SELECT ... FOR UPDATE SKIP LOCKED, leases them and processes each one in a transaction of its own. Claimed
+callbacks not finished before the lease expires (e.g. the worker died) are picked up by another worker.
+Failed callbacks are retried with exponential backoff and are marked dead after QUICKPAY_CALLBACK_MAX_ATTEMPTS.
+
+SELECT ... FOR UPDATE SKIP LOCKED requires PostgreSQL, Oracle or MySQL >= 8.
+
+SETTINGS:
+    QUICKPAY_CALLBACK_INBOX        = Whether to process callbacks in the worker, default False
+    QUICKPAY_CALLBACK_MAX_ATTEMPTS = Attempts before a callback is marked dead, default 10
+    QUICKPAY_CALLBACK_RETRY_DELAY  = Seconds before first retry, doubled for each attempt, default 30
+    QUICKPAY_CALLBACK_LEASE        = Seconds a worker may spend on a batch before others may take over, default 300
+"""
+import json
+import logging
+import traceback
+from datetime import timedelta
+from typing import List
+
+from django.db import transaction
+from django.utils.timezone import now
+from mezzanine.conf import settings
+
+from .models import QuickpayCallback
+
+
+__author__ = 'jfk@metation.dk'
+
+
+_MAX_RETRY_DELAY = 3600
+
+
+def claim_callbacks(batch_size: int) -> List[QuickpayCallback]:
+    """Claim a batch of callbacks due for processing. Other workers skip them until the lease expires"""
+    lease = getattr(settings, 'QUICKPAY_CALLBACK_LEASE', 300)
+    timestamp = now()
+    with transaction.atomic():
+        callbacks = list(QuickpayCallback.objects
+                         .filter(status__in=[QuickpayCallback.STATUS_PENDING, QuickpayCallback.STATUS_PROCESSING],
+                                 next_attempt__lte=timestamp)
+                         .order_by('next_attempt', 'id')
+                         .select_for_update(skip_locked=True)[:batch_size])
+        if callbacks:
+            (QuickpayCallback.objects
+             .filter(pk__in=[c.pk for c in callbacks])
+             .update(status=QuickpayCallback.STATUS_PROCESSING, next_attempt=timestamp + timedelta(seconds=lease)))
+    return callbacks
+
+
+def process_inbox_callback(callback: QuickpayCallback) -> bool:
+    """Process a claimed callback and register the result. Return whether it succeeded"""
+    from .views import process_callback
+    try:
+        process_callback(json.loads(callback.body))
+    except Exception:
+        callback.attempts += 1
+        callback.last_error = traceback.format_exc()
+        if callback.attempts >= getattr(settings, 'QUICKPAY_CALLBACK_MAX_ATTEMPTS', 10):
+            logging.error("cartridge_quickpay.inbox: callback %s failed %d times, giving up:\n%s",
+                          callback.pk, callback.attempts, callback.last_error)
+            callback.status = QuickpayCallback.STATUS_DEAD
+        else:
+            logging.warning("cartridge_quickpay.inbox: callback %s failed, attempt %d:\n%s",
+                            callback.pk, callback.attempts, callback.last_error)
+            delay = getattr(settings, 'QUICKPAY_CALLBACK_RETRY_DELAY', 30) * 2 ** (callback.attempts - 1)
+            callback.status = QuickpayCallback.STATUS_PENDING
+            callback.next_attempt = now() + timedelta(seconds=min(delay, _MAX_RETRY_DELAY))
+        callback.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt'])
+        return False
+    callback.status = QuickpayCallback.STATUS_DONE
+    callback.processed = now()
+    callback.save(update_fields=['status', 'processed'])
+    return True
+
+
+def process_inbox(batch_size: int = 50) -> int:
+    """Claim and process one batch of callbacks. Return the number of callbacks claimed"""
+    callbacks = claim_callbacks(batch_size)
+    for callback in callbacks:
+        process_inbox_callback(callback)
+    return len(callbacks)
@@ -0,0 +1,101 @@
+"""Background bulk jobs started from the admin
+
+    from cartridge_quickpay.jobs import start_job, get_job
+    job_id = start_job('capture', payments)
+    get_job(job_id)  # {'operation': 'capture', 'total': 1200, 'done': 500, ...}
+
+A job runs a bulk capture or refund (see bulk.py) or a sync of the selected payments (see sync.py) in a thread of
+the process that started it, so the admin request returns right away. Its progress is kept in QUICKPAY_CACHE, so
+it can be followed from any process. Jobs are lost if the process is stopped; run the quickpay_bulk command for
+long runs that must be resumable.
+
+SETTINGS:
+    QUICKPAY_ADMIN_JOB_WORKERS = Max. concurrent Quickpay calls per job, default 4
+    QUICKPAY_ADMIN_JOB_RATE    = Max. Quickpay calls per second per job, default None for no limit
+"""
+import logging
+import threading
+import uuid
+from typing import Optional
+
+from django.db import connection
+from django.db.models import QuerySet
+from django.utils.timezone import now
+from mezzanine.conf import settings
+
+from .bulk import eligible_payments, run_bulk_operation
+from .payment import quickpay_cache
+from .sync import sync_selected_payments
+
+
+__author__ = 'jfk@metation.dk'
+
+
+JOB_OPERATIONS = ('capture', 'refund', 'sync')
+
+# Seconds the progress of a job is kept after its last update
+_JOB_TTL = 24 * 3600
+
+# Max. errors kept in the progress of a job
+_MAX_ERRORS = 20
+
+
+def _job_key(job_id: str) -> str:
+    return 'cartridge_quickpay:job:{}'.format(job_id)
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    """Progress of a job, None if unknown or expired"""
+    return quickpay_cache().get(_job_key(job_id))
+
+
+def _set_job(job_id: str, job: dict):
+    quickpay_cache().set(_job_key(job_id), job, _JOB_TTL)
+
+
+def start_job(operation: str, payments: QuerySet, user: str = '') -> str:
+    """Start operation ('capture', 'refund' or 'sync') on the payments in the background. Payments the operation
+    can't be applied to are left out. Return the ID of the job"""
+    if operation not in JOB_OPERATIONS:
+        raise ValueError("Unknown operation '{}'".format(operation))
+    if operation != 'sync':
+        payments = eligible_payments(operation).filter(pk__in=payments.values('pk'))
+    else:
+        payments = payments.filter(qp_id__isnull=False)
+    job_id = uuid.uuid4().hex
+    job = {'operation': operation, 'user': user, 'total': payments.count(), 'done': 0, 'succeeded': 0,
+           'failed': 0, 'errors': [], 'started': now(), 'finished': None}
+    _set_job(job_id, job)
+    threading.Thread(target=_run_job, args=(job_id, job, payments), daemon=True,
+                     name='quickpay-job-{}'.format(job_id)).start()
+    return job_id
+
+
+def _run_job(job_id: str, job: dict, payments: QuerySet):
+    workers = getattr(settings, 'QUICKPAY_ADMIN_JOB_WORKERS', 4)
+
+    def progress(result):
+        job['done'] = result.done
+        if job['operation'] == 'sync':
+            job['succeeded'] = result.fetched
+            job['failed'] = result.failed
+        else:
+            job['succeeded'] = result.succeeded
+            job['failed'] = result.failed
+            job['errors'] = ['{}: {}'.format(pk, error)
+                             for pk, error in list(result.errors.items())[:_MAX_ERRORS]]
+        _set_job(job_id, job)
+
+    try:
+        if job['operation'] == 'sync':
+            sync_selected_payments(payments, workers=workers, progress=progress)
+        else:
+            run_bulk_operation(payments, job['operation'], workers=workers,
+                               rate=getattr(settings, 'QUICKPAY_ADMIN_JOB_RATE', None), progress=progress)
+    except Exception as e:
+        logging.exception("cartridge_quickpay.jobs: %s job %s failed", job['operation'], job_id)
+        job['errors'].append(str(e))
+    finally:
+        job['finished'] = now()
+        _set_job(job_id, job)
+        connection.close()  # The thread has its own connection
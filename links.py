@@ -0,0 +1,121 @@
+"""Payment links for many orders, e.g. for an invoice run
+
+    from cartridge_quickpay.links import generate_payment_links
+    result = generate_payment_links(Order.objects.filter(status=1), write=print, workers=8)
+
+Gets the payment link of each order with get_quickpay_link() on a bounded thread pool, in the batch lane of the
+shared rate limit (see ratelimit.py). Orders are read in chunks, and a row per order is passed to write() as soon
+as its chunk is done, so output streams while memory stays bounded by the chunk size. An order with a link made
+within QUICKPAY_LINK_REUSE_TTL gets that link again.
+
+Orders whose IDs are in done are skipped, so an interrupted run is resumed by passing the orders that got a link.
+
+Also available as the quickpay_payment_link management command.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Union
+
+from django.db.models import QuerySet
+from quickpay_api_client.exceptions import ApiError
+from cartridge.shop.models import Order
+
+from .bulk import close_worker_connections, payment_chunks
+from .payment import get_quickpay_link
+from .ratelimit import BATCH, priority
+
+
+__author__ = 'jfk@metation.dk'
+
+
+# Fields of the rows passed to write()
+ROW_FIELDS = ('order_id', 'payment_id', 'url', 'error')
+
+
+class LinkResult:
+    """Outcome of generating payment links"""
+
+    def __init__(self):
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+
+    @property
+    def done(self) -> int:
+        return self.succeeded + self.failed + self.skipped
+
+    def __str__(self):
+        return "{} links, {} failed, {} skipped".format(self.succeeded, self.failed, self.skipped)
+
+
+def generate_payment_links(orders: Union[QuerySet, Iterable[int]], write: Callable[[dict], None],
+                           acquirer: Optional[str] = None, workers: int = 8, chunk_size: int = 200,
+                           done: Optional[Set[int]] = None,
+                           progress: Optional[Callable[[LinkResult], None]] = None) -> LinkResult:
+    """Get the payment links of orders. Pass a row per order to write(), a dict with the ROW_FIELDS.
+
+    # Args:
+    orders : QuerySet | Iterable[int] = Orders, or order IDs. IDs are read lazily, e.g. from a file
+    write : callable = Called with the row of each order, in the order of the orders
+    acquirer : str | None = Acquirer of the links, as in get_quickpay_link()
+    workers : int = Max. concurrent orders
+    chunk_size : int = Orders read at a time
+    done : Set[int] | None = IDs of orders to skip. Orders getting a link are added
+    progress : callable | None = Called with the result so far after each chunk
+    """
+    done = set() if done is None else done
+    result = LinkResult()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for order_ids, orders_by_id in _order_chunks(orders, chunk_size):
+                todo = [pk for pk in dict.fromkeys(order_ids) if pk not in done]
+                result.skipped += len(order_ids) - len(todo)
+                rows = executor.map(lambda pk: _link_row(pk, orders_by_id.get(pk), acquirer), todo)
+                for row in rows:
+                    if row['error']:
+                        result.failed += 1
+                    else:
+                        result.succeeded += 1
+                        done.add(row['order_id'])
+                    write(row)
+                logging.info("cartridge_quickpay.links: %s", result)
+                if progress is not None:
+                    progress(result)
+        finally:
+            close_worker_connections(executor, workers)
+    return result
+
+
+def _order_chunks(orders: Union[QuerySet, Iterable[int]], chunk_size: int) -> Iterator[tuple]:
+    """Iterate over (order IDs, {order ID: Order}) in chunks"""
+    if isinstance(orders, QuerySet):
+        for chunk in payment_chunks(orders, chunk_size):
+            yield [order.pk for order in chunk], {order.pk: order for order in chunk}
+        return
+    order_ids = iter(orders)
+    while True:
+        chunk = list(islice(order_ids, chunk_size))  # type: List[int]
+        if not chunk:
+            return
+        yield chunk, Order.objects.in_bulk(chunk)
+
+
+def _link_row(order_id: int, order: Optional[Order], acquirer: Optional[str]) -> dict:
+    """Get the payment link of an order. Return its row"""
+    row = dict.fromkeys(ROW_FIELDS, '')
+    row['order_id'] = order_id
+    if order is None:
+        row['error'] = "Unknown order"
+        return row
+    try:
+        with priority(BATCH):
+            res = get_quickpay_link(order, acquirer)
+        row['payment_id'], row['url'] = res['id'], res['url']
+    except ApiError as e:
+        logging.error("QuickPay API error: %s" % e.body)
+        row['error'] = str(e.body)
+    except Exception as e:  # Network errors etc. must not stop the run
+        logging.exception("cartridge_quickpay.links: payment link of order %s failed", order_id)
+        row['error'] = str(e) or type(e).__name__
+    return row
@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, \
+    teardown_test_environment
+from cartridge_quickpay.benchmark import SCENARIOS, ScenarioResult, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Benchmark checkout, callbacks, success and bulk operations against a local Quickpay stand-in. ' \
+           'Runs in a test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', nargs='*', help='Scenarios to run: {}. Default all'.format(', '.join(SCENARIOS)))
+        parser.add_argument('--requests', type=int, default=100, help='Calls per scenario')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent calls')
+        parser.add_argument('--latency', type=float, default=20, help='Milliseconds per Quickpay call')
+        parser.add_argument('--hold', type=float, default=100,
+                            help='Milliseconds the Order lock is held in the success scenario')
+        parser.add_argument('--chunk-size', type=int, default=100, help='Chunk size of the bulk_capture scenario')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the test database between runs')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON lines')
+
+    def handle(self, *args, **options):
+        unknown = set(options['scenario']) - set(SCENARIOS)
+        if unknown:
+            raise CommandError("Unknown scenario(s): {}".format(', '.join(sorted(unknown))))
+
+        def report(result: ScenarioResult):
+            self.stdout.write(json.dumps(result.as_dict()) if options['json'] else str(result))
+
+        setup_test_environment()  # Among others, mails are kept in memory
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+        try:
+            if not options['json']:
+                self.stdout.write(ScenarioResult.HEADER)
+            run_benchmarks(options['scenario'] or SCENARIOS, requests=options['requests'],
+                           concurrency=max(options['concurrency'], 1), latency=options['latency'] / 1000,
+                           hold=options['hold'] / 1000, chunk_size=options['chunk_size'], report=report)
+        finally:
+            teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
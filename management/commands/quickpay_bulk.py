@@ -0,0 +1,44 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from cartridge_quickpay.bulk import OPERATIONS, eligible_payments, run_bulk_operation
+
+
+class Command(BaseCommand):
+    help = 'Capture, refund or cancel Quickpay payments in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('operation', choices=OPERATIONS)
+        parser.add_argument('payments', nargs='*', type=int,
+                            help='IDs of QuickpayPayments. Default all payments eligible for the operation')
+        parser.add_argument('--order', nargs='*', type=int, default=[], help='Limit to payments of these orders')
+        parser.add_argument('--amount', type=Decimal, default=None,
+                            help='Amount per payment. Default the full amount')
+        parser.add_argument('--workers', type=int, default=8, help='Max. concurrent Quickpay calls')
+        parser.add_argument('--rate', type=float, default=None, help='Max. Quickpay calls per second')
+        parser.add_argument('--checkpoint', default=None,
+                            help='File recording succeeded payments. Rerun with the same file to resume')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the payments')
+
+    def handle(self, *args, **options):
+        payments = eligible_payments(options['operation'])
+        if options['payments']:
+            payments = payments.filter(pk__in=options['payments'])
+        if options['order']:
+            payments = payments.filter(order_id__in=options['order'])
+        if options['dry_run']:
+            self.stdout.write("{} payments eligible for {}".format(payments.count(), options['operation']))
+            return
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1")
+
+        def progress(result):
+            if options['verbosity'] > 1:
+                self.stdout.write(str(result))
+
+        result = run_bulk_operation(payments, options['operation'], amount=options['amount'],
+                                    workers=options['workers'], rate=options['rate'],
+                                    checkpoint=options['checkpoint'], progress=progress)
+        for payment_id, error in sorted(result.errors.items()):
+            self.stderr.write("Payment {}: {}".format(payment_id, error))
+        self.stdout.write(str(result))
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+from cartridge_quickpay.inbox import process_inbox
+
+
+class Command(BaseCommand):
+    help = 'Process Quickpay callbacks stored in the inbox (QUICKPAY_CALLBACK_INBOX = True)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help='Callbacks claimed at a time')
+        parser.add_argument('--sleep', type=float, default=1.0, help='Seconds to wait when the inbox is empty')
+        parser.add_argument('--once', action='store_true', help='Exit when the inbox is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            count = process_inbox(options['batch_size'])
+            if options['verbosity'] > 1 and count:
+                self.stdout.write("Processed {} callbacks".format(count))
+            if count < options['batch_size']:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
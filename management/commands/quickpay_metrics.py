@@ -0,0 +1,17 @@
+import json
+
+from django.core.management.base import BaseCommand
+from cartridge_quickpay import metrics
+
+
+class Command(BaseCommand):
+    help = 'Show Quickpay metrics in Prometheus text format. Includes other processes if QUICKPAY_METRICS_DIR is set'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help='Show the raw metrics as JSON')
+
+    def handle(self, *args, **options):
+        if options['json']:
+            self.stdout.write(json.dumps(metrics.merged_snapshot(), indent=2, sort_keys=True))
+        else:
+            self.stdout.write(metrics.render(), ending='')
@@ -1,15 +1,153 @@
-from django.core.management.base import BaseCommand
+import csv
+import io
+import json
+import os
+import sys
+from itertools import chain
+from typing import Iterator, Set
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware
 from cartridge.shop.models import Order
-from cartridge_quickpay.payment import get_quickpay_link
+from cartridge_quickpay.links import ROW_FIELDS, generate_payment_links
 
 
 class Command(BaseCommand):
-    help = 'Get order links for given orders'
+    help = ('Get payment links of orders given by ID (arguments, or one per line with --file) or by filters. '
+            'Writes a JSON line or CSV row per order with order_id, payment_id, url and error')
 
     def add_arguments(self, parser):
-        parser.add_argument('orders', nargs='*', type=str)
+        parser.add_argument('orders', nargs='*', type=int, help='IDs of orders')
+        parser.add_argument('--file', default=None, help="File with an order ID per line, '-' for stdin")
+        parser.add_argument('--status', nargs='*', type=int, default=[], help='Orders with these statuses')
+        parser.add_argument('--since', default=None, help='Orders made from this ISO time')
+        parser.add_argument('--until', default=None, help='Orders made before this ISO time')
+        parser.add_argument('--unpaid', action='store_true', help='Orders without a transaction ID')
+        parser.add_argument('--acquirer', default=None, help='Acquirer of the payment links')
+        parser.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl', help='Output format')
+        parser.add_argument('--output', default=None, help='Output file, default stdout')
+        parser.add_argument('--resume', action='store_true',
+                            help='Skip orders that got a link in --output and append to it')
+        parser.add_argument('--workers', type=int, default=8, help='Max. concurrent orders')
+        parser.add_argument('--chunk-size', type=int, default=200, help='Orders read at a time')
 
     def handle(self, *args, **options):
-        for order_no in options['orders']:
-            order: Order = Order.objects.get(pk=order_no)
-            print("Quickpay link:", get_quickpay_link(order))
+        if options['workers'] < 1:
+            raise CommandError("--workers must be at least 1")
+        if options['resume'] and not options['output']:
+            raise CommandError("--resume needs --output")
+        orders = self._orders(options)
+        done = set()  # type: Set[int]
+        if options['resume'] and os.path.exists(options['output']):
+            _drop_cut_off_line(options['output'])
+            done = _read_done(options['output'], options['format'])
+
+        out = (open(options['output'], 'a' if options['resume'] else 'w', newline='', encoding='utf-8')
+               if options['output'] else self.stdout)
+        try:
+            write = _row_writer(out, options['format'], header=not (options['output'] and out.tell() > 0))
+
+            def progress(result):
+                if options['verbosity'] > 1:
+                    self.stderr.write(str(result))
+                if out is not self.stdout:
+                    out.flush()
+
+            result = generate_payment_links(orders, write, acquirer=options['acquirer'],
+                                            workers=options['workers'], chunk_size=options['chunk_size'],
+                                            done=done, progress=progress)
+        finally:
+            if out is not self.stdout:
+                out.close()
+        self.stderr.write(str(result))
+
+    def _orders(self, options):
+        """Order IDs from the arguments or file, or a queryset from the filters"""
+        filtered = options['status'] or options['since'] or options['until'] or options['unpaid']
+        if options['orders'] or options['file']:
+            if filtered:
+                raise CommandError("Give order IDs or filters, not both")
+            ids = iter(options['orders'])
+            if options['file']:
+                ids = chain(ids, _read_ids(options['file']))
+            return ids
+        if not filtered:
+            raise CommandError("Give order IDs, --file or filters")
+        orders = Order.objects.all()
+        if options['status']:
+            orders = orders.filter(status__in=options['status'])
+        if options['since']:
+            orders = orders.filter(time__gte=_parse_time(options['since'], '--since'))
+        if options['until']:
+            orders = orders.filter(time__lt=_parse_time(options['until'], '--until'))
+        if options['unpaid']:
+            orders = orders.filter(Q(transaction_id__isnull=True) | Q(transaction_id=''))
+        return orders
+
+
+def _parse_time(value: str, option: str):
+    time = parse_datetime(value) or parse_datetime(value + 'T00:00')
+    if time is None:
+        raise CommandError("Invalid {} time '{}'".format(option, value))
+    return make_aware(time) if settings.USE_TZ and is_naive(time) else time
+
+
+def _read_ids(path: str) -> Iterator[int]:
+    """Order IDs of a file, one per line. Read lazily"""
+    f = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                yield int(line)
+            except ValueError:
+                raise CommandError("{}:{}: not an order ID: '{}'".format(path, number, line))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _read_done(path: str, output_format: str) -> Set[int]:
+    """IDs of the orders that got a link in an earlier output file"""
+    done = set()
+    with open(path, newline='', encoding='utf-8') as f:
+        if output_format == 'csv':
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            if row.get('url') and not row.get('error'):
+                done.add(int(row['order_id']))
+    return done
+
+
+def _drop_cut_off_line(path: str):
+    """Remove a last line cut off by an interrupted run from an output file"""
+    with open(path, 'rb+') as f:
+        size = f.seek(0, io.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(end - 4096, 0)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+
+
+def _row_writer(out, output_format: str, header: bool):
+    """Function writing a row to out in the format"""
+    if output_format == 'jsonl':
+        return lambda row: out.write(json.dumps(row) + '\n')
+    writer = csv.DictWriter(out, ROW_FIELDS, lineterminator='\n')
+    if header:
+        writer.writeheader()
+    return writer.writerow
@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from cartridge_quickpay.purge import abandoned_payments, purge_abandoned_payments
+
+
+class Command(BaseCommand):
+    help = 'Delete payments never accepted, and their links and unpaid subscriptions in Quickpay'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=30, help='Purge payments created more than this ago')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Payments deleted per transaction')
+        parser.add_argument('--workers', type=int, default=8, help='Max. concurrent Quickpay calls')
+        parser.add_argument('--rate', type=float, default=None, help='Max. Quickpay calls per second')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the payments')
+
+    def handle(self, *args, **options):
+        older_than = timedelta(days=options['days'])
+        if options['dry_run']:
+            self.stdout.write("{} abandoned payments".format(abandoned_payments(older_than).count()))
+            return
+        if options['workers'] < 1 or options['chunk_size'] < 1:
+            raise CommandError("--workers and --chunk-size must be at least 1")
+
+        def progress(result):
+            if options['verbosity'] > 1:
+                self.stdout.write(str(result))
+
+        result = purge_abandoned_payments(older_than, chunk_size=options['chunk_size'], workers=options['workers'],
+                                          rate=options['rate'], progress=progress)
+        self.stdout.write(str(result))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from cartridge_quickpay.settlement import rebuild_settlements
+
+
+class Command(BaseCommand):
+    help = 'Recompute the settlement summaries from the payments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', default=None, help='Only rebuild the days from this ISO date on')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Payments read at a time')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_date(options['since'])
+            if since is None:
+                raise CommandError("Invalid --since date '{}'".format(options['since']))
+        rows = rebuild_settlements(since=since, chunk_size=options['chunk_size'])
+        self.stdout.write("{} settlement rows".format(rows))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from cartridge_quickpay.renewal import renewal_candidates, run_renewals
+
+
+class Command(BaseCommand):
+    help = 'Renew due subscriptions and start their recurring Quickpay payments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=float, default=0,
+                            help='Seconds to spread the renewals over. Default start them as fast as possible')
+        parser.add_argument('--concurrency', type=int, default=8, help='Max. renewals in progress at a time')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the subscriptions to consider, due or not')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            self.stdout.write("{} subscriptions to consider".format(renewal_candidates().count()))
+            return
+        report = run_renewals(window=options['window'], concurrency=max(options['concurrency'], 1))
+        for subscription_id, error in sorted(report.errors.items()):
+            self.stderr.write("Subscription {}: {}".format(subscription_id, error))
+        self.stdout.write(str(report))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware
+from cartridge_quickpay.sync import sync_payments
+
+
+class Command(BaseCommand):
+    help = 'Synchronize payments changed in Quickpay since the last run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', default=None, help='Synchronize payments changed since this ISO time')
+        parser.add_argument('--full', action='store_true', help='Synchronize all payments')
+        parser.add_argument('--currency', default=None, help='Currency of the agreement to synchronize')
+        parser.add_argument('--page-size', type=int, default=100, help='Payments per request, max. 100')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError("Invalid --since time '{}'".format(options['since']))
+            if is_naive(since):
+                since = make_aware(since)
+        result = sync_payments(since=since, full=options['full'], currency=options['currency'],
+                               page_size=options['page_size'])
+        self.stdout.write(str(result))
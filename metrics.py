@@ -0,0 +1,305 @@
+"""Metrics for Quickpay API calls, callbacks, lock waits and the order handler
+
+Metrics are collected in memory per process. They are shown in Prometheus' text format by the
+quickpay_metrics view (url name 'quickpay_metrics') and by the quickpay_metrics management command.
+
+To see the metrics of all processes of the shop (several WSGI workers, callback workers, commands), set
+QUICKPAY_METRICS_DIR to a directory writable by all of them. Each process then writes its metrics to a file
+there at most every QUICKPAY_METRICS_FLUSH_INTERVAL seconds, and the view and the command add up the files.
+The files of processes that have exited are added to a file of retired metrics and removed, so counters don't
+go backwards and the directory doesn't grow. The directory must only be shared by processes of one host (one
+PID namespace), as whether a process has exited is told by its PID.
+
+SETTINGS:
+    QUICKPAY_METRICS_DIR            = Directory for sharing metrics between processes, default None
+    QUICKPAY_METRICS_FLUSH_INTERVAL = Seconds between writes to QUICKPAY_METRICS_DIR, default 5
+    QUICKPAY_METRICS_TOKEN          = Token for access to the metrics view (?token=... or "Authorization: Bearer
+                                      ..."). Without it, the view is for staff users only.
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+
+__author__ = 'jfk@metation.dk'
+
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_metrics = []  # type: List[_Metric]
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}  # type: Dict[Tuple[str, ...], object]
+        _metrics.append(self)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        _maybe_flush()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=_DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with _lock:
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data['buckets'][i] += 1
+            data['sum'] += value
+            data['count'] += 1
+        _maybe_flush()
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+
+api_calls = Histogram('quickpay_api_request_seconds', 'Duration of Quickpay API calls',
+                      ('method', 'endpoint', 'status'))
+callbacks = Counter('quickpay_callbacks_total', 'Quickpay callbacks by outcome', ('outcome',))
+lock_wait = Histogram('quickpay_lock_wait_seconds', 'Time spent waiting for order row locks and single-flight locks', ('site',))
+order_handler_seconds = Histogram('quickpay_order_handler_seconds', 'Duration of order_handler()')
+side_effects = Counter('quickpay_side_effects_total', 'Deferred side effects by outcome', ('effect', 'outcome'))
+api_retries = Counter('quickpay_api_retries_total', 'Retried Quickpay API calls', ('endpoint',))
+circuit_breaker = Counter('quickpay_circuit_breaker_total',
+                          'Circuit breaker openings, closings, rejected calls and missed deadlines', ('event',))
+rate_limit_wait = Histogram('quickpay_rate_limit_wait_seconds', 'Time Quickpay calls waited for the shared rate limit',
+                            ('lane',))
+
+
+_ID_RE = re.compile(r'/\d+')
+
+
+def endpoint(path: str) -> str:
+    """API endpoint of path for use as a label, e.g. /payments/:id/capture"""
+    return _ID_RE.sub('/:id', path.split('?', 1)[0])
+
+
+# -- Snapshots and sharing between processes
+
+def snapshot() -> dict:
+    """Metrics of this process, JSON serializable"""
+    with _lock:
+        return {m.name: {'kind': m.kind, 'help': m.help, 'labels': list(m.labels),
+                         'buckets': list(getattr(m, 'buckets', ())),
+                         'values': [[list(k), v if m.kind == 'counter' else dict(v, buckets=list(v['buckets']))]
+                                    for k, v in m.values.items()]}
+                for m in _metrics}
+
+
+def merged_snapshot() -> dict:
+    """Metrics of all processes sharing QUICKPAY_METRICS_DIR, or of this process if not set"""
+    directory = getattr(settings, 'QUICKPAY_METRICS_DIR', None)
+    if not directory:
+        return snapshot()
+    flush()
+    with _directory_lock(directory) as locked:
+        return _merge_directory(directory, retire=locked)
+
+
+# Metrics of exited processes: {'metrics': snapshot, 'files': names of the files added but maybe not removed}
+_RETIRED_FILE = 'retired.metrics'
+
+
+def _merge_directory(directory: str, retire: bool) -> dict:
+    """Add up the files in directory. With retire, move the files of exited processes to the retired metrics"""
+    retired_path = os.path.join(directory, _RETIRED_FILE)
+    retired = _read_json(retired_path) or {'metrics': {}, 'files': []}
+    merged = {}
+    _merge(merged, retired['metrics'])
+    exited = []  # type: List[str]
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.json'):
+            continue
+        if filename in retired['files']:
+            _remove(os.path.join(directory, filename))  # Added to the retired metrics already
+            continue
+        snap = _read_json(os.path.join(directory, filename))
+        if snap is None:
+            continue
+        _merge(merged, snap)
+        if retire and not _process_alive(filename):
+            _merge(retired['metrics'], snap)
+            exited.append(filename)
+    if exited:
+        # Recorded before the files are removed, so a file that can't be removed isn't added again
+        files = [f for f in retired['files'] if os.path.exists(os.path.join(directory, f))] + exited
+        _write_json(retired_path, {'metrics': retired['metrics'], 'files': files})
+        for filename in exited:
+            _remove(os.path.join(directory, filename))
+    return merged
+
+
+@contextmanager
+def _directory_lock(directory: str):
+    """Lock the metrics directory against other processes. Yields whether it is locked, i.e. flock is available"""
+    try:
+        import fcntl
+    except ImportError:  # Not POSIX
+        yield False
+        return
+    fd = os.open(os.path.join(directory, '.lock'), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield True
+    finally:
+        os.close(fd)  # Releases the lock
+
+
+def _process_alive(filename: str) -> bool:
+    """Whether the process that wrote the metrics file is running"""
+    try:
+        pid = int(filename.split('.', 1)[0].split('-', 1)[0])
+    except ValueError:
+        return True  # Not written by flush()
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:  # PermissionError: a process of another user
+        pass
+    return True
+
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None  # Missing, being replaced or removed
+
+
+def _write_json(path: str, data: dict):
+    """Write data to path atomically"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _merge(merged: dict, snap: dict):
+    for name, metric in snap.items():
+        target = merged.setdefault(name, dict(metric, values=[]))
+        values = {tuple(k): v for k, v in target['values']}
+        for key, value in metric['values']:
+            key = tuple(key)
+            if metric['kind'] == 'counter':
+                values[key] = values.get(key, 0) + value
+            elif key in values:
+                old = values[key]
+                values[key] = {'buckets': [a + b for a, b in zip(old['buckets'], value['buckets'])],
+                               'sum': old['sum'] + value['sum'], 'count': old['count'] + value['count']}
+            else:
+                values[key] = value
+        target['values'] = [[list(k), v] for k, v in values.items()]
+
+
+_last_flush = 0.0
+
+
+def _maybe_flush():
+    if getattr(settings, 'QUICKPAY_METRICS_DIR', None) and \
+            time.monotonic() - _last_flush >= getattr(settings, 'QUICKPAY_METRICS_FLUSH_INTERVAL', 5):
+        flush()
+
+
+def flush():
+    """Write the metrics of this process to QUICKPAY_METRICS_DIR"""
+    global _last_flush
+    directory = getattr(settings, 'QUICKPAY_METRICS_DIR', None)
+    if not directory:
+        return
+    _last_flush = time.monotonic()
+    os.makedirs(directory, exist_ok=True)
+    _write_json(os.path.join(directory, _file_name()), snapshot())
+
+
+_file = (0, '')  # (PID, name of the metrics file of the process)
+
+
+def _file_name() -> str:
+    """Name of the metrics file of this process. Unique to the process, so a process reusing the PID of an exited
+    one doesn't overwrite the exited one's metrics before they are retired"""
+    global _file
+    pid = os.getpid()
+    if _file[0] != pid:
+        _file = (pid, '{}-{}.json'.format(pid, uuid.uuid4().hex[:12]))
+    return _file[1]
+
+
+# -- Prometheus text format
+
+def render(snap: Optional[dict] = None) -> str:
+    """Metrics in Prometheus' text exposition format"""
+    snap = merged_snapshot() if snap is None else snap
+    lines = []
+    for name, metric in sorted(snap.items()):
+        lines.append('# HELP {} {}'.format(name, metric['help']))
+        lines.append('# TYPE {} {}'.format(name, metric['kind']))
+        for key, value in sorted(metric['values'], key=lambda kv: kv[0]):
+            labels = list(zip(metric['labels'], key))
+            if metric['kind'] == 'counter':
+                lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+                continue
+            # Observations are counted in every bucket they fit in, so the counts are cumulative as required
+            for bound, count in zip(metric['buckets'], value['buckets']):
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + [('le', _number(bound))]), count))
+            lines.append('{}_bucket{} {}'.format(name, _labels(labels + [('le', '+Inf')]), value['count']))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(value['sum'])))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 19:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('shop', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuickpayPayment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('requested_amount', models.IntegerField(editable=False, help_text='Requested amount in minor unit, e.g. cent. NB: for subscriptions this is the period amount with tax. The captured amount may be smaller if the previous period was (partly) refunded.')),
+                ('requested_currency', models.CharField(editable=False, max_length=3)),
+                ('card_last4', models.CharField(editable=False, help_text='Last 4 digits of card number', max_length=4)),
+                ('qp_id', models.IntegerField(db_index=True, editable=False, help_text='ID of Payment in Quickpay', null=True)),
+                ('accepted', models.BooleanField(default=False, editable=False)),
+                ('test_mode', models.BooleanField(default=True, editable=False)),
+                ('type', models.CharField(editable=False, max_length=31, null=True)),
+                ('text_on_statement', models.TextField(editable=False, null=True)),
+                ('acquirer', models.CharField(editable=False, max_length=31, null=True)),
+                ('state', models.CharField(editable=False, max_length=31, null=True)),
+                ('balance', models.IntegerField(editable=False, help_text='Captured amount in minor unit, e.g. cent', null=True)),
+                ('last_qp_status', models.CharField(editable=False, help_text='Last status code from Quickpay', max_length=31, null=True)),
+                ('last_qp_status_msg', models.CharField(editable=False, help_text='Last status message from Quickpay', max_length=255, null=True)),
+                ('last_aq_status', models.CharField(editable=False, help_text='Last status code from acquirer', max_length=31, null=True)),
+                ('last_aq_status_msg', models.CharField(editable=False, help_text='Last status message from acquirer', max_length=255, null=True)),
+                ('accepted_date', models.DateTimeField(editable=False, null=True)),
+                ('captured_date', models.DateTimeField(editable=False, null=True)),
+                ('order', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, to='shop.Order')),
+            ],
+            options={
+                'ordering': ['order'],
+            },
+        ),
+    ]
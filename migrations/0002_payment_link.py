@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 19:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cartridge_quickpay', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='quickpaypayment',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='quickpaypayment',
+            name='link_acquirer',
+            field=models.CharField(editable=False, help_text='Acquirer requested for the payment link, blank for any', max_length=31, null=True),
+        ),
+        migrations.AddField(
+            model_name='quickpaypayment',
+            name='link_url',
+            field=models.CharField(editable=False, help_text='URL of the payment link in Quickpay', max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 19:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cartridge_quickpay', '0002_payment_link'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuickpayCallback',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('qp_id', models.IntegerField(editable=False, help_text='ID of Payment or Subscription in Quickpay')),
+                ('operation', models.CharField(editable=False, help_text='Quickpay state and ID of the last operation. Identifies the callback for the resource', max_length=63)),
+                ('body', models.TextField(editable=False, help_text='Callback body as received')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('dead', 'Dead')], default='pending', editable=False, max_length=15)),
+                ('attempts', models.IntegerField(default=0, editable=False)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, editable=False, help_text="When to process the callback next. When processing, the end of the worker's lease")),
+                ('last_error', models.TextField(editable=False, null=True)),
+                ('received', models.DateTimeField(auto_now_add=True)),
+                ('processed', models.DateTimeField(editable=False, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='quickpaycallback',
+            index=models.Index(fields=['status', 'next_attempt'], name='cartridge_q_status_bd074a_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='quickpaycallback',
+            unique_together=set([('qp_id', 'operation')]),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 19:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cartridge_quickpay', '0003_quickpaycallback'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuickpaySyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(editable=False, max_length=63, unique=True)),
+                ('watermark', models.DateTimeField(editable=False, help_text='Resources changed in Quickpay before this time have been synchronized', null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 19:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0001_initial'),
+        ('cartridge_quickpay', '0004_quickpaysyncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuickpayOrderPayment',
+            fields=[
+                ('order', models.OneToOneField(editable=False, on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='shop.Order')),
+                ('paid', models.BooleanField(default=False, editable=False)),
+            ],
+        ),
+        migrations.AlterModelOptions(
+            name='quickpaypayment',
+            options={},
+        ),
+        migrations.AddIndex(
+            model_name='quickpaypayment',
+            index=models.Index(fields=['order', 'accepted'], name='cartridge_q_order_i_46daec_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='quickpaypayment',
+            index=models.Index(fields=['order', '-id'], name='cartridge_q_order_i_aca3b3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='quickpaypayment',
+            index=models.Index(fields=['state'], name='cartridge_q_state_386cc7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='quickpaypayment',
+            index=models.Index(fields=['accepted_date'], name='cartridge_q_accepte_b6e46b_idx'),
+        ),
+        migrations.AddField(
+            model_name='quickpayorderpayment',
+            name='latest',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='cartridge_quickpay.QuickpayPayment'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 19:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cartridge_quickpay', '0005_quickpayorderpayment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='quickpaypayment',
+            name='last_operation_seq',
+            field=models.IntegerField(editable=False, help_text='Sequence number of the last Quickpay state applied, see operation_sequence()', null=True),
+        ),
+    ]
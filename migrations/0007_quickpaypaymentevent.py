@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 19:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cartridge_quickpay', '0006_quickpaypayment_last_operation_seq'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuickpayPaymentEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_id', models.IntegerField(editable=False, help_text='ID of the Order. Not a foreign key, so the history outlives the order')),
+                ('qp_id', models.IntegerField(editable=False, help_text='ID of Payment in Quickpay')),
+                ('operation_seq', models.IntegerField(editable=False, help_text='Sequence number of the state, see operation_sequence()')),
+                ('source', models.CharField(choices=[('callback', 'Callback'), ('operation', 'Operation'), ('sync', 'Sync')], editable=False, max_length=15)),
+                ('operation', models.CharField(editable=False, help_text='Type of the last operation, e.g. authorize or capture', max_length=31, null=True)),
+                ('amount', models.IntegerField(editable=False, help_text='Amount of the last operation in minor unit, e.g. cent', null=True)),
+                ('state', models.CharField(editable=False, max_length=31, null=True)),
+                ('qp_status', models.CharField(editable=False, max_length=31, null=True)),
+                ('aq_status', models.CharField(editable=False, max_length=31, null=True)),
+                ('timestamp', models.DateTimeField(editable=False, help_text='Time of the last operation in Quickpay, or when received')),
+                ('raw_json', models.BinaryField(help_text='Quickpay response, zlib compressed JSON')),
+                ('payment', models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='events', to='cartridge_quickpay.QuickpayPayment')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='quickpaypaymentevent',
+            index=models.Index(fields=['order_id', 'timestamp'], name='cartridge_q_order_i_058f89_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='quickpaypaymentevent',
+            unique_together=set([('qp_id', 'operation_seq')]),
+        ),
+    ]
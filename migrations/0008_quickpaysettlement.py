@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 19:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cartridge_quickpay', '0007_quickpaypaymentevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuickpaySettlement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(editable=False, help_text='Day the payments were accepted')),
+                ('currency', models.CharField(editable=False, max_length=3)),
+                ('acquirer', models.CharField(default='', editable=False, max_length=31)),
+                ('state', models.CharField(editable=False, max_length=31)),
+                ('count', models.IntegerField(default=0, editable=False)),
+                ('requested_amount', models.BigIntegerField(default=0, editable=False, help_text='Sum of requested amounts in minor unit, e.g. cent')),
+                ('balance', models.BigIntegerField(default=0, editable=False, help_text='Sum of captured amounts in minor unit, e.g. cent')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='quickpaysettlement',
+            unique_together=set([('date', 'currency', 'acquirer', 'state')]),
+        ),
+    ]
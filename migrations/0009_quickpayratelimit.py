@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 19:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cartridge_quickpay', '0008_quickpaysettlement'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuickpayRateLimit',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(editable=False, max_length=63, unique=True)),
+                ('tokens', models.FloatField(editable=False)),
+                ('updated', models.FloatField(editable=False, help_text='Unix time of the last update')),
+            ],
+        ),
+    ]
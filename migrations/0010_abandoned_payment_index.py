@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 19:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cartridge_quickpay', '0009_quickpayratelimit'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='quickpaypayment',
+            index=models.Index(fields=['accepted', 'created'], name='cartridge_q_accepte_68c50f_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-16 19:22
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cartridge_quickpay', '0010_abandoned_payment_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='quickpaypayment',
+            name='last_callback_seq',
+            field=models.IntegerField(editable=False, help_text='Sequence number of the last callback processed, see operation_sequence()', null=True),
+        ),
+    ]
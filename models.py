@@ -1,54 +1,61 @@
 """
 QuickPay payments
 """
+import json
 import logging
+import threading
+import zlib
+from contextlib import contextmanager
 from decimal import Decimal
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.core.exceptions import ImproperlyConfigured
 from django.dispatch import receiver
-from django.db.models.signals import post_delete
-from django.utils.timezone import now
+from django.db.models.signals import post_delete, pre_delete
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_aware, localtime, now
 from django.conf import settings
 from cartridge.shop.models import Order, OrderItem, Product
 from cartridge.shop.checkout import CheckoutError
 from cartridge.shop import fields
-from quickpay_api_client import QPClient
 from quickpay_api_client.exceptions import ApiError
+from .agreements import get_agreement
+from .client import QuickpayClient
+from .currency import to_minor_units
 
-from datetime import datetime
+from datetime import date, datetime, timedelta
 try:
-    from typing import Optional
+    from typing import Dict, List, Optional, Tuple
 except ImportError:
-    Optional = None
+    Dict = List = Optional = Tuple = None
 
 
 __author__ = 'jfk@metation.dk'
 
 
-def quickpay_client(currency: Optional[str] = None) -> QPClient:
-    """Get QuickPay client proxy object"""
-    secret = ":{0}".format(get_api_key(currency))
-    return QPClient(secret)
+def quickpay_client(currency: Optional[str] = None) -> QuickpayClient:
+    """Get QuickPay client proxy object for the agreement of the currency. The client is shared by all callers
+    of the same agreement and keeps its connections to Quickpay alive"""
+    return get_agreement(currency).client()
 
 
 def get_api_key(currency: Optional[str] = None) -> str:
     """Get API key for the agreement for the given currency"""
-    try:
-        return settings.QUICKPAY_API_KEY
-    except AttributeError:
+    api_key = get_agreement(currency).api_key
+    if not api_key:
         raise ImproperlyConfigured("QUICKPAY_API_KEY missing or empty in settings")
+    return api_key
 
 
 def get_private_key(currency: Optional[str] = None) -> str:
     """Get private key for the agreement for the given currency"""
-    try:
-        return settings.QUICKPAY_PRIVATE_KEY
-    except AttributeError:
+    private_key = get_agreement(currency).private_key
+    if not private_key:
         raise ImproperlyConfigured("QUICKPAY_PRIVATE_KEY missing or empty in settings")
+    return private_key
     
 
 class QuickpayPayment(models.Model):
-    order = models.ForeignKey(Order, editable=False)
+    order = models.ForeignKey(Order, editable=False, on_delete=models.CASCADE)
     # When an order is deleted, associated payments are deleted. If possible, they are cancelled in Quickpay
     # by post_delete handler
     
@@ -84,8 +91,29 @@ class QuickpayPayment(models.Model):
     captured_date = models.DateTimeField(null=True, editable=False)        # type: datetime
     # Only known if the payment has been captured through cartridge_quickpay. Unknown if autocaptured
 
+    created = models.DateTimeField(null=True, auto_now_add=True)           # type: datetime
+    link_url = models.CharField(null=True, max_length=255, editable=False,
+        help_text="URL of the payment link in Quickpay")                  # type: str
+    link_acquirer = models.CharField(null=True, max_length=31, editable=False,
+        help_text="Acquirer requested for the payment link, blank for any")  # type: str
+    last_operation_seq = models.IntegerField(null=True, editable=False,
+        help_text="Sequence number of the last Quickpay state applied, see operation_sequence()")  # type: int
+    last_callback_seq = models.IntegerField(null=True, editable=False,
+        help_text="Sequence number of the last callback processed, see operation_sequence()")  # type: int
+
+    # Fields set from Quickpay by update_from_res()
+    QUICKPAY_FIELDS = ['qp_id', 'accepted', 'test_mode', 'type', 'text_on_statement', 'acquirer', 'state', 'balance',
+                       'card_last4', 'last_qp_status', 'last_qp_status_msg', 'last_aq_status', 'last_aq_status_msg',
+                       'accepted_date', 'captured_date', 'last_operation_seq']
+
     class Meta:
-        ordering = ['order']
+        indexes = [
+            models.Index(fields=['order', 'accepted']),
+            models.Index(fields=['order', '-id']),
+            models.Index(fields=['state']),
+            models.Index(fields=['accepted_date']),
+            models.Index(fields=['accepted', 'created']),  # Abandoned payments, see purge.py
+        ]
 
     @classmethod
     def create_card_payment(cls, order: Order, amount: Decimal, currency: str, card_last4: str) -> 'QuickpayPayment':
@@ -99,23 +127,134 @@ class QuickpayPayment(models.Model):
         """
         assert isinstance(order, Order)
         assert isinstance(amount, Decimal)
-        succeeded_payment = cls.objects.filter(order=order, accepted=True)
-        if succeeded_payment:
-            raise CheckoutError("Order already paid!")
-        int_amount = int(amount * 100)
-        res = cls.objects.create(order=order, requested_amount=int_amount,
-                                 requested_currency=currency, card_last4=card_last4, state='new')
+        with transaction.atomic():
+            if cls.is_order_paid(order):
+                raise CheckoutError("Order already paid!")
+            int_amount = to_minor_units(amount, currency)
+            res = cls.objects.create(order=order, requested_amount=int_amount,
+                                     requested_currency=currency, card_last4=card_last4, state='new')
+            QuickpayOrderPayment.set_latest(res)
         return res
 
+    @classmethod
+    def is_order_paid(cls, order: Order) -> bool:
+        """Whether the order has an accepted payment"""
+        paid = QuickpayOrderPayment.objects.filter(order_id=order.pk).values_list('paid', flat=True).first()
+        if paid is None:
+            # Order paid before QuickpayOrderPayment was introduced
+            return cls.objects.filter(order=order, accepted=True).exists()
+        return paid
+
+    @classmethod
+    def lock_saved(cls, payment_ids: List[int]) -> 'Dict[int, QuickpayPayment]':
+        """Lock the rows of the payments and read the fields settlement_entry() depends on and last_operation_seq,
+        by payment ID. Call in the transaction saving or deleting them, so what is read is the rows being
+        overwritten even when callbacks, operations and synchronizations save the same payments concurrently"""
+        return (cls.objects.select_for_update().only(*SETTLEMENT_FIELDS, 'last_operation_seq').order_by('pk')
+                .in_bulk(list(payment_ids)))
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        payment = super().from_db(db, field_names, values)
+        payment._saved_accepted = payment.__dict__.get('accepted')
+        payment._saved_settlement = {f: payment.__dict__[f] for f in SETTLEMENT_FIELDS if f in payment.__dict__}
+        return payment
+
+    # Whether the payment was accepted as loaded or last saved. None if unknown
+    _saved_accepted = None
+    # Values of the SETTLEMENT_FIELDS as loaded or last saved. Fields not loaded are missing
+    _saved_settlement = {}  # type: Dict[str, object]
+
+    def save(self, *args, **kwargs):
+        """Save the payment and move it between QuickpaySettlement rows. When the fields settlement_entry() depends
+        on haven't changed since the payment was loaded, they are left out of the UPDATE, so the settlement rows
+        stay right without locking the payment's row first. Otherwise the row is locked and read, see lock_saved()"""
+        update_fields = kwargs.get('update_fields')
+        saves_accepted = update_fields is None or 'accepted' in update_fields
+        written = SETTLEMENT_FIELDS if update_fields is None else SETTLEMENT_FIELDS.intersection(update_fields)
+        changed = {f for f in written
+                   if f not in self._saved_settlement or getattr(self, f) != self._saved_settlement[f]}
+        if not self._state.adding and not changed:
+            if written:
+                fields = update_fields if update_fields is not None else [
+                    f.name for f in self._meta.concrete_fields if not f.primary_key]
+                kwargs['update_fields'] = [f for f in fields if f not in SETTLEMENT_FIELDS]
+            super().save(*args, **kwargs)
+        else:
+            with transaction.atomic(savepoint=False):
+                saved = None if self.pk is None else self.lock_saved([self.pk]).get(self.pk)
+                super().save(*args, **kwargs)
+                QuickpaySettlement.apply_changes([(self, settlement_entry(saved) if saved is not None else None)])
+            self._saved_settlement = dict(self._saved_settlement, **{f: getattr(self, f) for f in written})
+        if saves_accepted:
+            if self.accepted and not self._saved_accepted:
+                QuickpayOrderPayment.objects.filter(order_id=self.order_id, paid=False).update(paid=True)
+            self._saved_accepted = self.accepted
+
+    @classmethod
+    def bulk_save(cls, payments: 'List[QuickpayPayment]', fields: List[str], batch_size: int = 500,
+                  later_only: bool = False) -> 'List[QuickpayPayment]':
+        """Save the given fields of many payments in one transaction. Return the payments saved.
+
+        # Args:
+        later_only : bool = Only save payments with a later Quickpay state than their rows, so a state applied
+                            meanwhile, e.g. by a callback, isn't overwritten by an earlier one
+        """
+        if not payments:
+            return []
+        with transaction.atomic():
+            saved = cls.lock_saved([p.pk for p in payments])
+            if later_only:
+                payments = [p for p in payments if p.pk in saved and p.is_later_than_saved(saved[p.pk])]
+            if hasattr(cls.objects, 'bulk_update'):
+                cls.objects.bulk_update(payments, fields, batch_size=batch_size)
+                QuickpaySettlement.apply_changes(
+                    [(p, settlement_entry(saved[p.pk]) if p.pk in saved else None) for p in payments])
+                (QuickpayOrderPayment.objects
+                 .filter(order_id__in={p.order_id for p in payments if p.accepted}, paid=False)
+                 .update(paid=True))
+            else:
+                for payment in payments:
+                    payment.save(update_fields=fields)
+        return payments
+
     @classmethod
     def get_order_payment(cls, order: Order, lock: bool = True) -> Optional['QuickpayPayment']:
         """Get the latest payment associated with the Order. Lock it for update.
         Return None if no payment found"""
-        payments = order.quickpaypayment_set.all().order_by('-id')[:1]
+        latest_id = QuickpayOrderPayment.objects.filter(order_id=order.pk).values_list('latest_id', flat=True).first()
+        if latest_id is not None:
+            payments = cls.objects.filter(pk=latest_id)
+        else:
+            # Payments made before QuickpayOrderPayment was introduced
+            payments = order.quickpaypayment_set.all().order_by('-id')[:1]
         if lock:
             payments = payments.select_for_update()
+        payments = list(payments)
         return payments[0] if payments else None
     
+    @classmethod
+    def get_reusable_link_payment(cls, order: Order, int_amount: int, currency: str, acquirer: Optional[str],
+                                  max_age: float) -> Optional['QuickpayPayment']:
+        """Get the latest unaccepted payment for the order with a payment link for the given amount, currency and
+        acquirer if created less than max_age seconds ago. Return None if there is no such payment"""
+        return (cls.objects
+                .filter(order=order, accepted=False, requested_amount=int_amount, requested_currency=currency,
+                        link_acquirer=acquirer or '', link_url__isnull=False,
+                        created__gte=now() - timedelta(seconds=max_age))
+                .order_by('-id').first())
+
+    def set_link(self, url: str, acquirer: Optional[str]):
+        """Register the payment link. Saves the link fields only"""
+        type(self).objects.filter(pk=self.pk).update(link_url=url, link_acquirer=acquirer or '')
+        self.link_url, self.link_acquirer = url, acquirer or ''
+
+    def set_qp_id(self, qp_id: int):
+        """Register the Quickpay payment ID. Saves the qp_id field only, in a statement of its own so it doesn't
+        hold locks while other fields are updated"""
+        type(self).objects.filter(pk=self.pk).update(qp_id=qp_id)
+        self.qp_id = qp_id
+
     @property
     def is_accepted(self) -> bool:
         return bool(self.accepted_date)
@@ -129,6 +268,18 @@ class QuickpayPayment(models.Model):
         """Whether payment may be captured"""
         return bool(self.accepted_date and self.captured_date is None)
 
+    def capture_amount(self, amount: 'Optional[Decimal]'=None) -> int:
+        """Amount to capture in minor units. Default requested amount, never more than requested"""
+        if amount is not None:
+            return min(self.requested_amount, to_minor_units(amount, self.requested_currency))
+        return self.requested_amount
+
+    def refund_amount(self, amount: 'Optional[Decimal]'=None) -> int:
+        """Amount to refund in minor units. Default captured amount, never more than captured"""
+        if amount is not None:
+            return min(self.balance, to_minor_units(amount, self.requested_currency))
+        return self.balance
+
     def capture(self, amount: 'Optional[Decimal]'=None) -> bool:
         """Capture this payment. May only capture once. Extra capture() calls have no effect.
         TODO: this function hasn't been used much for newer versions of Quickpay. Needs test and correction.
@@ -141,15 +292,11 @@ class QuickpayPayment(models.Model):
         """
         assert amount is None or isinstance(amount, Decimal)
         self.update_from_quickpay()  # Make sure we have the latest data form QP
-        if amount is not None:
-            assert isinstance(amount, Decimal)
-            int_amount = min(self.requested_amount, int(amount * 100))
-        else:
-            int_amount = self.requested_amount
+        int_amount = self.capture_amount(amount)
         client = quickpay_client(self.requested_currency)
         try:
-            client.post('/payments/%s/capture' % self.qp_id, **{'amount': int_amount})
-            # print("capture res", qp_res)
+            qp_res = client.post('/payments/%s/capture' % self.qp_id, **{'amount': int_amount})
+            QuickpayPaymentEvent.record(self, qp_res, QuickpayPaymentEvent.SOURCE_OPERATION)
             self.captured_date = now()
             # Have to get object again, the returned object is with the old data
             self.update_from_quickpay()
@@ -171,16 +318,12 @@ class QuickpayPayment(models.Model):
         """
         assert amount is None or isinstance(amount, Decimal)
         self.update_from_quickpay()  # Make sure we have the latest data form QP
-        if amount is not None:
-            assert isinstance(amount, Decimal)
-            int_amount = min(self.balance, int(amount * 100))
-        else:
-            int_amount = self.balance
+        int_amount = self.refund_amount(amount)
         client = quickpay_client(self.requested_currency)
         try:
             # print("Attempt to refund %d" % int_amount)
-            client.post('/payments/%s/refund' % self.qp_id, **{'amount': int_amount})
-            # print("RES", qp_res)
+            qp_res = client.post('/payments/%s/refund' % self.qp_id, **{'amount': int_amount})
+            QuickpayPaymentEvent.record(self, qp_res, QuickpayPaymentEvent.SOURCE_OPERATION)
             # Have to get object again, the returned object is with the old data
             self.update_from_quickpay()
             if self.balance == 0:
@@ -216,6 +359,7 @@ class QuickpayPayment(models.Model):
         self.state = res['state']
         self.balance = res.get('balance', 0)
         self.card_last4 = res.get('metadata', {}).get('last4', self.card_last4) or '9999'
+        self.last_operation_seq = operation_sequence(res)
 
         operations = res.get('operations', [])
         if operations:
@@ -232,20 +376,335 @@ class QuickpayPayment(models.Model):
             if self.state == 'processed' and not self.captured_date:
                 self.captured_date = timestamp
 
+    def quickpay_values(self) -> dict:
+        """Values of the fields set from Quickpay, for save_changes()"""
+        return {f: getattr(self, f) for f in self.QUICKPAY_FIELDS}
+
+    def save_changes(self, old_values: dict) -> List[str]:
+        """Save the fields changed since old_values was taken with quickpay_values(). Return the changed fields"""
+        changed = [f for f, value in old_values.items() if getattr(self, f) != value]
+        if changed:
+            self.save(update_fields=changed)
+        return changed
+
+    def is_later_than(self, res: dict) -> bool:
+        """Whether the payment already has the state of the Quickpay result or a later one"""
+        return self.last_operation_seq is not None and self.last_operation_seq >= operation_sequence(res)
+
+    def is_later_than_saved(self, saved: 'QuickpayPayment') -> bool:
+        """Whether the payment has a later Quickpay state than saved, another copy of it"""
+        return saved.last_operation_seq is None or (self.last_operation_seq is not None and
+                                                    self.last_operation_seq > saved.last_operation_seq)
+
+    def callback_processed(self, data: dict) -> bool:
+        """Whether a callback with the state of data, or a later state, has been processed for the payment.
+        Kept apart from last_operation_seq, which sync and operations also set without processing the order"""
+        return self.last_callback_seq is not None and self.last_callback_seq >= operation_sequence(data)
+
+    @classmethod
+    def callback_applied(cls, data: dict) -> bool:
+        """Whether a callback with the state of data, or a later state, has already been processed.
+        Quickpay retries callbacks and may deliver them out of order. An accepted callback is never considered
+        processed while its order has no transaction ID"""
+        if data.get('type') != 'Payment':
+            return False
+        payments = cls.objects.filter(qp_id=data['id'], last_callback_seq__gte=operation_sequence(data))
+        if data.get('accepted'):
+            payments = payments.exclude(order__transaction_id__isnull=True).exclude(order__transaction_id='')
+        return payments.exists()
+
+
+def operation_sequence(res: dict) -> int:
+    """Sequence number of the state of a Quickpay payment. Grows with each operation on the payment and when the
+    last operation is no longer pending, so later states have higher numbers"""
+    operations = res.get('operations') or []
+    if not operations:
+        return 0
+    last_op = operations[-1]
+    return 2 * int(last_op.get('id') or len(operations)) + (0 if last_op.get('pending') else 1)
+
+
+# Key of a QuickpaySettlement row (date, currency, acquirer, state) and the requested amount and balance
+SettlementEntry = Tuple[Tuple[date, str, str, str], int, int]
+
+# Fields of QuickpayPayment that settlement_entry() depends on
+SETTLEMENT_FIELDS = {'accepted_date', 'requested_currency', 'acquirer', 'state', 'requested_amount', 'balance'}
+
+def settlement_entry(payment: QuickpayPayment) -> 'Optional[SettlementEntry]':
+    """What the payment adds to QuickpaySettlement. Only accepted payments are counted, on the day accepted"""
+    if payment.accepted_date is None or payment.state is None:
+        return None
+    accepted_date = payment.accepted_date
+    day = (localtime(accepted_date) if is_aware(accepted_date) else accepted_date).date()
+    return ((day, payment.requested_currency, payment.acquirer or '', payment.state),
+            payment.requested_amount or 0, payment.balance or 0)
+
+
+class QuickpaySettlement(models.Model):
+    """Number and amounts of accepted payments per day, currency, acquirer and state. Maintained incrementally
+    when payments are saved, and rebuilt by the quickpay_rebuild_settlements command. See settlement.py"""
+    date = models.DateField(editable=False, help_text="Day the payments were accepted")  # type: date
+    currency = models.CharField(max_length=3, editable=False)              # type: str
+    acquirer = models.CharField(max_length=31, default='', editable=False)  # type: str
+    state = models.CharField(max_length=31, editable=False)                # type: str
+    count = models.IntegerField(default=0, editable=False)                 # type: int
+    requested_amount = models.BigIntegerField(default=0, editable=False,
+        help_text="Sum of requested amounts in minor unit, e.g. cent")     # type: int
+    balance = models.BigIntegerField(default=0, editable=False,
+        help_text="Sum of captured amounts in minor unit, e.g. cent")      # type: int
+
+    class Meta:
+        unique_together = [('date', 'currency', 'acquirer', 'state')]
+
+    @classmethod
+    def apply_changes(cls, changes: 'List[Tuple[QuickpayPayment, Optional[SettlementEntry]]]'):
+        """Move saved payments from the rows of their previous entries to the rows of their current ones.
+        changes are (payment, entry before it was saved)"""
+        deltas = {}  # type: Dict[tuple, List[int]]
+        for payment, saved_entry in changes:
+            entry = settlement_entry(payment)
+            if entry == saved_entry:
+                continue
+            if saved_entry is not None:
+                cls.add_entry(deltas, saved_entry, -1)
+            if entry is not None:
+                cls.add_entry(deltas, entry, 1)
+        cls.add(deltas)
+
+    @staticmethod
+    def add_entry(deltas: 'Dict[tuple, List[int]]', entry: 'SettlementEntry', sign: int):
+        """Add sign times the entry to the [count, requested amount, balance] deltas by key"""
+        key, requested_amount, balance = entry
+        delta = deltas.setdefault(key, [0, 0, 0])
+        delta[0] += sign
+        delta[1] += sign * requested_amount
+        delta[2] += sign * balance
+
+    @classmethod
+    def add(cls, deltas: 'Dict[tuple, List[int]]'):
+        """Add [count, requested amount, balance] deltas to the rows with the keys"""
+        # Rows are updated in key order so concurrent transactions don't deadlock
+        for key in sorted(deltas):
+            count, requested_amount, balance = deltas[key]
+            if not (count or requested_amount or balance):
+                continue
+            day, currency, acquirer, state = key
+            rows = cls.objects.filter(date=day, currency=currency, acquirer=acquirer, state=state)
+            values = {'count': models.F('count') + count,
+                      'requested_amount': models.F('requested_amount') + requested_amount,
+                      'balance': models.F('balance') + balance}
+            if not rows.update(**values):
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(date=day, currency=currency, acquirer=acquirer, state=state, count=count,
+                                           requested_amount=requested_amount, balance=balance)
+                except IntegrityError:
+                    # Created concurrently
+                    rows.update(**values)
+
+
+class QuickpayOrderPayment(models.Model):
+    """Latest payment and whether paid per Order, so they can be looked up by primary key.
+    Maintained by QuickpayPayment in the transaction changing the payment"""
+    order = models.OneToOneField(Order, primary_key=True, editable=False, on_delete=models.CASCADE)
+    latest = models.ForeignKey(QuickpayPayment, null=True, editable=False, related_name='+',
+                               on_delete=models.SET_NULL)                 # type: QuickpayPayment
+    paid = models.BooleanField(default=False, editable=False)            # type: bool
+
+    @classmethod
+    def set_latest(cls, payment: QuickpayPayment):
+        """Register payment as the latest payment of its order"""
+        if not cls.objects.filter(order_id=payment.order_id).update(latest=payment):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(order_id=payment.order_id, latest=payment)
+            except IntegrityError:
+                # Created concurrently
+                cls.objects.filter(order_id=payment.order_id).update(latest=payment)
+
+
+class QuickpayCallback(models.Model):
+    """Callback from Quickpay waiting to be processed by the quickpay_callback_worker command.
+    Only used when settings.QUICKPAY_CALLBACK_INBOX is True"""
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_DONE = 'done'
+    STATUS_DEAD = 'dead'
+    STATUS_CHOICES = ((STATUS_PENDING, 'Pending'), (STATUS_PROCESSING, 'Processing'), (STATUS_DONE, 'Done'),
+                      (STATUS_DEAD, 'Dead'))
+
+    qp_id = models.IntegerField(editable=False, help_text="ID of Payment or Subscription in Quickpay")  # type: int
+    operation = models.CharField(max_length=63, editable=False,
+        help_text="Quickpay state and ID of the last operation. Identifies the callback for the resource")  # type: str
+    body = models.TextField(editable=False, help_text="Callback body as received")  # type: str
+    status = models.CharField(max_length=15, choices=STATUS_CHOICES, default=STATUS_PENDING,
+                              editable=False)                              # type: str
+    attempts = models.IntegerField(default=0, editable=False)              # type: int
+    next_attempt = models.DateTimeField(default=now, editable=False,
+        help_text="When to process the callback next. When processing, the end of the worker's lease")  # type: datetime
+    last_error = models.TextField(null=True, editable=False)               # type: str
+    received = models.DateTimeField(auto_now_add=True, editable=False)     # type: datetime
+    processed = models.DateTimeField(null=True, editable=False)            # type: datetime
+
+    class Meta:
+        unique_together = [('qp_id', 'operation')]
+        indexes = [models.Index(fields=['status', 'next_attempt'])]
+
+    @classmethod
+    def enqueue(cls, body: bytes, data: dict) -> bool:
+        """Store callback unless the same callback has been stored already. Return whether it was stored"""
+        operations = data.get('operations') or [{}]
+        operation = '{}:{}'.format(data.get('state'), operations[-1].get('id', ''))
+        try:
+            with transaction.atomic():
+                cls.objects.create(qp_id=data['id'], operation=operation, body=body.decode('utf-8'))
+        except IntegrityError:
+            return False
+        return True
+
+
+class QuickpayPaymentEvent(models.Model):
+    """Quickpay state of a payment as received from a callback, an operation or a synchronization. Append-only.
+    One row per state: a state already recorded for the payment isn't recorded again.
+    The summary fields are from the last operation. The full response is kept zlib compressed in raw_json"""
+    SOURCE_CALLBACK = 'callback'
+    SOURCE_OPERATION = 'operation'
+    SOURCE_SYNC = 'sync'
+    SOURCE_CHOICES = ((SOURCE_CALLBACK, 'Callback'), (SOURCE_OPERATION, 'Operation'), (SOURCE_SYNC, 'Sync'))
+
+    payment = models.ForeignKey(QuickpayPayment, null=True, editable=False, related_name='events',
+                                on_delete=models.SET_NULL)             # type: QuickpayPayment
+    order_id = models.IntegerField(editable=False,
+        help_text="ID of the Order. Not a foreign key, so the history outlives the order")  # type: int
+    qp_id = models.IntegerField(editable=False, help_text="ID of Payment in Quickpay")  # type: int
+    operation_seq = models.IntegerField(editable=False,
+        help_text="Sequence number of the state, see operation_sequence()")  # type: int
+    source = models.CharField(max_length=15, choices=SOURCE_CHOICES, editable=False)  # type: str
+    operation = models.CharField(null=True, max_length=31, editable=False,
+        help_text="Type of the last operation, e.g. authorize or capture")  # type: str
+    amount = models.IntegerField(null=True, editable=False,
+        help_text="Amount of the last operation in minor unit, e.g. cent")  # type: int
+    state = models.CharField(null=True, max_length=31, editable=False)     # type: str
+    qp_status = models.CharField(null=True, max_length=31, editable=False)  # type: str
+    aq_status = models.CharField(null=True, max_length=31, editable=False)  # type: str
+    timestamp = models.DateTimeField(editable=False,
+        help_text="Time of the last operation in Quickpay, or when received")  # type: datetime
+    raw_json = models.BinaryField(editable=False, help_text="Quickpay response, zlib compressed JSON")  # type: bytes
+
+    class Meta:
+        unique_together = [('qp_id', 'operation_seq')]
+        indexes = [models.Index(fields=['order_id', 'timestamp'])]
+
+    @classmethod
+    def from_res(cls, payment: QuickpayPayment, res: dict, source: str) -> 'QuickpayPaymentEvent':
+        """Make an unsaved event from a Quickpay payment result"""
+        operations = res.get('operations') or [{}]
+        last_op = operations[-1]
+        return cls(payment=payment, order_id=payment.order_id, qp_id=res['id'], operation_seq=operation_sequence(res),
+                   source=source, operation=last_op.get('type'), amount=last_op.get('amount'),
+                   state=res.get('state'), qp_status=last_op.get('qp_status_code'),
+                   aq_status=last_op.get('aq_status_code'),
+                   timestamp=parse_datetime(last_op.get('created_at') or '') or now(),
+                   raw_json=zlib.compress(json.dumps(res, separators=(',', ':')).encode('utf-8')))
+
+    @classmethod
+    def record(cls, payment: QuickpayPayment, res: dict, source: str) -> bool:
+        """Record the state of a Quickpay payment result. Return whether it was new"""
+        return cls.record_many([cls.from_res(payment, res, source)]) == 1
+
+    @classmethod
+    def record_many(cls, events: 'List[QuickpayPaymentEvent]') -> int:
+        """Save events, leaving out states already recorded. Return the number saved"""
+        unique = {(e.qp_id, e.operation_seq): e for e in events}
+        if not unique:
+            return 0
+        recorded = set(cls.objects.filter(qp_id__in={qp_id for qp_id, _ in unique})
+                       .values_list('qp_id', 'operation_seq'))
+        new = [e for key, e in unique.items() if key not in recorded]
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create(new)
+            return len(new)
+        except IntegrityError:
+            # Recorded concurrently, save one at a time
+            saved = 0
+            for event in new:
+                try:
+                    with transaction.atomic():
+                        event.save()
+                    saved += 1
+                except IntegrityError:
+                    pass
+            return saved
+
+    @classmethod
+    def order_history(cls, order_id: int) -> models.QuerySet:
+        """Events of the payments of an order, oldest first, without the raw responses"""
+        return cls.objects.filter(order_id=order_id).defer('raw_json').order_by('timestamp', 'id')
+
+    @property
+    def raw(self) -> dict:
+        """The Quickpay response, decompressed"""
+        return json.loads(zlib.decompress(bytes(self.raw_json)).decode('utf-8'))
+
+
+class QuickpaySyncState(models.Model):
+    """Watermark of incremental synchronization with Quickpay"""
+    name = models.CharField(max_length=63, unique=True, editable=False)   # type: str
+    watermark = models.DateTimeField(null=True, editable=False,
+        help_text="Resources changed in Quickpay before this time have been synchronized")  # type: datetime
+
+
+class QuickpayRateLimit(models.Model):
+    """State of a token bucket shared by all nodes, see ratelimit.py"""
+    name = models.CharField(max_length=63, unique=True, editable=False)   # type: str
+    tokens = models.FloatField(editable=False)                            # type: float
+    updated = models.FloatField(editable=False, help_text="Unix time of the last update")  # type: float
+
+
+_remote_cleanup = threading.local()
+
+
+@contextmanager
+def remote_cleanup_deferred():
+    """Don't call Quickpay when payments and orders are deleted in the block. The caller cleans up in Quickpay
+    itself after the deletion is committed, e.g. purge.py in concurrent batches. Applies to the current thread"""
+    deferred = getattr(_remote_cleanup, 'deferred', False)
+    _remote_cleanup.deferred = True
+    try:
+        yield
+    finally:
+        _remote_cleanup.deferred = deferred
+
 
 @receiver(post_delete, sender=QuickpayPayment)
 def _quickpay_payment_post_delete(sender, instance: QuickpayPayment, **kwargs):
     """Delete payment link in Quickpay if it hasn't been accepted.
     The payment itself cannot be deleted."""
+    if getattr(_remote_cleanup, 'deferred', False):
+        return
     from .payment import delete_payment_link
     delete_payment_link(instance)
 
 
+@receiver(pre_delete, sender=QuickpayPayment)
+def _quickpay_payment_pre_delete_settlement(sender, instance: QuickpayPayment, **kwargs):
+    """Remove payment from QuickpaySettlement. Run in the transaction deleting it"""
+    saved = instance.lock_saved([instance.pk]).get(instance.pk)
+    saved_entry = settlement_entry(saved) if saved is not None else None
+    if saved_entry is not None:
+        deltas = {}  # type: Dict[tuple, List[int]]
+        QuickpaySettlement.add_entry(deltas, saved_entry, -1)
+        QuickpaySettlement.add(deltas)
+
+
 @receiver(post_delete, sender=Order)
 def _order_post_delete_subscription(sender, instance: Order, **kwargs):
     """Delete subscription in Quickpay if order deleted before subscription activated/paid.
     """
     # Applicable when subscription has been created in Quickpay but not in cartridge_subscription.
     # cartridge_subscription.Subscription is created when the subscription has been paid!
+    if getattr(_remote_cleanup, 'deferred', False):
+        return
     from .payment import delete_order_subscription
     delete_order_subscription(instance)
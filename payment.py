@@ -32,24 +32,35 @@ TEST CARD (Nets, Dankort):
     see list of test cards here: https://learn.quickpay.net/tech-talk/appendixes/test/
     cvd = 208 for test card issued in DK
 
-TODO:
-    Prevent double payment. Seen during test, probably due to double-click!
+DOUBLE PAYMENT:
+    Repeated checkouts (double-click, browser retry) are coalesced. Only one request at a time creates the payment
+    link for an order, and an unaccepted link for the same order, amount, currency and acquirer is reused for
+    QUICKPAY_LINK_REUSE_TTL seconds (default 900, 0 disables reuse).
+    Coalescing across processes requires a cache shared by the processes (QUICKPAY_CACHE, default 'default').
+    Requests wait at most QUICKPAY_SINGLE_FLIGHT_TIMEOUT seconds (default 30) for the request ahead of them.
 """
 
+from django.utils import translation
 from django.utils.timezone import now
 from django.forms import Form
-from django.utils.translation import ugettext_lazy as _
-from django.core.urlresolvers import reverse
+from django.utils.translation import gettext_lazy as _
+from django.urls import reverse
 from django.dispatch import Signal, receiver
 from django.http import HttpRequest
 from django.db import transaction
+from django.core.cache import caches
 from mezzanine.conf import settings
+from mezzanine.utils.sites import current_site_id, override_current_site_id
 from cartridge.shop.models import Order, OrderItem
 from cartridge.shop.checkout import CheckoutError, send_order_email
-from .models import QuickpayPayment, quickpay_client, get_private_key
+from . import effects, metrics
+from .models import QuickpayPayment, QuickpayPaymentEvent, quickpay_client
+from .agreements import get_agreement, get_agreements
+from .currency import default_currency, to_minor_units
 from quickpay_api_client.exceptions import ApiError
 # noinspection PyPep8
-import hmac, hashlib, locale, logging
+import hmac, hashlib, json, logging, time, uuid
+from contextlib import contextmanager
 from datetime import datetime
 from decimal import Decimal
 from typing import Dict, List, Optional, Tuple
@@ -108,9 +119,7 @@ def quickpay_payment_handler(request, order_form: Form, order: Order) -> str:
     logging.debug("quickpay_payment_handler(): card_number = XXXX XXXX XXXX %s, card_expiry = %s, card_ccv = XXXX"
                   % (card_last4, card_expiry))
 
-    # Currency - the shop's currency. If we support multiple currencies in the future,
-    # fetch currency from order instead.
-    locale.setlocale(locale.LC_ALL, str(settings.SHOP_CURRENCY_LOCALE))
+    # Currency - the order's currency if it has one, else the shop's currency
     currency = order_currency(order)
     logging.debug("quickpay_payment_handler(): currency = %s" % currency)
 
@@ -137,6 +146,7 @@ def quickpay_payment_handler(request, order_form: Form, order: Order) -> str:
     logging.debug("quickpay_payment_handler(): authorize result = %s" % res)
     payment.update_from_res(res)
     payment.save()
+    QuickpayPaymentEvent.record(payment, res, QuickpayPaymentEvent.SOURCE_OPERATION)
 
     order.status = settings.SHOP_ORDER_PAID
     order.save()
@@ -158,25 +168,90 @@ def get_quickpay_link(order: Order, acquirer: Optional[str] = None) -> Dict[str,
 
     If both settings.QUICKPAY_ACQUIRER and settings.QUICKPAY_PAYMENT_METHODS are None or unspecified,
     the payment window will let the user choose any available payment method.
+
+    No transaction is held open while calling Quickpay: the QuickpayPayment is committed first, then the
+    Quickpay payment is created, then its ID is saved. Don't call inside transaction.atomic() (or with
+    ATOMIC_REQUESTS) or the locks are held during the Quickpay calls after all.
     """
     logging.debug("payment_quickpay: get_quickpay_link() - link for {}".format(order))
-    framed: bool = getattr(settings, 'QUICKPAY_FRAMED_MODE', False)
-    iframe: bool = getattr(settings, 'QUICKPAY_IFRAME_MODE', False)
     currency = order_currency(order)
+    reuse_ttl = getattr(settings, 'QUICKPAY_LINK_REUSE_TTL', 900)
+    if not reuse_ttl:
+        return _create_quickpay_link(order, currency, acquirer)
+
+    with single_flight('quickpay_link:{}'.format(order.pk)):
+        payment = QuickpayPayment.get_reusable_link_payment(
+            order, to_minor_units(order.total, currency), currency, acquirer, reuse_ttl)
+        if payment is not None:
+            logging.debug("payment_quickpay: get_quickpay_link() - reusing link of Quickpay payment {}"
+                          .format(payment.qp_id))
+            return {'id': payment.qp_id, 'url': payment.link_url}
+        return _create_quickpay_link(order, currency, acquirer)
+
+
+def _create_quickpay_link(order: Order, currency: str, acquirer: Optional[str]) -> Dict[str, str]:
+    """Create Quickpay payment and link for the order"""
     card_last4 = '9999'
     with transaction.atomic():
         payment = QuickpayPayment.create_card_payment(order, order.total, currency, card_last4)
 
-        client = quickpay_client(currency)
-        qp_order_id = '%s_%06d' % (order.id, payment.id)
-        res = client.post('/payments', currency=currency, order_id=qp_order_id)
-        payment_id = res['id']
-        payment.qp_id = payment_id
-        payment.save()
+    client = quickpay_client(currency)
+    qp_order_id = '%s_%06d' % (order.id, payment.id)
+    res = client.post('/payments', currency=currency, order_id=qp_order_id)
+    payment_id = res['id']
+    payment.set_qp_id(payment_id)
     logging.debug(
         "payment_quickpay: get_quickpay_link() - created Quickpay payment with order_id={}, payment id={}"
         .format(qp_order_id, res['id']))
 
+    quickpay_link_args = payment_link_args(order, payment, acquirer)
+    logging.debug(
+        "payment_quickpay: get_quickpay_link() - creating link with args {}".format(str(quickpay_link_args)))
+    res = client.put("/payments/%s/link" % payment_id, **quickpay_link_args)
+    logging.debug(
+        "payment_quickpay: get_quickpay_link() - got link {}".format(res))
+    payment.set_link(res['url'], acquirer)
+    return {'id': payment_id, 'url': res['url']}  # Same as for a reused link
+
+
+def quickpay_cache():
+    """Cache for locks and checkout coalescing. Must be shared by the processes of the shop"""
+    return caches[getattr(settings, 'QUICKPAY_CACHE', 'default')]
+
+
+@contextmanager
+def single_flight(key: str, timeout: Optional[float] = None):
+    """Run the block for one caller at a time per key, across processes sharing the cache.
+
+    Later callers wait for the caller ahead of them to finish so they can reuse its result. If the lock isn't
+    released within timeout seconds (QUICKPAY_SINGLE_FLIGHT_TIMEOUT), the caller goes ahead without it.
+    """
+    timeout = timeout or getattr(settings, 'QUICKPAY_SINGLE_FLIGHT_TIMEOUT', 30)
+    cache = quickpay_cache()
+    cache_key = 'cartridge_quickpay:lock:' + key
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + timeout
+    delay = 0.02
+    with metrics.lock_wait.time(site='single_flight'):
+        acquired = cache.add(cache_key, token, timeout)
+        while not acquired and time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.25)
+            acquired = cache.add(cache_key, token, timeout)
+    if not acquired:
+        logging.warning("payment_quickpay: single_flight({}) - timed out waiting, going ahead".format(key))
+    try:
+        yield
+    finally:
+        if acquired and cache.get(cache_key) == token:
+            cache.delete(cache_key)
+
+
+def payment_link_args(order: Order, payment: QuickpayPayment, acquirer: Optional[str] = None) -> dict:
+    """Make the arguments for the Quickpay link of a payment"""
+    framed: bool = getattr(settings, 'QUICKPAY_FRAMED_MODE', False)
+    iframe: bool = getattr(settings, 'QUICKPAY_IFRAME_MODE', False)
+
     # Make continue_url, cancel_url for framed/unframed versions
     cancel_url = reverse("quickpay_failed")
     continue_url = reverse("quickpay_success") + "?id="+str(order.pk) + "&hash=" + sign_order(order)
@@ -211,13 +286,7 @@ def get_quickpay_link(order: Order, acquirer: Optional[str] = None) -> Dict[str,
         quickpay_link_args['payment_methods'] = settings.QUICKPAY_PAYMENT_METHODS
         logging.debug("payment_quickpay: get_quickpay_link() - payement methods = '{}'"
                       .format(settings.QUICKPAY_PAYMENT_METHODS))
-
-    logging.debug(
-        "payment_quickpay: get_quickpay_link() - creating link with args {}".format(str(quickpay_link_args)))
-    res = client.put("/payments/%s/link" % payment_id, **quickpay_link_args)
-    logging.debug(
-        "payment_quickpay: get_quickpay_link() - got link {}".format(res))
-    return res
+    return quickpay_link_args
 
 
 def delete_payment_link(payment: QuickpayPayment):
@@ -237,7 +306,15 @@ def delete_payment_link(payment: QuickpayPayment):
         # print(client.post(url))
 
 
-@transaction.atomic
+def cancel_payment_link(qp_id: int, currency: Optional[str] = None):
+    """Delete the link of a Quickpay payment, so it can't be paid any more.
+    Requires permission for the API user in Quickpay (Settings > Users > API User > /payments/:id/link delete
+    """
+    url = "/payments/{}/link".format(qp_id)
+    logging.debug("cartridge_quickpay.payment.cancel_payment_link: delete({})".format(url))
+    quickpay_client(currency).delete(url)
+
+
 def start_subscription(order: Order, order_item: OrderItem) -> Tuple[int, str]:
     """Start subscription and get subscription authorization link.
     Returns (<Quickpay subscription id>, <Quickpay payment url>)
@@ -247,10 +324,14 @@ def start_subscription(order: Order, order_item: OrderItem) -> Tuple[int, str]:
       Call start_subscription() to create the QP subscription. The subscription id is registered as order.membership_id
       Redirect the user to the returned payment URL
       The user makes a normal payment. 
+
+    Like get_quickpay_link(), the payment is committed before calling Quickpay and no transaction is open
+    during the Quickpay calls.
     """
     currency = order_currency(order)
     amount: Decimal = order_item.total_price + getattr(order_item, 'tax_amount', 0)
-    payment = QuickpayPayment.create_card_payment(order, amount, currency, '9999')
+    with transaction.atomic():
+        payment = QuickpayPayment.create_card_payment(order, amount, currency, '9999')
 
     # Create subscription in Quickpay
     client = quickpay_client(currency)
@@ -259,9 +340,26 @@ def start_subscription(order: Order, order_item: OrderItem) -> Tuple[int, str]:
     logging.debug("start_subscription qp /subscriptions POST result = {}".format(res))
     subscription_id = res['id']
 
-    # Make continue_url, cancel_url for framed/unframed versions
+    quickpay_link_args = subscription_link_args(order, to_minor_units(amount, currency))
+    logging.debug("start_subscription qp /subscriptions/{}/link args: {}".format(subscription_id, quickpay_link_args))
+
+    res = client.put('/subscriptions/{}/link'.format(subscription_id), **quickpay_link_args)
+    logging.debug("start_subscription qp /subscriptions/{}/link result = {}".format(subscription_id, res))
+    url = res['url']
+
+    if Subscription is not None:
+        Order.objects.filter(pk=order.pk).update(membership_id=subscription_id)
+        order.membership_id = subscription_id
+
+    return subscription_id, url
+    
+
+def subscription_link_args(order: Order, int_amount: int) -> dict:
+    """Make the arguments for the Quickpay link of a subscription"""
     framed: bool = getattr(settings, 'QUICKPAY_FRAMED_MODE', False)
     iframe: bool = getattr(settings, 'QUICKPAY_IFRAME_MODE', False)
+
+    # Make continue_url, cancel_url for framed/unframed versions
     continue_url = reverse("quickpay_success") + "?id="+str(order.pk) + "&hash=" + sign_order(order)
     cancel_url = reverse("quickpay_failed")
     if framed:
@@ -269,7 +367,6 @@ def start_subscription(order: Order, order_item: OrderItem) -> Tuple[int, str]:
         cancel_url += '?framed=1'
 
     # Make Quickpay link
-    int_amount = int(amount * 100)
     quickpay_link_args = dict(
         amount=int_amount,
         continue_url=settings.QUICKPAY_SHOP_BASE_URL + continue_url,
@@ -280,18 +377,8 @@ def start_subscription(order: Order, order_item: OrderItem) -> Tuple[int, str]:
     )
     quickpay_link_args['customer_email'] = order.billing_detail_email
     # quickpay_link_args['acquirer'] = 'paypal' - FOR TEST
-    logging.debug("start_subscription qp /subscriptions/{}/link args: {}".format(subscription_id, quickpay_link_args))
-
-    res = client.put('/subscriptions/{}/link'.format(subscription_id), **quickpay_link_args)
-    logging.debug("start_subscription qp /subscriptions/{}/link result = {}".format(subscription_id, res))
-    url = res['url']
+    return quickpay_link_args
 
-    if Subscription is not None:
-        order.membership_id = subscription_id
-        order.save()
-
-    return subscription_id, url
-    
 
 def renew_subscription(subscription: 'Subscription', product_sku: Optional[str] = None,
                        from_time: Optional[datetime] = None) -> Optional['Order']:
@@ -304,52 +391,86 @@ def renew_subscription(subscription: 'Subscription', product_sku: Optional[str]
     return order
 
 
-@transaction.atomic
-def capture_subscription_order(order: Order):
+def capture_subscription_order(order: Order, synchronized: bool = True):
     """Capture initial or recurring subscription order.
 
     Makes a QuickpayPayment instance with the QP payment id but does not modify any other data.
     The capture is finished in the callback.
 
+    With synchronized=False Quickpay returns as soon as the recurring payment has been created instead of waiting
+    for the acquirer. Completion is left to the callback either way.
+
+    The payment is reserved under a lock on the Order and committed before calling Quickpay, so the
+    Order lock is not held during the call. A payment that already has a Quickpay ID is not captured
+    again. The Quickpay order_id is derived from the payment ID, so Quickpay rejects a concurrent
+    duplicate capture of the same payment.
+
     Before capturing:
     - Subscription payment must be authorized
     """
-    currency = order_currency(order)
-    client = quickpay_client(currency)
-    amount = order.total
-    Order.objects.filter(pk=order.pk).select_for_update()[0]  # Lock order to prevent race condition
-    payment = (QuickpayPayment.get_order_payment(order)
-                   or QuickpayPayment.create_card_payment(order, amount, currency, '9999'))
+    payment = reserve_subscription_payment(order)
+    if payment is None:
+        return
+
+    client = quickpay_client(payment.requested_currency)
     qp_order_id = '%s_%06d' % (order.id, payment.id)
-    int_amount = int(amount * 100)
+    int_amount = to_minor_units(order.total, payment.requested_currency)
     url = "/subscriptions/{}/recurring".format(order.membership_id)
-    args = {'order_id': qp_order_id, 'amount': int_amount, 'auto_capture': True, 'synchronized': True}
+    args = {'order_id': qp_order_id, 'amount': int_amount, 'auto_capture': True}
+    if synchronized:
+        args['synchronized'] = True
     logging.debug("payment_quickpay:capture_subscription: recurring capture, url={}, args={}".format(url, args))
     res = client.post(url, **args)
     logging.debug("payment_quickpay:capture_subscription res = {}".format(res))
-    payment.qp_id = res['id']
-    payment.save()
+    payment.set_qp_id(res['id'])
+
+
+def reserve_subscription_payment(order: Order) -> Optional[QuickpayPayment]:
+    """Get or create the payment for capturing a subscription order and commit it.
+    Return None if the payment has already been captured"""
+    currency = order_currency(order)
+    with transaction.atomic():
+        with metrics.lock_wait.time(site='reserve_subscription_payment'):
+            Order.objects.filter(pk=order.pk).select_for_update()[0]  # Lock order to prevent race condition
+        payment = (QuickpayPayment.get_order_payment(order)
+                       or QuickpayPayment.create_card_payment(order, order.total, currency, '9999'))
+    if payment.qp_id is not None:
+        logging.debug("payment_quickpay:capture_subscription: order {} already captured as Quickpay payment {}"
+                      .format(order.pk, payment.qp_id))
+        return None
+    return payment
 
 
 def delete_order_subscription(order: Order):
     """Delete order subscription in Quickpay if it has never been paid/active
     Requires permission for the API user in Quickpay (Settings > Users > API User > /subscription/:id/link delete
     """
-    if order.status == settings.ORDER_STATUS_NEW and not order.transaction_id and getattr(order, 'membership_id', None):
-        client = quickpay_client(order.currency)
-        url = "/subscriptions/{}/link".format(order.membership_id)
-        logging.debug("cartridge_quickpay.payment.delete_order_subscription: delete({})".format(url))
-        client.delete(url)
-        url = "/subscriptions/{}/cancel".format(order.membership_id)
-        # Ignore if subscription cannot be cancelled in qp
-        try:
-            client.post(url)
-        except:
-            pass
+    if has_unpaid_subscription(order):
+        cancel_subscription(order.membership_id, order_currency(order))
+
+
+def has_unpaid_subscription(order: Order) -> bool:
+    """Whether the order has a Quickpay subscription that has never been paid/active"""
+    return (order.status == settings.ORDER_STATUS_NEW and not order.transaction_id
+            and bool(getattr(order, 'membership_id', None)))
+
+
+def cancel_subscription(subscription_id, currency: Optional[str] = None):
+    """Delete the link of a Quickpay subscription and cancel it"""
+    client = quickpay_client(currency)
+    url = "/subscriptions/{}/link".format(subscription_id)
+    logging.debug("cartridge_quickpay.payment.cancel_subscription: delete({})".format(url))
+    client.delete(url)
+    url = "/subscriptions/{}/cancel".format(subscription_id)
+    # Ignore if subscription cannot be cancelled in qp
+    try:
+        client.post(url)
+    except:
+        pass
 
 
 def order_currency(order: Order) -> str:
-    return getattr(order, 'currency') or locale.localeconv()['int_curr_symbol'][0:3]
+    return getattr(order, 'currency', None) or default_currency()
 
 
 def sign(base: bytes, private_key: str) -> str:
@@ -361,30 +482,59 @@ def sign(base: bytes, private_key: str) -> str:
     ).hexdigest()
 
 
+def verify_callback(body: bytes, checksum: Optional[str], account_id: Optional[str] = None) -> bool:
+    """Whether the callback body is signed with the private key of its agreement. The agreement is found by
+    Quickpay account ID if known, otherwise by the currency of the callback. Doesn't touch the database"""
+    if not checksum:
+        return False
+    agreement = get_agreements().for_account(account_id)
+    if agreement is None:
+        agreement = get_agreement(_callback_currency(body))
+    return hmac.compare_digest(agreement.sign(body).encode('utf-8'), checksum.encode('utf-8'))
+
+
+def _callback_currency(body: bytes) -> Optional[str]:
+    """The top level currency of a callback body, None if there is none"""
+    try:
+        data = json.loads(body.decode('utf-8'))
+    except ValueError:  # Includes UnicodeDecodeError
+        return None
+    currency = data.get('currency') if isinstance(data, dict) else None
+    return currency if isinstance(currency, str) else None
+
+
+def callback_state_processed(qp_state: Optional[str]) -> bool:
+    """Whether callbacks in the given state are processed.
+    We may get several callbacks with states "new", "pending", or "processed"
+    We're only interested in "processed" for payments and "active" for new subscriptions"""
+    return (qp_state in ('processed', 'active', 'rejected')
+            or not getattr(settings, 'QUICKPAY_AUTO_CAPTURE', False) and qp_state == 'pending')
+
+
 def sign_order(order: Order) -> str:
     """Calculate order order signature"""
     # order.total may have more decimals than are saved, round to make sure it has exactly two
     sign_string = str(order.pk) + str(round(order.total, 2)) + order.key
     logging.debug("cartridge_quickpay:sign_order() - sign string = '{}'".format(sign_string))
-    res = sign(bytes(sign_string, 'utf-8'), get_private_key(order_currency(order)))
+    res = get_agreement(order_currency(order)).sign(bytes(sign_string, 'utf-8'))
     logging.debug("cartridge_quickpay:sign_order() - signature = '{}'".format(res))
     return res
 
 
-# Signal when order has been authorized. Sent once per order.
-# Called within a transaction
-order_authorized = Signal(providing_args=['instance', 'payment'])
-order_captured = Signal(providing_args=['instance', 'payment'])
+# Signal when order has been authorized. Sent once per order. Arguments: instance (the Order), payment
+# Called within a transaction. With QUICKPAY_DEFER_SIDE_EFFECTS, sent after commit from a worker thread (effects.py)
+order_authorized = Signal()
+order_captured = Signal()  # Arguments: instance (the Order), payment
 
 
 # Signal when order has been completed. Sent once per order. NOT SENT if success page not reached!
 # Called within a transaction
-order_completed = Signal(providing_args=['instance'])
+order_completed = Signal()  # Arguments: instance (the Order)
 
 
 # Signal when order has been completed. Sent once per order. NOT SENT if success page not reached!
 # Called within a transaction
-subscription_paid = Signal(providing_args=['instance'])
+subscription_paid = Signal()  # Arguments: instance (the Order)
 
 
 def order_handler(request: Optional[HttpRequest], order_form, order: Order, payment: Optional[QuickpayPayment] = None):
@@ -397,13 +547,18 @@ def order_handler(request: Optional[HttpRequest], order_form, order: Order, paym
     NB: order.complete() is done here! With standard Cartridge credit card flow, order.complete() is called there!
     This is because we want complete() to be called within the atomic transaction!
     """
+    with metrics.order_handler_seconds.time():
+        _order_handler(request, order, payment)
 
+
+def _order_handler(request: Optional[HttpRequest], order: Order, payment: Optional[QuickpayPayment]):
     completed_now = False
     with transaction.atomic():
         transaction_id = order.transaction_id
         # Re-read the order from the database to make sure it locked for atomicity.
         # This is important when calling order_handler from success()
-        order: Order = Order.objects.filter(pk=order.pk).select_for_update()[0]
+        with metrics.lock_wait.time(site='order_handler'):
+            order: Order = Order.objects.filter(pk=order.pk).select_for_update()[0]
         status_authorized = getattr(settings, 'QUICKPAY_ORDER_STATUS_AUTHORIZED', None)
         if status_authorized and order.status < status_authorized or not order.transaction_id:
             logging.debug("payment_quickpay: order_handler(), order = %s" % order)
@@ -416,10 +571,13 @@ def order_handler(request: Optional[HttpRequest], order_form, order: Order, paym
 
             order.save()
             if order.transaction_id:
-                if payment and payment.is_captured:
-                    order_captured.send(sender=Order, instance=order, payment=payment)
+                signal, name = ((order_captured, 'order_captured') if payment and payment.is_captured
+                                else (order_authorized, 'order_authorized'))
+                if effects.deferred():
+                    # Sent when committed so the receivers don't make the Order lock be held longer
+                    effects.send_signal_after_commit(signal, name, order.pk, payment=payment)
                 else:
-                    order_authorized.send(sender=Order, instance=order, payment=payment)
+                    signal.send(sender=Order, instance=order, payment=payment)
         else:
             logging.debug("order_handler() - order {} already being processed".format(order.id))
 
@@ -439,7 +597,24 @@ def order_handler(request: Optional[HttpRequest], order_form, order: Order, paym
         # Mail isn't sent if success page isn't reached. Shop admin can see that - the order will be in
         # ORDER_STATUS_AUTHORIZED whereas if the success page was reached, it's in _WAITING.
         # Outside transaction to shorten transaction time and to prevent transaction rollback if mail fails
-        send_order_email(request, order)
+        if effects.deferred():
+            effects.run_after_commit(order.pk, 'send_order_email', _order_email_effect(request, order), retry=False)
+        else:
+            send_order_email(request, order)
+
+
+def _order_email_effect(request: HttpRequest, order: Order) -> effects.Effect:
+    """send_order_email() for running after the response has been returned. Keeps what the mail needs, the site,
+    the language and a detached copy of the request, and re-reads the order when run"""
+    mail_request = effects.detached_request(request)
+    order_id = order.pk
+    language = translation.get_language()
+    site_id = current_site_id()
+
+    def send():
+        with translation.override(language), override_current_site_id(site_id):
+            send_order_email(mail_request, Order.objects.get(pk=order_id))
+    return send
 
 
 if Subscription is not None:
@@ -0,0 +1,156 @@
+"""Purge of abandoned payments
+
+    from cartridge_quickpay.purge import purge_abandoned_payments
+    result = purge_abandoned_payments(timedelta(days=30))
+
+Every checkout attempt leaves a QuickpayPayment. Payments never accepted and created before the cutoff are found
+through the (accepted, created) index and deleted in chunks, each in a short transaction of its own. Payments with
+callbacks in the inbox that aren't processed yet (see inbox.py) are left alone: such a callback may be the one
+accepting the payment. The transaction doesn't call Quickpay (see models.remote_cleanup_deferred()): after each
+chunk is committed, the links of its payments are deleted in Quickpay, so they can't be paid any more,
+concurrently, in the batch lane of the shared rate limit (see ratelimit.py) and at most rate calls per second.
+
+Subscription orders (membership_id) that were never paid and have no payments left get their Quickpay
+subscription cancelled the same way, and their membership_id cleared in the chunk's transaction.
+
+Deleting a payment updates QuickpaySettlement and keeps its events (see models.py). A Quickpay call failing after
+the commit is logged and counted, not retried: the payment is already gone in the shop, and an unpaid payment
+left in Quickpay does no harm. Don't call inside transaction.atomic(), or nothing is committed when Quickpay is
+called. Payments without a created time (made before it was recorded) are left alone.
+
+Also available as the quickpay_purge management command.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Callable, List, Optional, Tuple
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.db.models import Q, QuerySet
+from django.utils.timezone import now
+from cartridge.shop.models import Order
+from quickpay_api_client.exceptions import ApiError
+
+from .models import QuickpayCallback, QuickpayPayment, remote_cleanup_deferred
+from .payment import cancel_payment_link, cancel_subscription, has_unpaid_subscription, order_currency
+from .ratelimit import BATCH, TokenBucket, priority
+
+
+__author__ = 'jfk@metation.dk'
+
+
+class PurgeResult:
+    """Outcome of a purge"""
+
+    def __init__(self):
+        self.payments = 0
+        self.subscriptions = 0
+        self.remote_calls = 0
+        self.remote_failed = 0
+
+    def __str__(self):
+        return "{} payments and {} subscriptions purged, {} Quickpay cleanups, {} failed".format(
+            self.payments, self.subscriptions, self.remote_calls, self.remote_failed)
+
+
+def abandoned_payments(older_than: timedelta) -> QuerySet:
+    """Payments never accepted, created more than older_than ago"""
+    return _still_abandoned(QuickpayPayment.objects.filter(created__lt=now() - older_than))
+
+
+def _still_abandoned(payments: QuerySet) -> QuerySet:
+    """The payments that aren't accepted and have no unprocessed callbacks in the inbox"""
+    unprocessed = QuickpayCallback.objects.exclude(status=QuickpayCallback.STATUS_DONE).values('qp_id')
+    return payments.filter(accepted=False, accepted_date__isnull=True).exclude(qp_id__in=unprocessed)
+
+
+def purge_abandoned_payments(older_than: timedelta, chunk_size: int = 500, workers: int = 8,
+                             rate: Optional[float] = None,
+                             progress: Optional[Callable[[PurgeResult], None]] = None) -> PurgeResult:
+    """Delete abandoned payments and clean up in Quickpay after each chunk.
+
+    # Args:
+    older_than : timedelta = Age of the payments to purge
+    chunk_size : int = Payments deleted per transaction
+    workers : int = Max. concurrent Quickpay calls
+    rate : float | None = Max. Quickpay calls per second, None for no limit besides the shared rate limit
+    progress : callable | None = Called with the result so far after each chunk
+    """
+    payments = abandoned_payments(older_than).order_by('created', 'pk')
+    limiter = TokenBucket(rate, burst=workers) if rate else None
+    result = PurgeResult()
+    last = None  # type: Optional[Tuple]  # (created, pk) of the last payment seen
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Keyset pagination along the index, so payments that couldn't be deleted aren't read again
+            chunk = payments if last is None else payments.filter(
+                Q(created__gt=last[0]) | Q(created=last[0], pk__gt=last[1]))
+            candidates = list(chunk.values_list('created', 'pk')[:chunk_size])
+            if not candidates:
+                break
+            last = candidates[-1]
+
+            cleanups = _delete_chunk([pk for _, pk in candidates], result)
+            for ok in executor.map(lambda cleanup: _clean_up(cleanup, limiter), cleanups):
+                result.remote_calls += 1
+                result.remote_failed += 0 if ok else 1
+            logging.info("cartridge_quickpay.purge: %s", result)
+            if progress is not None:
+                progress(result)
+    return result
+
+
+def _delete_chunk(payment_ids: List[int], result: PurgeResult) -> List[Tuple[Callable, tuple]]:
+    """Delete the payments that are still abandoned in one transaction. Return the Quickpay cleanups as
+    (function, args)"""
+    cleanups = []  # type: List[Tuple[Callable, tuple]]
+    with transaction.atomic(), remote_cleanup_deferred():
+        # Locked and checked again, so a payment accepted or getting a callback meanwhile isn't deleted
+        rows = list(_still_abandoned(QuickpayPayment.objects.select_for_update().filter(pk__in=payment_ids))
+                    .values_list('pk', 'qp_id', 'requested_currency', 'order_id'))
+        if not rows:
+            return cleanups
+        QuickpayPayment.objects.filter(pk__in=[pk for pk, _, _, _ in rows]).delete()
+        result.payments += len(rows)
+        cleanups.extend((cancel_payment_link, (qp_id, currency)) for _, qp_id, currency, _ in rows if qp_id)
+
+        if _has_membership_id():
+            order_ids = {order_id for _, _, _, order_id in rows}
+            orders = (Order.objects.select_for_update()
+                      .filter(pk__in=order_ids)
+                      .exclude(pk__in=QuickpayPayment.objects.filter(order_id__in=order_ids).values('order_id')))
+            subscription_orders = [order for order in orders if has_unpaid_subscription(order)]
+            if subscription_orders:
+                field = Order._meta.get_field('membership_id')
+                Order.objects.filter(pk__in=[order.pk for order in subscription_orders]).update(
+                    membership_id=None if field.null else '')
+                result.subscriptions += len(subscription_orders)
+                cleanups.extend((cancel_subscription, (order.membership_id, order_currency(order)))
+                                for order in subscription_orders)
+    return cleanups
+
+
+def _clean_up(cleanup: Tuple[Callable, tuple], limiter: Optional[TokenBucket]) -> bool:
+    """Make a Quickpay cleanup call. Return whether it succeeded"""
+    function, args = cleanup
+    if limiter is not None:
+        limiter.acquire()
+    try:
+        with priority(BATCH):
+            function(*args)
+        return True
+    except ApiError as e:
+        logging.warning("cartridge_quickpay.purge: %s%s failed: %s", function.__name__, args, e.body)
+    except Exception:  # Network errors etc. must not stop the purge
+        logging.exception("cartridge_quickpay.purge: %s%s failed", function.__name__, args)
+    return False
+
+
+def _has_membership_id() -> bool:
+    """Whether orders have Quickpay subscriptions"""
+    try:
+        Order._meta.get_field('membership_id')
+        return True
+    except FieldDoesNotExist:
+        return False
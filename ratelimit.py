@@ -0,0 +1,274 @@
+"""Rate limiting of calls to Quickpay
+
+TokenBucket limits the calls of a single run, e.g. a bulk operation, within one process.
+
+With QUICKPAY_RATE_LIMIT, all Quickpay calls of the shop share a token bucket across processes: the buckets state
+is kept in a file locked with flock (the processes of one node) or in a database row (all nodes). Every call made
+by QuickpayClient and the asyncio client takes a token first.
+
+Calls are made in one of two lanes:
+
+- interactive, the default, e.g. checkout and callbacks. May take any token, and waits at most
+  QUICKPAY_RATE_LIMIT_MAX_WAIT seconds (or until the deadline, see resilience.py) before calling anyway.
+- batch, e.g. bulk operations, renewals and synchronization. Only takes a token while more than
+  QUICKPAY_RATE_LIMIT_RESERVE tokens are left, and waits for as long as it takes. So batch jobs only use the
+  capacity interactive calls leave over, and interactive calls always find tokens after a quiet moment.
+
+Code runs its calls in the batch lane with:
+
+    with priority(BATCH):
+        ...
+
+The lane is kept in a contextvar, so it applies to the current thread or asyncio task. Threads started in the
+block, e.g. by a ThreadPoolExecutor, must enter the lane themselves.
+
+SETTINGS:
+    QUICKPAY_RATE_LIMIT          = Quickpay calls per second shared by all processes, default None for no limit
+    QUICKPAY_RATE_LIMIT_BURST    = Max. tokens saved up, default the rate per second (at least 1)
+    QUICKPAY_RATE_LIMIT_RESERVE  = Tokens batch calls leave for interactive calls, default half the burst
+    QUICKPAY_RATE_LIMIT_MAX_WAIT = Max. seconds an interactive call waits for a token, default 2
+    QUICKPAY_RATE_LIMIT_STORE    = 'file' (processes of one node, default) or 'database' (all nodes)
+    QUICKPAY_RATE_LIMIT_FILE     = Path of the file for 'file', default cartridge_quickpay_ratelimit in the temp dir
+    QUICKPAY_RATE_LIMIT_DATABASE = Database alias for 'database', default 'default'. Use an alias of its own
+                                   for the same database, so the bucket's row isn't locked until the caller's
+                                   transaction ends when Quickpay is called inside transaction.atomic()
+"""
+import contextvars
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional, Tuple
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import metrics
+
+
+__author__ = 'jfk@metation.dk'
+
+
+class TokenBucket:
+    """Thread safe token bucket allowing rate calls per second on average, bursts of up to burst calls"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token. Wait until one is available"""
+        while True:
+            with self.lock:
+                timestamp = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (timestamp - self.updated) * self.rate)
+                self.updated = timestamp
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# -- Lanes
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+_lane = contextvars.ContextVar('quickpay_lane', default=INTERACTIVE)  # type: contextvars.ContextVar
+
+
+@contextmanager
+def priority(lane: str):
+    """Make the Quickpay calls in the block in lane INTERACTIVE or BATCH"""
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def current_lane() -> str:
+    return _lane.get()
+
+
+# -- Shared token bucket
+
+# Bucket state (tokens, time of last update), None if the bucket is new
+State = Optional[Tuple[float, float]]
+
+
+class FileStore:
+    """Bucket state in a file locked with flock. Shared by the processes of a node"""
+
+    _FORMAT = '=dd'
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None  # type: Optional[int]
+        self._pid = None  # type: Optional[int]
+        self._lock = threading.Lock()
+
+    def update(self, f: Callable[[State], Tuple[State, float]]) -> float:
+        """Replace the state by f(state)[0] while the file is locked. Return f(state)[1]"""
+        import fcntl
+
+        with self._lock:  # flock doesn't exclude the threads of a process
+            if self._pid != os.getpid():
+                # Locks are shared with the file descriptor, so a forked child opens the file again
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+                self._pid = os.getpid()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                data = os.pread(self._fd, struct.calcsize(self._FORMAT), 0)
+                state = struct.unpack(self._FORMAT, data) if len(data) == struct.calcsize(self._FORMAT) else None
+                state, result = f(state)
+                os.pwrite(self._fd, struct.pack(self._FORMAT, *state), 0)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return result
+
+
+class DatabaseStore:
+    """Bucket state in a QuickpayRateLimit row. Shared by all nodes"""
+
+    def __init__(self, name: str, using: str = 'default'):
+        self.name = name
+        self.using = using
+
+    def update(self, f: Callable[[State], Tuple[State, float]]) -> float:
+        from django.db import IntegrityError, transaction
+        from .models import QuickpayRateLimit
+
+        with transaction.atomic(using=self.using):
+            rows = QuickpayRateLimit.objects.using(self.using).select_for_update().filter(name=self.name)
+            row = rows.first()
+            if row is None:
+                try:
+                    with transaction.atomic(using=self.using):
+                        QuickpayRateLimit.objects.using(self.using).create(name=self.name, tokens=0, updated=0)
+                except IntegrityError:
+                    pass  # Created concurrently
+                row = rows.get()
+                state = None
+            else:
+                state = (row.tokens, row.updated)
+            (row.tokens, row.updated), result = f(state)
+            row.save(using=self.using, update_fields=['tokens', 'updated'])
+        return result
+
+
+class SharedTokenBucket:
+    """Token bucket in a store shared by processes, with interactive and batch lanes"""
+
+    def __init__(self, store, rate: float, burst: float, reserve: float):
+        self.store = store
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.reserve = min(reserve, self.burst - 1)
+
+    def take(self, lane: str) -> float:
+        """Take a token in the lane if there is one. Return 0 if taken, else the seconds until there may be one"""
+        floor = self.reserve if lane == BATCH else 0
+
+        def take_token(state: State) -> Tuple[State, float]:
+            timestamp = time.time()
+            tokens = self.burst if state is None else min(self.burst,
+                                                          state[0] + max(timestamp - state[1], 0) * self.rate)
+            if tokens >= floor + 1:
+                return (tokens - 1, timestamp), 0.0
+            return (tokens, timestamp), (floor + 1 - tokens) / self.rate
+
+        return self.store.update(take_token)
+
+
+_limiter = None  # type: Optional[SharedTokenBucket]
+_limiter_lock = threading.Lock()
+
+
+def get_limiter() -> Optional[SharedTokenBucket]:
+    """The shared token bucket from the settings, None if QUICKPAY_RATE_LIMIT isn't set"""
+    global _limiter
+    rate = getattr(settings, 'QUICKPAY_RATE_LIMIT', None)
+    if not rate:
+        return None
+    with _limiter_lock:
+        if _limiter is None:
+            burst = getattr(settings, 'QUICKPAY_RATE_LIMIT_BURST', None) or max(rate, 1)
+            reserve = getattr(settings, 'QUICKPAY_RATE_LIMIT_RESERVE', None)
+            if getattr(settings, 'QUICKPAY_RATE_LIMIT_STORE', 'file') == 'database':
+                store = DatabaseStore('quickpay', getattr(settings, 'QUICKPAY_RATE_LIMIT_DATABASE', 'default'))
+            else:
+                store = FileStore(getattr(settings, 'QUICKPAY_RATE_LIMIT_FILE', None) or
+                                  os.path.join(tempfile.gettempdir(), 'cartridge_quickpay_ratelimit'))
+            _limiter = SharedTokenBucket(store, rate, burst, burst / 2 if reserve is None else reserve)
+        return _limiter
+
+
+def _max_wait(lane: str) -> Optional[float]:
+    """Max. seconds to wait for a token in the lane, None for no limit"""
+    if lane == BATCH:
+        return None
+    from .resilience import time_left
+    max_wait = getattr(settings, 'QUICKPAY_RATE_LIMIT_MAX_WAIT', 2)
+    left = time_left()
+    return max_wait if left is None else max(min(max_wait, left), 0)
+
+
+def acquire():
+    """Take a token from the shared bucket for a Quickpay call in the current lane. Wait if there is none"""
+    limiter = get_limiter()
+    if limiter is None:
+        return
+    lane = current_lane()
+    max_wait = _max_wait(lane)
+    start = time.monotonic()
+    while True:
+        wait = limiter.take(lane)
+        waited = time.monotonic() - start
+        if not wait:
+            break
+        if max_wait is not None and waited + wait > max_wait:
+            logging.warning("cartridge_quickpay.ratelimit: no token after %.1f s, calling Quickpay anyway", waited)
+            break
+        time.sleep(wait)
+    metrics.rate_limit_wait.observe(time.monotonic() - start, lane=lane)
+
+
+async def aacquire():
+    """Asyncio version of acquire()"""
+    import asyncio
+    from asgiref.sync import sync_to_async
+
+    limiter = get_limiter()
+    if limiter is None:
+        return
+    lane = current_lane()
+    max_wait = _max_wait(lane)
+    start = time.monotonic()
+    while True:
+        wait = await sync_to_async(limiter.take)(lane)
+        waited = time.monotonic() - start
+        if not wait:
+            break
+        if max_wait is not None and waited + wait > max_wait:
+            logging.warning("cartridge_quickpay.ratelimit: no token after %.1f s, calling Quickpay anyway", waited)
+            break
+        await asyncio.sleep(wait)
+    metrics.rate_limit_wait.observe(time.monotonic() - start, lane=lane)
+
+
+@receiver(setting_changed)
+def _reset_limiter(setting, **kwargs):
+    """Make a new limiter when settings are changed in tests"""
+    global _limiter
+    if setting.startswith('QUICKPAY_RATE_LIMIT'):
+        with _limiter_lock:
+            _limiter = None
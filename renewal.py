@@ -0,0 +1,133 @@
+"""Parallel renewal of subscriptions
+
+    from cartridge_quickpay.renewal import run_renewals
+    report = run_renewals(window=3600, concurrency=8)
+
+Renews the due subscriptions (cartridge_subscription) and starts the recurring Quickpay payments without
+'synchronized', so Quickpay doesn't wait for the acquirer. The payments are completed by the callbacks.
+Renewals are started evenly over the window and at most concurrency renewals run at a time. The Quickpay calls are
+made in the batch lane of the shared rate limit (see ratelimit.py).
+
+Also available as the quickpay_renew_subscriptions management command.
+
+SETTINGS:
+    QUICKPAY_RENEWAL_QUERYSET = Dotted path to a function returning the queryset of subscriptions to consider for
+                                renewal. Default authorized subscriptions with a Quickpay subscription. Whether
+                                each one is due is decided by Subscription.renew(). Make the function filter on
+                                an indexed due date if the subscription model has one.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Optional
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import Q, QuerySet
+from mezzanine.conf import settings
+from mezzanine.utils.importing import import_dotted_path
+
+from .bulk import close_worker_connections
+from .payment import capture_subscription_order, Subscription
+from .ratelimit import BATCH, priority
+
+
+__author__ = 'jfk@metation.dk'
+
+
+class RenewalReport:
+    """Outcome of a renewal run"""
+
+    def __init__(self):
+        self.subscriptions = 0
+        self.renewed = 0
+        self.not_due = 0
+        self.failed = 0
+        self.errors = {}  # type: Dict[int, str]  # subscription id -> error message
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Subscriptions handled per second"""
+        return (self.renewed + self.not_due + self.failed) / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return ("{} subscriptions: {} renewed, {} not due, {} failed in {:.1f} s ({:.1f}/s)"
+                .format(self.subscriptions, self.renewed, self.not_due, self.failed, self.elapsed, self.throughput))
+
+
+def renewal_candidates() -> QuerySet:
+    """Subscriptions to consider for renewal. Not only the due ones: by default all authorized subscriptions with a
+    Quickpay subscription, and Subscription.renew() skips those that aren't due. See QUICKPAY_RENEWAL_QUERYSET"""
+    if Subscription is None:
+        raise ImproperlyConfigured("cartridge_subscription is required for subscription renewal")
+    path = getattr(settings, 'QUICKPAY_RENEWAL_QUERYSET', None)
+    if path:
+        return import_dotted_path(path)()
+    return (Subscription.objects
+            .filter(is_authorized=True)
+            .exclude(Q(membership_id__isnull=True) | Q(membership_id='')))
+
+
+def run_renewals(subscriptions: Optional[QuerySet] = None, window: float = 0, concurrency: int = 8,
+                 from_time: Optional[datetime] = None) -> RenewalReport:
+    """Renew the subscriptions that are due and start their recurring payments.
+
+    # Args:
+    subscriptions : QuerySet | None = Subscriptions to consider, default renewal_candidates()
+    window : float = Seconds to spread the renewals over
+    concurrency : int = Max. renewals in progress at a time
+    from_time : datetime | None = Passed to Subscription.renew()
+    """
+    if subscriptions is None:
+        subscriptions = renewal_candidates()
+    subscription_ids = list(subscriptions.order_by('pk').values_list('pk', flat=True))
+    report = RenewalReport()
+    report.subscriptions = len(subscription_ids)
+    if not subscription_ids:
+        return report
+
+    spacing = window / len(subscription_ids)
+    slots = threading.BoundedSemaphore(concurrency)
+    report_lock = threading.Lock()
+
+    def renew(subscription_id: int):
+        try:
+            outcome, error = _renew_one(subscription_id, from_time)
+        finally:
+            slots.release()
+        with report_lock:
+            setattr(report, outcome, getattr(report, outcome) + 1)
+            if error is not None:
+                report.errors[subscription_id] = error
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i, subscription_id in enumerate(subscription_ids):
+            delay = start + i * spacing - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            slots.acquire()
+            executor.submit(renew, subscription_id)
+        close_worker_connections(executor, concurrency)
+    report.elapsed = time.monotonic() - start
+    logging.info("cartridge_quickpay.renewal: %s", report)
+    return report
+
+
+def _renew_one(subscription_id: int, from_time: Optional[datetime]):
+    """Renew one subscription. Return (outcome, error message or None), outcome is the report counter"""
+    try:
+        subscription = Subscription.objects.get(pk=subscription_id)
+        order = subscription.renew(None, from_time)
+        if order is None:
+            return 'not_due', None
+        with priority(BATCH):
+            capture_subscription_order(order, synchronized=False)  # Finished in callback
+        return 'renewed', None
+    except Exception as e:
+        logging.exception("cartridge_quickpay.renewal: renewal of subscription %s failed", subscription_id)
+        connection.close()  # May be broken
+        return 'failed', str(e)
@@ -0,0 +1,230 @@
+"""Timeouts, deadlines, retries and a circuit breaker for Quickpay API calls
+
+QuickpayClient (and the asyncio client) make every API call through these rules, so a slow or failing Quickpay
+doesn't tie up the shop's workers:
+
+- Each endpoint has its own (connect, read) timeout, e.g. short ones for the calls made during checkout.
+- Code running with deadline(seconds) gets at most that long for all its Quickpay calls together. The
+  checkout views run with QUICKPAY_CHECKOUT_DEADLINE. A call is never started after the deadline, and its read
+  timeout is cut to the time left.
+- Idempotent calls are retried with jittered exponential backoff after network errors, 429 and 5xx responses:
+  GETs, and the PUTs creating a payment or subscription link, which Quickpay replaces for the same payment.
+  Other calls, e.g. creating payments and captures, are never retried.
+- A circuit breaker per agreement counts network errors, 429 and 5xx responses. When at least
+  QUICKPAY_BREAKER_MIN_CALLS calls were made in the last QUICKPAY_BREAKER_WINDOW seconds and the share of
+  errors reached QUICKPAY_BREAKER_THRESHOLD, calls fail right away for QUICKPAY_BREAKER_COOLDOWN seconds. Then a
+  single trial call is let through, which closes the circuit if it succeeds.
+
+Calls refused by the circuit breaker or the deadline, and calls that didn't get an answer, raise
+QuickpayUnavailable, a CheckoutError. Error responses from Quickpay still raise ApiError.
+
+SETTINGS:
+    QUICKPAY_TIMEOUTS           = (connect, read) timeout in seconds per endpoint, e.g.
+                                  {'/payments/:id/link': (3, 10)}. Merged with DEFAULT_TIMEOUTS, other endpoints
+                                  use QUICKPAY_CONNECT_TIMEOUT and QUICKPAY_READ_TIMEOUT
+    QUICKPAY_CHECKOUT_DEADLINE  = Seconds for all Quickpay calls of a checkout, default 15
+    QUICKPAY_RETRIES            = Retries of idempotent calls, default 2
+    QUICKPAY_RETRY_BACKOFF      = Max. seconds before the first retry, doubled for each retry, default 0.2
+    QUICKPAY_BREAKER_THRESHOLD  = Share of failed calls opening the circuit, default 0.5
+    QUICKPAY_BREAKER_MIN_CALLS  = Calls in the window before the circuit may open, default 20
+    QUICKPAY_BREAKER_WINDOW     = Seconds of calls counted, default 30
+    QUICKPAY_BREAKER_COOLDOWN   = Seconds the circuit stays open before a trial call, default 10
+"""
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.translation import gettext as _
+from cartridge.shop.checkout import CheckoutError
+
+from . import metrics
+
+
+__author__ = 'jfk@metation.dk'
+
+
+class QuickpayUnavailable(CheckoutError):
+    """Quickpay didn't answer in time, or is failing so the call wasn't made"""
+
+
+# (connect, read) timeouts of the calls made while the customer waits
+DEFAULT_TIMEOUTS = {
+    '/payments': (3, 10),
+    '/payments/:id/link': (3, 10),
+    '/subscriptions': (3, 10),
+    '/subscriptions/:id/link': (3, 10),
+}
+
+_IDEMPOTENT_PUTS = ('/payments/:id/link', '/subscriptions/:id/link')
+
+
+def endpoint_timeout(endpoint: str, default: Tuple[float, float]) -> Tuple[float, float]:
+    """(connect, read) timeout of an endpoint, e.g. '/payments/:id/link'"""
+    timeouts = getattr(settings, 'QUICKPAY_TIMEOUTS', None) or {}
+    return tuple(timeouts.get(endpoint) or DEFAULT_TIMEOUTS.get(endpoint) or default)
+
+
+def is_idempotent(method: str, endpoint: str) -> bool:
+    """Whether a call may be repeated with the same effect"""
+    return method == 'get' or (method == 'put' and endpoint in _IDEMPOTENT_PUTS)
+
+
+def is_failure(status: int) -> bool:
+    """Whether a response status means Quickpay is failing, as opposed to refusing the request"""
+    return status == 429 or status >= 500
+
+
+def no_answer() -> QuickpayUnavailable:
+    """Error for a call that got no answer from Quickpay"""
+    return QuickpayUnavailable(_("The payment service didn't answer, please try again"))
+
+
+def max_retries() -> int:
+    return getattr(settings, 'QUICKPAY_RETRIES', 2)
+
+
+def retry_delay(attempt: int) -> float:
+    """Seconds to wait before retry number attempt (1, 2, ...). Random so clients don't retry in step"""
+    return random.uniform(0, getattr(settings, 'QUICKPAY_RETRY_BACKOFF', 0.2) * 2 ** (attempt - 1))
+
+
+# -- Deadlines
+
+_deadline = contextvars.ContextVar('quickpay_deadline', default=None)  # type: contextvars.ContextVar
+
+
+@contextmanager
+def deadline(seconds: Optional[float]):
+    """Give the Quickpay calls made in the block seconds altogether. A deadline set outside is kept if it's
+    earlier. None for no deadline"""
+    if seconds is None:
+        yield
+        return
+    ends = time.monotonic() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(ends if outer is None else min(ends, outer))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left() -> Optional[float]:
+    """Seconds left until the deadline, None if there is none"""
+    ends = _deadline.get()
+    return None if ends is None else ends - time.monotonic()
+
+
+def call_timeout(timeout: Tuple[float, float]) -> Tuple[float, float]:
+    """Timeout of a call starting now: timeout, cut to the time left. Raise QuickpayUnavailable if none is left"""
+    left = time_left()
+    if left is None:
+        return timeout
+    if left <= 0:
+        metrics.circuit_breaker.inc(event='deadline_exceeded')
+        raise QuickpayUnavailable(_("The payment service didn't answer in time, please try again"))
+    return min(timeout[0], left), min(timeout[1], left)
+
+
+def may_wait(seconds: float) -> bool:
+    """Whether there's time to wait seconds and still make a call before the deadline"""
+    left = time_left()
+    return left is None or left > seconds
+
+
+# -- Circuit breaker
+
+class CircuitBreaker:
+    """Thread safe circuit breaker. Counts calls and failures per second over a sliding window"""
+
+    def __init__(self, threshold: float = 0.5, min_calls: int = 20, window: float = 30, cooldown: float = 10):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.opened_at = None  # type: Optional[float]
+        self._trial = False  # Whether the trial call after the cooldown is running
+        self._buckets = deque()  # type: Deque[List[int]]  # [second, calls, failures]
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def before_call(self) -> bool:
+        """Raise QuickpayUnavailable if the call may not be made. Return whether it is the trial call"""
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            if not self._trial and time.monotonic() - self.opened_at >= self.cooldown:
+                self._trial = True
+                return True
+        metrics.circuit_breaker.inc(event='rejected')
+        raise QuickpayUnavailable(_("The payment service is unavailable, please try again later"))
+
+    def record(self, ok: bool, trial: bool = False):
+        """Record the outcome of a call. trial as returned by before_call()"""
+        timestamp = time.monotonic()
+        with self._lock:
+            if self.opened_at is not None:
+                if not trial:
+                    return  # Call started before the circuit opened
+                self._trial = False
+                if ok:
+                    self.opened_at = None
+                    self._buckets.clear()
+                    metrics.circuit_breaker.inc(event='closed')
+                else:
+                    self.opened_at = timestamp
+                return
+
+            second = int(timestamp)
+            if not self._buckets or self._buckets[-1][0] != second:
+                self._buckets.append([second, 0, 0])
+            self._buckets[-1][1] += 1
+            self._buckets[-1][2] += 0 if ok else 1
+            while self._buckets[0][0] <= second - self.window:
+                self._buckets.popleft()
+            if ok:
+                return
+            calls = sum(bucket[1] for bucket in self._buckets)
+            failures = sum(bucket[2] for bucket in self._buckets)
+            if calls >= self.min_calls and failures >= self.threshold * calls:
+                self.opened_at = timestamp
+                metrics.circuit_breaker.inc(event='opened')
+
+
+def make_breaker() -> CircuitBreaker:
+    """Circuit breaker with the settings"""
+    return CircuitBreaker(threshold=getattr(settings, 'QUICKPAY_BREAKER_THRESHOLD', 0.5),
+                          min_calls=getattr(settings, 'QUICKPAY_BREAKER_MIN_CALLS', 20),
+                          window=getattr(settings, 'QUICKPAY_BREAKER_WINDOW', 30),
+                          cooldown=getattr(settings, 'QUICKPAY_BREAKER_COOLDOWN', 10))
+
+
+_breakers = {}  # type: Dict[str, CircuitBreaker]
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(key: str) -> CircuitBreaker:
+    """The process-wide circuit breaker for key, e.g. an agreement's API key"""
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(key, make_breaker())
+    return breaker
+
+
+@receiver(setting_changed)
+def _reset_breakers(setting, **kwargs):
+    """Make new circuit breakers when settings are changed in tests"""
+    if setting.startswith('QUICKPAY_BREAKER_'):
+        with _breakers_lock:
+            _breakers.clear()
@@ -0,0 +1,104 @@
+"""Settlement summaries of accepted payments
+
+    from cartridge_quickpay.settlement import settlement_totals
+    settlement_totals(date(2024, 1, 1), date(2024, 1, 31), group_by=('date', 'currency'))
+
+QuickpaySettlement holds the number, requested amount and captured balance of accepted payments per day,
+currency, acquirer and state. A payment is counted on the day it was accepted, in the row of its current state.
+The rows are updated with the payment in the same transaction whenever a payment is saved, deleted or saved in
+bulk (callbacks, capture and refund, bulk operations and synchronization), so totals are read from a few rows per
+day instead of from all payments. What a payment counted before is read from its row, locked, in that transaction,
+so writers saving the same payment concurrently from stale copies don't make the rows drift.
+
+rebuild_settlements() recomputes the rows from the payments, e.g. after payments were changed by raw SQL. Payments
+are read in chunks, so memory is bounded by the number of rows. Payments changed while rebuilding may be counted
+in their old state, so rebuild when payments are quiet or rebuild the affected days again.
+
+Also available as the quickpay_rebuild_settlements management command.
+"""
+import logging
+from datetime import date, datetime, time
+from typing import Dict, List, Optional, Sequence
+
+from django.db import transaction
+from django.db.models import Sum
+from django.utils.timezone import get_current_timezone, make_aware
+from mezzanine.conf import settings
+
+from .bulk import payment_chunks
+from .currency import from_minor_units
+from .models import QuickpayPayment, QuickpaySettlement, SETTLEMENT_FIELDS, settlement_entry
+
+
+__author__ = 'jfk@metation.dk'
+
+
+GROUP_BY_FIELDS = ('date', 'currency', 'acquirer', 'state')
+
+
+def settlement_totals(start: date, end: date, group_by: Sequence[str] = ('currency',), currency: Optional[str] = None,
+                      acquirer: Optional[str] = None, state: Optional[str] = None) -> List[dict]:
+    """Totals of payments accepted from start to end, both included.
+
+    Returns a dict per group with the group_by fields, 'count', and 'requested_amount' and 'balance' in minor
+    units. When grouped by currency, also 'requested' and 'captured' as Decimal amounts.
+
+    # Args:
+    group_by : Sequence[str] = Fields of GROUP_BY_FIELDS to group by
+    currency, acquirer, state : str | None = Only payments with this currency, acquirer or state
+    """
+    unknown = set(group_by) - set(GROUP_BY_FIELDS)
+    if unknown:
+        raise ValueError("Can't group by {}".format(', '.join(sorted(unknown))))
+    rows = QuickpaySettlement.objects.filter(date__gte=start, date__lte=end)
+    if currency is not None:
+        rows = rows.filter(currency=currency)
+    if acquirer is not None:
+        rows = rows.filter(acquirer=acquirer)
+    if state is not None:
+        rows = rows.filter(state=state)
+    totals = list(rows.values(*group_by)
+                  .annotate(count=Sum('count'), requested_amount=Sum('requested_amount'), balance=Sum('balance'))
+                  .order_by(*group_by))
+    if 'currency' in group_by:
+        for total in totals:
+            total['requested'] = from_minor_units(total['requested_amount'], total['currency'])
+            total['captured'] = from_minor_units(total['balance'], total['currency'])
+    return totals
+
+
+def rebuild_settlements(since: Optional[date] = None, chunk_size: int = 2000) -> int:
+    """Recompute the settlement rows from the payments. Return the number of rows.
+
+    # Args:
+    since : date | None = Only rebuild the days from this day on, default all days
+    chunk_size : int = Payments read at a time
+    """
+    payments = QuickpayPayment.objects.filter(accepted_date__isnull=False).only(*SETTLEMENT_FIELDS)
+    if since is not None:
+        start = datetime.combine(since, time.min)
+        if settings.USE_TZ:
+            start = make_aware(start, get_current_timezone())
+        payments = payments.filter(accepted_date__gte=start)
+
+    totals = {}  # type: Dict[tuple, List[int]]
+    read = 0
+    for chunk in payment_chunks(payments, chunk_size):
+        for payment in chunk:
+            entry = settlement_entry(payment)
+            if entry is not None:
+                QuickpaySettlement.add_entry(totals, entry, 1)
+        read += len(chunk)
+        logging.debug("cartridge_quickpay.settlement: %d payments read", read)
+
+    rows = [QuickpaySettlement(date=key[0], currency=key[1], acquirer=key[2], state=key[3], count=count,
+                               requested_amount=requested_amount, balance=balance)
+            for key, (count, requested_amount, balance) in sorted(totals.items())]
+    with transaction.atomic():
+        existing = QuickpaySettlement.objects.all()
+        if since is not None:
+            existing = existing.filter(date__gte=since)
+        existing.delete()
+        QuickpaySettlement.objects.bulk_create(rows, batch_size=500)
+    logging.info("cartridge_quickpay.settlement: rebuilt %d rows from %d payments", len(rows), read)
+    return len(rows)
@@ -0,0 +1,368 @@
+"""In-memory Quickpay simulator for load testing
+
+The simulator answers the Quickpay API calls made by cartridge_quickpay without network access and sends
+signed callbacks to views.callback like Quickpay does. To run the shop against it:
+
+    QUICKPAY_TRANSPORT = 'cartridge_quickpay.simulator.SimulatorTransport'
+    QUICKPAY_SIMULATOR = {'latency': 0.05, 'error_rate': 0.01, 'decline_rate': 0.05, 'auto_pay': True}
+
+Payments go from 'initial' to 'new' when authorized (or 'rejected' when declined), to 'processed' when
+captured, and to 'rejected' when cancelled. Subscriptions go from 'initial' to 'active' when authorized and
+to 'cancelled' when cancelled; recurring payments can only be made on active subscriptions. Operations not
+allowed in the current state, and captures or refunds of more than is available, get a 400 response like
+Quickpay's validation errors.
+
+Callbacks are made from a pool of threads after each authorization, capture, refund, cancel and recurring
+payment. Failed callbacks are retried with backoff.
+
+SETTINGS:
+    QUICKPAY_SIMULATOR = Options of the process-wide simulator:
+        latency              = Mean seconds per API call, default 0. Calls take 0.5 to 1.5 times as long
+        error_rate           = Fraction of API calls answered with 503 Service Unavailable, default 0
+        decline_rate         = Fraction of authorizations and recurring payments declined, default 0
+        auto_pay             = Whether the customer pays each payment link right away, default False
+        pay_delay            = Seconds from link creation to payment when auto_pay is set, default 0
+        callbacks            = Whether to make callbacks, default True
+        callback_workers     = Threads making callbacks, default 4
+        callback_retries     = Retries of failed callbacks, default 3
+        callback_retry_delay = Seconds before the first retry, doubled for each retry, default 1
+"""
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.urls import reverse
+from django.db import connection
+from django.dispatch import receiver
+from django.test import RequestFactory
+
+from .agreements import get_agreement
+from .client import Transport
+
+
+__author__ = 'jfk@metation.dk'
+
+
+class SimulatorError(Exception):
+    """API call refused by the simulator"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+# Allowed states of each operation and the state after it
+PAYMENT_STATES = {
+    'authorize': (('initial',), 'new'),
+    'capture': (('new', 'processed'), 'processed'),
+    'refund': (('processed',), 'processed'),
+    'cancel': (('initial', 'new'), 'rejected'),
+}
+SUBSCRIPTION_STATES = {
+    'authorize': (('initial',), 'active'),
+    'cancel': (('initial', 'active'), 'cancelled'),
+}
+
+
+class QuickpaySimulator:
+    """Payments and subscriptions in memory with Quickpay's states and operations"""
+
+    LINK_URL = 'https://payment.quickpay.net/simulator/'
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, decline_rate: float = 0.0,
+                 auto_pay: bool = False, pay_delay: float = 0.0, callbacks: bool = True, callback_workers: int = 4,
+                 callback_retries: int = 3, callback_retry_delay: float = 1.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.decline_rate = decline_rate
+        self.auto_pay = auto_pay
+        self.pay_delay = pay_delay
+        self.callbacks = callbacks
+        self.callback_retries = callback_retries
+        self.callback_retry_delay = callback_retry_delay
+        self.resources = {}  # type: Dict[int, dict]
+        self.calls = 0
+        self.callbacks_sent = 0
+        self.callbacks_failed = 0
+        self._lock = threading.Lock()
+        self._next_id = 100000
+        self._executor = ThreadPoolExecutor(max_workers=callback_workers)
+        self._pending = 0
+        self._idle = threading.Condition(self._lock)
+
+    # -- Resources and operations
+
+    def create(self, type_: str = 'Payment', order_id: str = '', currency: str = 'DKK', **values) -> dict:
+        """Create a payment or subscription. Return a copy of the resource"""
+        with self._lock:
+            self._next_id += 1
+            resource = {
+                'id': self._next_id, 'order_id': order_id, 'type': type_, 'currency': currency,
+                'accepted': False, 'test_mode': True, 'text_on_statement': None, 'acquirer': 'clearhaus',
+                'state': 'initial', 'balance': 0, 'metadata': {'last4': '0008'}, 'operations': [], 'link': None,
+            }
+            resource.update(values)
+            self.resources[resource['id']] = resource
+            return _copy(resource)
+
+    def operate(self, qp_id: int, operation: str, amount: Optional[int] = None) -> dict:
+        """Apply an operation to a payment or subscription. Return a copy of the resource.
+        Raise SimulatorError if the operation isn't allowed"""
+        with self._lock:
+            resource = self.resources.get(qp_id)
+            if resource is None:
+                raise SimulatorError(404, 'Not found')
+            states = PAYMENT_STATES if resource['type'] == 'Payment' else SUBSCRIPTION_STATES
+            if operation not in states:
+                raise SimulatorError(404, 'Not found')
+            allowed, next_state = states[operation]
+            if resource['state'] not in allowed:
+                raise SimulatorError(400, "Validation error: {} not allowed in state {}"
+                                     .format(operation, resource['state']))
+            if operation == 'authorize':
+                if amount is None:
+                    amount = (resource['link'] or {}).get('amount', 0)
+                resource['authorized_amount'] = amount
+            elif operation == 'capture':
+                amount = resource['authorized_amount'] - resource['balance'] if amount is None else amount
+                if amount > resource['authorized_amount'] - resource['balance']:
+                    raise SimulatorError(400, "Validation error: amount exceeds authorized amount")
+                resource['balance'] += amount
+            elif operation == 'refund':
+                amount = resource['balance'] if amount is None else amount
+                if amount > resource['balance']:
+                    raise SimulatorError(400, "Validation error: amount exceeds captured amount")
+                resource['balance'] -= amount
+
+            declined = operation == 'authorize' and random.random() < self.decline_rate
+            if declined:
+                resource['state'] = 'rejected'
+            else:
+                resource['state'] = next_state
+                resource['accepted'] = resource['accepted'] or operation == 'authorize'
+            resource['operations'].append({
+                'id': len(resource['operations']) + 1, 'type': operation, 'amount': amount, 'pending': False,
+                'qp_status_code': '40000' if declined else '20000',
+                'qp_status_msg': 'Rejected By Acquirer' if declined else 'Approved',
+                'aq_status_code': '40000' if declined else '20000',
+                'aq_status_msg': 'Rejected' if declined else 'Approved'})
+            result = _copy(resource)
+        self.send_callback(qp_id)
+        return result
+
+    def create_link(self, qp_id: int, args: dict) -> dict:
+        """Create the payment link of a payment or subscription. The customer pays it if auto_pay is set"""
+        with self._lock:
+            resource = self.resources.get(qp_id)
+            if resource is None:
+                raise SimulatorError(404, 'Not found')
+            if resource['state'] != 'initial':
+                raise SimulatorError(400, "Validation error: payment link not allowed in state {}"
+                                     .format(resource['state']))
+            resource['link'] = dict(args, url='{}{}'.format(self.LINK_URL, qp_id))
+            link = {'url': resource['link']['url']}
+        if self.auto_pay:
+            self._submit(self.pay, qp_id, delay=self.pay_delay)
+        return link
+
+    def pay(self, qp_id: int):
+        """Customer completes the payment window of the payment or subscription"""
+        try:
+            resource = self.operate(qp_id, 'authorize')
+            if resource['accepted'] and resource['type'] == 'Payment' and resource['link'].get('auto_capture'):
+                self.operate(qp_id, 'capture')
+        except SimulatorError as e:
+            logging.warning("cartridge_quickpay.simulator: payment of %s failed: %s", qp_id, e.message)
+
+    def recurring(self, subscription_id: int, args: dict) -> dict:
+        """Make a recurring payment on an active subscription"""
+        with self._lock:
+            subscription = self.resources.get(subscription_id)
+            if subscription is None:
+                raise SimulatorError(404, 'Not found')
+            if subscription['type'] != 'Subscription' or subscription['state'] != 'active':
+                raise SimulatorError(400, "Validation error: subscription is not active")
+            currency = subscription['currency']
+        payment = self.create('Payment', args.get('order_id', ''), currency, subscription_id=subscription_id)
+        payment = self.operate(payment['id'], 'authorize', args.get('amount'))
+        if payment['accepted'] and args.get('auto_capture'):
+            payment = self.operate(payment['id'], 'capture')
+        return payment
+
+    # -- API calls
+
+    def handle(self, method: str, path: str, args: dict) -> Tuple[int, object]:
+        """Answer an API call. Return (status, JSON result or None)"""
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency * random.uniform(0.5, 1.5))
+        if self.error_rate and random.random() < self.error_rate:
+            return 503, {'message': 'Service Unavailable'}
+        try:
+            return self._route(method, path.rstrip('/'), args)
+        except SimulatorError as e:
+            return e.status, {'message': e.message}
+
+    def _route(self, method: str, path: str, args: dict) -> Tuple[int, object]:
+        parts = path.strip('/').split('/')
+        if parts[0] not in ('payments', 'subscriptions') or len(parts) > 3:
+            raise SimulatorError(404, 'Not found')
+        type_ = 'Payment' if parts[0] == 'payments' else 'Subscription'
+        if len(parts) == 1:
+            if method == 'post':
+                return 201, self.create(type_, args.get('order_id', ''), args.get('currency', 'DKK'))
+            if method == 'get':
+                page, page_size = int(args.get('page', 1)), int(args.get('page_size', 20))
+                with self._lock:
+                    resources = sorted((r for r in self.resources.values() if r['type'] == type_),
+                                       key=lambda r: r['id'])
+                    return 200, [_copy(r) for r in resources[(page - 1) * page_size:page * page_size]]
+            raise SimulatorError(405, 'Method not allowed')
+
+        try:
+            qp_id = int(parts[1])
+        except ValueError:
+            raise SimulatorError(404, 'Not found')
+        with self._lock:
+            resource = self.resources.get(qp_id)
+            if resource is None or resource['type'] != type_:
+                raise SimulatorError(404, 'Not found')
+            if len(parts) == 2 and method == 'get':
+                return 200, _copy(resource)
+        action = parts[2] if len(parts) == 3 else None
+        if action == 'link' and method == 'put':
+            return 200, self.create_link(qp_id, args)
+        if action == 'link' and method == 'delete':
+            with self._lock:
+                resource['link'] = None
+            return 204, None
+        if action == 'recurring' and method == 'post':
+            return 202, self.recurring(qp_id, args)
+        if action in ('authorize', 'capture', 'refund', 'cancel') and method == 'post':
+            return 202, self.operate(qp_id, action, _int_or_none(args.get('amount')))
+        raise SimulatorError(404, 'Not found')
+
+    # -- Callbacks
+
+    def callback_body(self, qp_id: int) -> bytes:
+        """Body of Quickpay's callback for the current state of a resource"""
+        with self._lock:
+            return json.dumps(self.resources[qp_id]).encode('utf-8')
+
+    def send_callback(self, qp_id: int):
+        """Make the callback for the current state of a resource in the background"""
+        if self.callbacks:
+            self._submit(self._deliver, self.callback_body(qp_id))
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for scheduled payments and callbacks to finish. Return False on timeout"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def _submit(self, f, *args, delay: float = 0.0):
+        with self._lock:
+            self._pending += 1
+
+        def run():
+            try:
+                if delay:
+                    time.sleep(delay)
+                f(*args)
+            except Exception:
+                logging.exception("cartridge_quickpay.simulator: background task failed")
+            finally:
+                connection.close()  # Each worker thread has its own connection
+                with self._idle:
+                    self._pending -= 1
+                    self._idle.notify_all()
+        self._executor.submit(run)
+
+    def _deliver(self, body: bytes):
+        from .views import callback
+
+        resource = json.loads(body.decode('utf-8'))
+        agreement = get_agreement(resource['currency'])
+        headers = {'HTTP_QUICKPAY_CHECKSUM_SHA256': agreement.sign(body),
+                   'HTTP_QUICKPAY_RESOURCE_TYPE': resource['type']}
+        if agreement.account_id is not None:
+            headers['HTTP_QUICKPAY_ACCOUNT_ID'] = str(agreement.account_id)
+        for attempt in range(self.callback_retries + 1):
+            if attempt:
+                time.sleep(self.callback_retry_delay * 2 ** (attempt - 1))
+            try:
+                request = RequestFactory().post(reverse('quickpay_callback'), data=body,
+                                                content_type='application/json', **headers)
+                if callback(request).status_code == 200:
+                    with self._lock:
+                        self.callbacks_sent += 1
+                    return
+            except Exception:
+                logging.exception("cartridge_quickpay.simulator: callback for %s failed", resource['id'])
+        with self._lock:
+            self.callbacks_failed += 1
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+def _copy(resource: dict) -> dict:
+    return json.loads(json.dumps(resource))
+
+
+def _int_or_none(value) -> Optional[int]:
+    return int(value) if value is not None else None
+
+
+class SimulatorTransport(Transport):
+    """Transport answering API calls with the process-wide simulator. For QUICKPAY_TRANSPORT"""
+
+    def __init__(self, pool_size: int = 10):
+        pass
+
+    def send(self, method, url, params, data, headers, timeout):
+        if 'Authorization' not in headers:
+            return 401, b'{"message": "Unauthorized"}', {'Content-Type': 'application/json'}
+        url = urlsplit(url)
+        args = dict(parse_qsl(url.query, keep_blank_values=True))
+        args.update(params or {})
+        if data:
+            args.update(json.loads(data.decode('utf-8')))
+        status, result = get_simulator().handle(method, url.path, args)
+        content = json.dumps(result).encode('utf-8') if result is not None else b''
+        return status, content, {'Content-Type': 'application/json'}
+
+
+_simulator = None  # type: Optional[QuickpaySimulator]
+_simulator_lock = threading.Lock()
+
+
+def get_simulator() -> QuickpaySimulator:
+    """Get the process-wide simulator. Made from QUICKPAY_SIMULATOR on first use"""
+    global _simulator
+    with _simulator_lock:
+        if _simulator is None:
+            _simulator = QuickpaySimulator(**getattr(settings, 'QUICKPAY_SIMULATOR', {}))
+        return _simulator
+
+
+def set_simulator(simulator: Optional[QuickpaySimulator]):
+    """Replace the process-wide simulator, e.g. by one with other options. None to make a new one on next use"""
+    global _simulator
+    with _simulator_lock:
+        _simulator = simulator
+
+
+@receiver(setting_changed)
+def _reset_simulator(setting, **kwargs):
+    """Make a new simulator when settings are changed in tests"""
+    if setting == 'QUICKPAY_SIMULATOR':
+        set_simulator(None)
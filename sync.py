@@ -0,0 +1,171 @@
+"""Incremental synchronization of payments with Quickpay
+
+    from cartridge_quickpay.sync import sync_payments
+    result = sync_payments()
+
+Pages through Quickpay's payment list, filtered to payments changed since the last run, and applies each
+payment to the local QuickpayPayment with the same Quickpay ID, unless the payment already has that state or a
+later one. Changed payments are saved in chunks with bulk updates, except those whose rows got a later state
+meanwhile, e.g. from a callback. The time of the last complete run is stored as a watermark, so nightly runs only
+fetch what changed since the night before. Payments unknown in the shop are ignored.
+
+Also available as the quickpay_sync management command.
+
+sync_selected_payments() synchronizes given payments instead, fetching each of them concurrently. It is used by
+the admin's sync action.
+
+The calls are made in the batch lane of the shared rate limit (see ratelimit.py).
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from django.db.models import QuerySet
+from django.utils.timezone import now
+from quickpay_api_client.exceptions import ApiError
+
+from .bulk import payment_chunks
+from .models import QuickpayPayment, QuickpayPaymentEvent, QuickpaySyncState, quickpay_client
+from .ratelimit import BATCH, priority
+
+
+__author__ = 'jfk@metation.dk'
+
+
+# Margin for clock differences between Quickpay and us and for payments changed during the run
+_WATERMARK_OVERLAP = timedelta(minutes=10)
+
+
+class SyncResult:
+    """Outcome of a synchronization run"""
+
+    def __init__(self):
+        self.requests = 0
+        self.fetched = 0
+        self.updated = 0
+        self.unknown = 0
+        self.failed = 0
+
+    @property
+    def done(self) -> int:
+        return self.fetched + self.failed
+
+    def __str__(self):
+        return ("{} payments fetched in {} requests, {} updated, {} unknown in the shop, {} failed"
+                .format(self.fetched, self.requests, self.updated, self.unknown, self.failed))
+
+
+def sync_payments(since: Optional[datetime] = None, full: bool = False, currency: Optional[str] = None,
+                  page_size: int = 100, chunk_size: int = 500) -> SyncResult:
+    """Synchronize payments changed in Quickpay since the watermark.
+
+    # Args:
+    since : datetime | None = Synchronize payments changed since this time instead of since the watermark
+    full : bool = Synchronize all payments
+    currency : str | None = Currency of the agreement to synchronize
+    page_size : int = Payments per request, max. 100
+    chunk_size : int = Payments saved at a time
+    """
+    state_name = 'payments:{}'.format(currency or '')
+    state, _ = QuickpaySyncState.objects.get_or_create(name=state_name)
+    if since is None and not full:
+        since = state.watermark
+    started = now()
+    client = quickpay_client(currency)
+    result = SyncResult()
+    changed = []  # type: List[QuickpayPayment]
+    events = []  # type: List[QuickpayPaymentEvent]
+
+    params = {'page_size': page_size, 'sort_by': 'id', 'sort_dir': 'asc'}
+    if since is not None:
+        params['min_time'] = since.isoformat()
+        params['time_attribute'] = 'updated_at'
+    page = 1
+    while True:
+        with priority(BATCH):
+            res = client.get('/payments', page=page, **params)
+        result.requests += 1
+        if not res:
+            break
+        result.fetched += len(res)
+        changed.extend(_apply_page(res, result, events))
+        if len(changed) >= chunk_size:
+            _save(changed, events)
+            changed, events = [], []
+        if len(res) < page_size:
+            break
+        page += 1
+    _save(changed, events)
+
+    QuickpaySyncState.objects.filter(pk=state.pk).update(watermark=started - _WATERMARK_OVERLAP)
+    logging.info("cartridge_quickpay.sync: %s", result)
+    return result
+
+
+def sync_selected_payments(payments: QuerySet, workers: int = 4, chunk_size: int = 100,
+                           progress: Optional[Callable[[SyncResult], None]] = None) -> SyncResult:
+    """Synchronize the given payments with Quickpay, one request per payment.
+
+    # Args:
+    payments : QuerySet = The payments, payments without a Quickpay ID are skipped
+    workers : int = Max. concurrent Quickpay calls
+    chunk_size : int = Payments read and saved at a time
+    progress : callable | None = Called with the result so far after each chunk
+    """
+    result = SyncResult()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in payment_chunks(payments.filter(qp_id__isnull=False), chunk_size):
+            fetched = list(executor.map(_fetch_payment, chunk))
+            result.requests += len(chunk)
+            result.failed += fetched.count(None)
+            page = [res for res in fetched if res is not None]
+            result.fetched += len(page)
+            events = []  # type: List[QuickpayPaymentEvent]
+            _save(_apply_page(page, result, events), events)
+            if progress is not None:
+                progress(result)
+    logging.info("cartridge_quickpay.sync: %s", result)
+    return result
+
+
+def _fetch_payment(payment: QuickpayPayment) -> Optional[dict]:
+    """Get a payment from Quickpay. None if it failed"""
+    try:
+        with priority(BATCH):
+            return quickpay_client(payment.requested_currency).get('/payments/{}'.format(payment.qp_id))
+    except ApiError as e:
+        logging.error("QuickPay API error: %s" % e.body)
+    except Exception:  # Network errors etc. must not stop the run
+        logging.exception("cartridge_quickpay.sync: fetching payment %s failed", payment.pk)
+    return None
+
+
+def _save(changed: List[QuickpayPayment], events: List[QuickpayPaymentEvent]):
+    # A callback or an operation may have saved a later state since the page was fetched
+    QuickpayPayment.bulk_save(changed, QuickpayPayment.QUICKPAY_FIELDS, later_only=True)
+    QuickpayPaymentEvent.record_many(events)
+
+
+def _apply_page(page: List[dict], result: SyncResult, events: List[QuickpayPaymentEvent]) -> List[QuickpayPayment]:
+    """Apply a page of Quickpay payments to the local payments. Return the payments that changed and add their
+    events to events"""
+    local: Dict[int, List[QuickpayPayment]] = {}
+    for payment in QuickpayPayment.objects.filter(qp_id__in=[res['id'] for res in page]):
+        local.setdefault(payment.qp_id, []).append(payment)
+    changed = []
+    for res in page:
+        payments = local.get(res['id'])
+        if not payments:
+            result.unknown += 1
+            continue
+        for payment in payments:
+            if payment.is_later_than(res):
+                continue
+            before = [getattr(payment, f) for f in QuickpayPayment.QUICKPAY_FIELDS]
+            payment.update_from_res(res)
+            if [getattr(payment, f) for f in QuickpayPayment.QUICKPAY_FIELDS] != before:
+                changed.append(payment)
+                events.append(QuickpayPaymentEvent.from_res(payment, res, QuickpayPaymentEvent.SOURCE_SYNC))
+                result.updated += 1
+    return changed
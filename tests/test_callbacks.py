@@ -0,0 +1,132 @@
+"""Ordering of callbacks, sync and retried callbacks for the same payment"""
+from decimal import Decimal
+from unittest import mock
+
+from django.test import TestCase
+from cartridge.shop.models import Order
+
+from cartridge_quickpay import views
+from cartridge_quickpay.models import QuickpayPayment, operation_sequence
+from cartridge_quickpay.simulator import QuickpaySimulator
+
+
+__author__ = 'jfk@metation.dk'
+
+
+def _save_order(request, order_form, order, payment=None):
+    order.save()
+
+
+class OperationSequenceTest(TestCase):
+
+    def test_no_operations(self):
+        self.assertEqual(operation_sequence({'operations': []}), 0)
+        self.assertEqual(operation_sequence({}), 0)
+
+    def test_grows_with_operations_and_completion(self):
+        authorize = {'id': 1, 'pending': False}
+        capture_pending = {'id': 2, 'pending': True}
+        capture = {'id': 2, 'pending': False}
+        sequences = [operation_sequence({'operations': operations}) for operations in
+                     ([authorize], [authorize, capture_pending], [authorize, capture])]
+        self.assertEqual(sequences, sorted(set(sequences)))
+
+
+class CallbackOrderingTest(TestCase):
+
+    def setUp(self):
+        self.simulator = QuickpaySimulator(callbacks=False)
+        self.order = Order.objects.create(total=Decimal('10.00'))
+        self.payment = QuickpayPayment.create_card_payment(self.order, Decimal('10.00'), 'DKK', '1234')
+        res = self.simulator.create('Payment', '%d_%06d' % (self.order.id, self.payment.id), 'DKK')
+        self.simulator.create_link(res['id'], {'amount': 1000})
+        self.payment.set_qp_id(res['id'])
+        patcher = mock.patch.object(views, 'order_handler', side_effect=_save_order)
+        self.order_handler = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.simulator.close()
+
+    def operate(self, operation: str) -> dict:
+        return self.simulator.operate(self.payment.qp_id, operation)
+
+    def reload(self) -> QuickpayPayment:
+        self.order.refresh_from_db()
+        return QuickpayPayment.objects.get(pk=self.payment.pk)
+
+    def test_is_later_than(self):
+        authorized = self.operate('authorize')
+        captured = self.operate('capture')
+        payment = self.reload()
+        self.assertFalse(payment.is_later_than(authorized))
+        payment.update_from_res(captured)
+        self.assertTrue(payment.is_later_than(authorized))
+        self.assertTrue(payment.is_later_than(captured))
+
+    def test_is_later_than_saved(self):
+        authorized = self.operate('authorize')
+        captured = self.operate('capture')
+        saved = self.reload()
+        self.assertTrue(self.reload().is_later_than_saved(saved))  # Nothing applied yet
+        saved.update_from_res(captured)
+        stale = self.reload()
+        stale.update_from_res(authorized)
+        self.assertFalse(stale.is_later_than_saved(saved))
+        self.assertFalse(saved.is_later_than_saved(saved))
+
+    def test_callback_after_sync(self):
+        """A payment synchronized before its callback arrives still gets its order processed by the callback"""
+        authorized = self.operate('authorize')
+        payment = self.reload()
+        payment.update_from_res(authorized)
+        payment.save()
+        self.assertFalse(QuickpayPayment.callback_applied(authorized))
+
+        views.process_callback(authorized)
+        payment = self.reload()
+        self.assertEqual(self.order.transaction_id, str(authorized['id']))
+        self.assertEqual(self.order_handler.call_count, 1)
+        self.assertTrue(payment.accepted)
+        self.assertEqual(payment.last_callback_seq, operation_sequence(authorized))
+
+    def test_duplicate_callback(self):
+        authorized = self.operate('authorize')
+        views.process_callback(authorized)
+        self.assertTrue(QuickpayPayment.callback_applied(authorized))
+
+        views.process_callback(authorized)
+        self.assertEqual(self.order_handler.call_count, 1)
+
+    def test_duplicate_callback_waiting_for_lock(self):
+        """A retry that passed callback_applied() before the first callback committed is dropped under the lock"""
+        authorized = self.operate('authorize')
+        views._process_callback(authorized)
+        views._process_callback(authorized)
+        self.assertEqual(self.order_handler.call_count, 1)
+        self.assertTrue(self.reload().accepted)
+
+    def test_older_callback_after_newer(self):
+        authorized = self.operate('authorize')
+        captured = self.operate('capture')
+        views.process_callback(captured)
+        self.assertTrue(QuickpayPayment.callback_applied(authorized))
+
+        views.process_callback(authorized)
+        payment = self.reload()
+        self.assertEqual(self.order_handler.call_count, 1)
+        self.assertEqual(payment.state, 'processed')
+        self.assertEqual(payment.balance, 1000)
+        self.assertEqual(payment.last_operation_seq, operation_sequence(captured))
+        self.assertEqual(payment.last_callback_seq, operation_sequence(captured))
+
+    def test_older_callback_waiting_for_lock(self):
+        """An older callback that passed callback_applied() doesn't write back the earlier state"""
+        authorized = self.operate('authorize')
+        captured = self.operate('capture')
+        views._process_callback(captured)
+        views._process_callback(authorized)
+        payment = self.reload()
+        self.assertEqual(self.order_handler.call_count, 1)
+        self.assertEqual(payment.state, 'processed')
+        self.assertEqual(payment.last_callback_seq, operation_sequence(captured))
@@ -0,0 +1,40 @@
+"""Amounts in minor units"""
+from decimal import Decimal
+
+from django.test import SimpleTestCase
+
+from cartridge_quickpay.currency import from_minor_units, minor_unit_decimals, to_minor_units
+
+
+__author__ = 'jfk@metation.dk'
+
+
+class MinorUnitsTest(SimpleTestCase):
+
+    def test_two_decimals(self):
+        self.assertEqual(to_minor_units(Decimal('12.50'), 'DKK'), 1250)
+        self.assertEqual(to_minor_units(Decimal('12.50'), 'eur'), 1250)
+
+    def test_zero_decimals(self):
+        self.assertEqual(minor_unit_decimals('JPY'), 0)
+        self.assertEqual(to_minor_units(Decimal('1250'), 'JPY'), 1250)
+        self.assertEqual(to_minor_units(Decimal('1250'), 'ISK'), 1250)
+        self.assertEqual(from_minor_units(1250, 'ISK'), Decimal('1250'))
+
+    def test_three_decimals(self):
+        self.assertEqual(minor_unit_decimals('KWD'), 3)
+        self.assertEqual(to_minor_units(Decimal('12.345'), 'KWD'), 12345)
+        self.assertEqual(to_minor_units(Decimal('0.5'), 'BHD'), 500)
+        self.assertEqual(from_minor_units(12345, 'BHD'), Decimal('12.345'))
+
+    def test_rounds_half_up(self):
+        self.assertEqual(to_minor_units(Decimal('12.345'), 'DKK'), 1235)
+        self.assertEqual(to_minor_units(Decimal('12.344'), 'DKK'), 1234)
+        self.assertEqual(to_minor_units(Decimal('12.5'), 'JPY'), 13)
+        self.assertEqual(to_minor_units(Decimal('13.5'), 'ISK'), 14)  # Not to even
+        self.assertEqual(to_minor_units(Decimal('1.0005'), 'KWD'), 1001)
+
+    def test_unknown_currency_has_two_decimals(self):
+        self.assertEqual(minor_unit_decimals('XYZ'), 2)
+        self.assertEqual(to_minor_units(Decimal('12.50'), 'XYZ'), 1250)
+        self.assertEqual(from_minor_units(1250, 'XYZ'), Decimal('12.50'))
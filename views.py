@@ -5,8 +5,10 @@ from django.template.response import TemplateResponse
 from django.shortcuts import redirect, render
 from django.utils.timezone import now
 from django.views.decorators.csrf import csrf_exempt
-from django.core.urlresolvers import reverse
+from django.core.exceptions import NON_FIELD_ERRORS
+from django.urls import reverse
 from django.db import transaction
+from django.db.models import Q
 
 from mezzanine.conf import settings
 from mezzanine.utils.importing import import_dotted_path
@@ -14,15 +16,21 @@ from cartridge.shop import checkout
 from cartridge.shop.models import Order
 from cartridge.shop.forms import OrderForm
 
+import hashlib
+import hmac
 import json
 import logging
 import re
+from functools import lru_cache
 from urllib.parse import urlencode
-from typing import Callable, List, Optional
+from typing import Callable, List, Optional, Tuple
 
-from .payment import get_quickpay_link, sign, sign_order, start_subscription, capture_subscription_order, \
-     acquirer_requires_popup, acquirer_supports_subscriptions, order_currency
-from .models import QuickpayPayment, get_private_key
+from .payment import get_quickpay_link, sign_order, start_subscription, capture_subscription_order, \
+     acquirer_requires_popup, acquirer_supports_subscriptions, single_flight, quickpay_cache, \
+     verify_callback, callback_state_processed
+from .models import QuickpayPayment, QuickpayCallback, QuickpayPaymentEvent, operation_sequence
+from .resilience import QuickpayUnavailable, deadline
+from . import metrics
 
 
 handler = lambda s: import_dotted_path(s) if s else lambda *args: None
@@ -41,20 +49,22 @@ def quickpay_checkout(request: HttpRequest) -> HttpResponse:
     Settings:
 
     QUICKPAY_ORDER_FORM = dotted path to order form to use
-    QUICKPAY_FRAMED_MODE = <whether to use framed Quickpay>
+    QUICKPAY_FRAMED_MODE = <whether to use framed Quickpay>. An invalid form is answered with JSON: the rendered
+                           checkout page, or only the errors if the POST has compact=1 (see checkout_form_invalid())
 
     QUICKPAY_SHOP_BASE_URL: str required = URL of the shop for success, cancel and callback URLs
     QUICKPAY_ACQUIRER: str|list required = The acquirer(s) to use, e.g. 'clearhaus'
     QUICKPAY_AUTO_CAPTURE: bool default False = Whether to auto-capture payment
+    QUICKPAY_CHECKOUT_DEADLINE: float default 15 = Seconds for all Quickpay calls of the checkout
 
     urls.py setup:
 
     from cartridge_quickpay.views import checkout_quickpay, order_form_class
     ...
 
-    url("^shop/checkout/", checkout_steps, {'form_class': order_form_class}),
-    url("^shop/checkout_quickpay/", checkout_quickpay, name="checkout_quickpay"),
-    url("^shop/", include("cartridge.shop.urls")),
+    re_path("^shop/checkout/", checkout_steps, {'form_class': order_form_class}),
+    re_path("^shop/checkout_quickpay/", checkout_quickpay, name="checkout_quickpay"),
+    re_path("^shop/", include("cartridge.shop.urls")),
     ...
 
     ** FOR FRAMED MODE: **
@@ -90,76 +100,176 @@ def quickpay_checkout(request: HttpRequest) -> HttpResponse:
     }
     </script>
     """
-    framed: bool = getattr(settings, 'QUICKPAY_FRAMED_MODE', False)
     acquirer = request.POST.get('acquirer', None)
     logging.debug("quickpay_checkout: using acquirer {}".format(acquirer or '<any>'))
-    in_popup = acquirer_requires_popup(acquirer)
+    form, order = checkout_order(request)
+    if order is None:
+        return checkout_form_invalid(request, form)
+
+    try:
+        with deadline(checkout_deadline()):
+            # Handle subscription or one-time order
+            if is_subscription_checkout(order, acquirer):
+                quickpay_subs_id, quickpay_link = start_subscription(
+                    order, order.items.all().order_by('id')[0])
+                logging.debug("quickpay_checkout() - starting subscription {}, payment link {}"
+                              .format(quickpay_subs_id, quickpay_link))
+            else:
+                # One-time order OR subscription with acquirer that doesn't support subscriptions
+                quickpay_link: str = get_quickpay_link(order, acquirer)['url']
+                logging.debug("quickpay_checkout() - product purchase (or subscription w/o auto-renewal), "
+                              "payment link {}".format(quickpay_link))
+    except QuickpayUnavailable as e:
+        return checkout_unavailable(request, e)
+    return checkout_redirect(request, quickpay_link, acquirer)
+
+
+def checkout_deadline() -> float:
+    return getattr(settings, 'QUICKPAY_CHECKOUT_DEADLINE', 15)
+
+
+def checkout_order(request: HttpRequest) -> Tuple[OrderForm, Optional[Order]]:
+    """Validate the checkout form and create the Order. Return (form, order), order is None if form invalid"""
     step = checkout.CHECKOUT_STEP_FIRST  # Was: _LAST
-    checkout_errors = []
 
     initial = checkout.initial_order_data(request, order_form_class)
     logging.debug("quickpay_checkout: initial order data = {}".format(initial))
     form = order_form_class(request, step, initial=initial, data=request.POST)
-    if form.is_valid():
-        logging.debug("quickpay_checkout() - Form valid")
-        request.session["order"] = dict(form.cleaned_data)
-        try:
-            billship_handler(request, form)
-            tax_handler(request, form)
-        except checkout.CheckoutError as e:
-            logging.warn("quickpay_checkout() - billship or tax handler failed")
-            checkout_errors.append(e)
-
-        # Create order and Quickpay payment, redirect to Quickpay/Mobilepay form
+    if not form.is_valid():
+        return form, None
+
+    logging.debug("quickpay_checkout() - Form valid")
+    request.session["order"] = dict(form.cleaned_data)
+    try:
+        billship_handler(request, form)
+        tax_handler(request, form)
+    except checkout.CheckoutError as e:
+        # As in Cartridge's checkout, the order isn't made and the error is shown with the form
+        logging.warn("quickpay_checkout() - billship or tax handler failed")
+        form.add_error(None, str(e))
+        return form, None
+
+    # Create order and Quickpay payment, redirect to Quickpay/Mobilepay form
+    # A repeated checkout of the same cart with the same form data reuses the order made by the first one
+    reuse_ttl = getattr(settings, 'QUICKPAY_LINK_REUSE_TTL', 900)
+    if not reuse_ttl:
         order = form.save(commit=False)
         order.setup(request)  # Order is saved here so it gets an ID
-
-        # Handle subscription or one-time order
-        if (hasattr(order, 'has_subscription')
-                and order.has_subscription()
-                and acquirer_supports_subscriptions(acquirer)):
-            quickpay_subs_id, quickpay_link = start_subscription(
-                order, order.items.all().order_by('id')[0])
-            logging.debug("quickpay_checkout() - starting subscription {}, payment link {}"
-                          .format(quickpay_subs_id, quickpay_link))
-        else:
-            # One-time order OR subscription with acquirer that doesn't support subscriptions
-            quickpay_link: str = get_quickpay_link(order, acquirer)['url']
-            logging.debug("quickpay_checkout() - product purchase (or subscription w/o auto-renewal), payment link {}"
-                          .format(quickpay_link))
-
-        # Redirect to Quickpay
-        if framed:
-            logging.debug("quickpay_checkout() - JSON response {}"
-                          .format(str({'success': True, 'payment_link': quickpay_link})))
-            return JsonResponse({'success': True, 'payment_link': quickpay_link})
-            # Medsende om url skal åbnes i nyt vindue, åben i JS, håndtere at returside havner i iframe igen
-        elif in_popup:
-            logging.debug("quickpay_checkout() - Opening popup window")
-            return render(request, "cartridge_quickpay/payment_toplevel.html", {'quickpay_link': quickpay_link})
+        return form, order
+
+    cache_key = 'cartridge_quickpay:checkout:' + checkout_fingerprint(request, form)
+    with single_flight(cache_key):
+        order = recent_checkout_order(request, quickpay_cache().get(cache_key))
+        if order is None:
+            order = form.save(commit=False)
+            order.setup(request)  # Order is saved here so it gets an ID
+            quickpay_cache().set(cache_key, order.pk, reuse_ttl)
         else:
-            logging.debug("quickpay_checkout() - Redirect response")
-            return HttpResponseRedirect(redirect_to=quickpay_link)
+            logging.debug("quickpay_checkout() - repeated checkout, reusing order {}".format(order.pk))
+    return form, order
+
+
+def checkout_fingerprint(request: HttpRequest, form: OrderForm) -> str:
+    """Hash identifying a checkout: the session, the cart contents and the order form data"""
+    cart = request.cart
+    parts = [request.session.session_key, cart.pk, getattr(cart, 'last_updated', None), cart.total_price(),
+             sorted((k, str(v)) for k, v in form.cleaned_data.items()),
+             [request.session.get(k) for k in ('shipping_type', 'shipping_total', 'discount_code', 'discount_total',
+                                               'tax_type', 'tax_total')]]
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+def recent_checkout_order(request: HttpRequest, order_id: Optional[int]) -> Optional[Order]:
+    """Get the unpaid Order of the session with the given ID if any"""
+    if order_id is None:
+        return None
+    return (Order.objects
+            .filter(pk=order_id, key=request.session.session_key)
+            .filter(Q(transaction_id__isnull=True) | Q(transaction_id=''))
+            .first())
+
+
+def is_subscription_checkout(order: Order, acquirer: Optional[str]) -> bool:
+    """Whether to pay the order with a Quickpay subscription"""
+    return (hasattr(order, 'has_subscription')
+            and order.has_subscription()
+            and acquirer_supports_subscriptions(acquirer))
+
+
+def checkout_redirect(request: HttpRequest, quickpay_link: str, acquirer: Optional[str]) -> HttpResponse:
+    """Response sending the user to the Quickpay payment window"""
+    framed: bool = getattr(settings, 'QUICKPAY_FRAMED_MODE', False)
+    if framed:
+        logging.debug("quickpay_checkout() - JSON response {}"
+                      .format(str({'success': True, 'payment_link': quickpay_link})))
+        return JsonResponse({'success': True, 'payment_link': quickpay_link})
+        # Medsende om url skal åbnes i nyt vindue, åben i JS, håndtere at returside havner i iframe igen
+    elif acquirer_requires_popup(acquirer):
+        logging.debug("quickpay_checkout() - Opening popup window")
+        return render(request, "cartridge_quickpay/payment_toplevel.html", {'quickpay_link': quickpay_link})
+    else:
+        logging.debug("quickpay_checkout() - Redirect response")
+        return HttpResponseRedirect(redirect_to=quickpay_link)
+
+
+def checkout_unavailable(request: HttpRequest, error: QuickpayUnavailable) -> HttpResponse:
+    """Quickpay is failing or too slow, tell the user to try again later"""
+    logging.warning("quickpay_checkout() - Quickpay unavailable: %s", error)
+    if getattr(settings, 'QUICKPAY_FRAMED_MODE', False):
+        return JsonResponse({'success': False, 'error': str(error)}, status=503)
+    return failed(request)
+
+
+def checkout_form_invalid(request: HttpRequest, form: OrderForm) -> HttpResponse:
+    """Form invalid, go back to checkout step.
+
+    In framed mode, a POST with compact=1 gets only the errors instead of the rendered page:
+    {'success': False, 'errors': {<field name>: [<message>, ...]}, 'checkout_errors': [<message>, ...]}
+    """
+    framed: bool = getattr(settings, 'QUICKPAY_FRAMED_MODE', False)
+    if framed and request.POST.get('compact'):
+        logging.debug("quickpay_checkout() - Form not OK, compact JSON response")
+        return JsonResponse(form_errors(form))
+
+    template, step_context = checkout_step_page()
+    context = dict(step_context, form=form)
+    page = template.render(context=context, request=request)
+    if framed:
+        logging.debug("quickpay_checkout() - Form not OK, JSON response")
+        return JsonResponse({'success': False, 'page': page})
+    else:
+        logging.debug("quickpay_checkout() - Form not OK, page response")
+        return HttpResponse(page)
+
+
+def form_errors(form: OrderForm) -> dict:
+    """Errors of an invalid checkout form for the framed mode's compact JSON response"""
+    errors = {field: [str(message) for message in messages]
+              for field, messages in form.errors.items() if field != NON_FIELD_ERRORS}
+    return {'success': False, 'errors': errors, 'checkout_errors': [str(e) for e in form.non_field_errors()]}
 
 
-    # Form invalid, go back to checkout step
+@lru_cache(maxsize=1)
+def _checkout_step_page() -> Tuple[object, dict]:
+    step = checkout.CHECKOUT_STEP_FIRST
     step_vars = checkout.CHECKOUT_STEPS[step - 1]
-    template = "shop/%s.html" % step_vars["template"]
+    template = loader.get_template("shop/%s.html" % step_vars["template"])
     context = {"CHECKOUT_STEP_FIRST": step == checkout.CHECKOUT_STEP_FIRST,
                "CHECKOUT_STEP_LAST": step == checkout.CHECKOUT_STEP_LAST,
                "CHECKOUT_STEP_PAYMENT": (settings.SHOP_PAYMENT_STEP_ENABLED and
                    step == checkout.CHECKOUT_STEP_PAYMENT),
                "step_title": step_vars["title"], "step_url": step_vars["url"],
-               "steps": checkout.CHECKOUT_STEPS, "step": step, "form": form,
+               "steps": checkout.CHECKOUT_STEPS, "step": step,
                "payment_url": "https://payment.quickpay.net/d7ad25ea15154ef4bdffb5bf78f623fc"}
+    return template, context
 
-    page = loader.get_template(template).render(context=context, request=request)
-    if framed:
-        logging.debug("quickpay_checkout() - Form not OK, JSON response")
-        return JsonResponse({'success': False, 'page': page})
-    else:
-        logging.debug("quickpay_checkout() - Form not OK, page response")
-        return HttpResponse(page)
+
+def checkout_step_page() -> Tuple[object, dict]:
+    """(template, context without the form) of the checkout step shown for an invalid form. Loaded once per
+    process, except with DEBUG so template changes show up"""
+    if settings.DEBUG:
+        _checkout_step_page.cache_clear()
+    return _checkout_step_page()
 
 
 def escape_frame(f: Callable[[HttpRequest], HttpResponse]) -> Callable[[HttpRequest], HttpResponse]:
@@ -233,12 +343,12 @@ def success(request: HttpRequest) -> HttpResponse:
     else:
         order = Order.objects.from_request(request)  # Raises DoesNotExist if order not found
     order_hash = sign_order(order)
-    logging.debug("\n ---- payment_quickpay.views.success()\n\norder = %s, sign arg = %s, check sign = %s"
-                  % (order, request.GET.get('hash'), sign_order(order)))
-    logging.debug("data: {}".format(dict(request.GET)))
+    logging.debug("\n ---- payment_quickpay.views.success()\n\norder = %s, sign arg = %s, check sign = %s",
+                  order, request.GET.get('hash'), order_hash)
+    logging.debug("data: %s", request.GET)
 
     # Check hash.
-    if request.GET.get('hash') != order_hash:
+    if not hmac.compare_digest(request.GET.get('hash', '').encode('utf-8'), order_hash.encode('utf-8')):
         logging.warn("cartridge_quickpay:success - hash doesn't match order")
         return HttpResponseForbidden()
 
@@ -256,64 +366,103 @@ except ImportError:
 
 
 @csrf_exempt
-@transaction.atomic
 def callback(request: HttpRequest) -> HttpResponse:
-    """Callback from Quickpay. Register payment status in case it wasn't registered already"""
+    """Callback from Quickpay. Register payment status in case it wasn't registered already
+
+    The signature and the state are checked before any database access, so forged callbacks and callbacks in
+    states we skip are cheap."""
+    body = request.body
+    if not verify_callback(body, request.META.get('HTTP_QUICKPAY_CHECKSUM_SHA256'),
+                           request.META.get('HTTP_QUICKPAY_ACCOUNT_ID')):
+        logging.error('Quickpay callback: checksum failed, %d bytes from %s',
+                      len(body), request.META.get('REMOTE_ADDR'))
+        metrics.callbacks.inc(outcome='bad_signature')
+        return HttpResponseBadRequest()
+
+    data = json.loads(body.decode('utf-8'))
+    qp_state = data.get('state')
+    if not callback_state_processed(qp_state):
+        logging.debug("payment_quickpay.views.callback(): QP state is %s, skipping", qp_state)
+        metrics.callbacks.inc(outcome='skipped')
+        return HttpResponse("OK")
+    logging.debug("payment_quickpay.views.callback(): QP state is %s, processing", qp_state)
+
+    if getattr(settings, 'QUICKPAY_CALLBACK_INBOX', False):
+        # Leave processing to the quickpay_callback_worker command
+        if QuickpayCallback.enqueue(body, data):
+            metrics.callbacks.inc(outcome='queued')
+        else:
+            logging.debug("payment_quickpay.views.callback(): duplicate callback for %s", data.get('id'))
+            metrics.callbacks.inc(outcome='duplicate')
+        return HttpResponse("OK")
+
+    process_callback(data)
+    return HttpResponse("OK")
+
+
+def process_callback(data: dict):
+    """Process callback with verified signature"""
+    # Retried and out of order callbacks are dropped without locking the order
+    if QuickpayPayment.callback_applied(data):
+        logging.debug("payment_quickpay.views.callback(): state of payment %s already applied, skipping", data['id'])
+        metrics.callbacks.inc(outcome='stale')
+        return
+    _process_callback(data)
+
+
+@transaction.atomic
+def _process_callback(data: dict):
 
     def update_payment() -> Optional[QuickpayPayment]:
-        """Update QuickPay payment from Quickpay result"""
-        # Refers order, data from outer scope
-        payment: Optional[QuickpayPayment] = QuickpayPayment.get_order_payment(order)
+        """Update QuickPay payment from Quickpay result. Only the changed fields are written"""
+        # Refers payment, data from outer scope
         if payment is not None:
-            payment.update_from_res(data)  # NB: qp.test_mode == data['test_mode']
-            payment.save()
+            old_values = dict(payment.quickpay_values(), last_callback_seq=payment.last_callback_seq)
+            if not payment.is_later_than(data):
+                # Sync or an operation may have applied a later state already
+                payment.update_from_res(data)  # NB: qp.test_mode == data['test_mode']
+            payment.last_callback_seq = max(operation_sequence(data), payment.last_callback_seq or 0)
+            payment.save_changes(old_values)
+            QuickpayPaymentEvent.record(payment, data, QuickpayPaymentEvent.SOURCE_CALLBACK)
         return payment
-        
-    data = json.loads(request.body.decode('utf-8'))
-    logging.debug("\n ---- payment_quickpay.views.callback() ----")
-    logging.debug("Got data {}\n".format(data))
-
-    # We may get several callbacks with states "new", "pending", or "processed"
-    # We're only interested in "processed" for payments and "active" for new subscriptions
-    qp_state = data.get('state', None)
-    if (qp_state in ('processed', 'active', 'rejected')
-            or not getattr(settings, 'QUICKPAY_AUTO_CAPTURE', False) and qp_state == 'pending'):
-        logging.debug("payment_quickpay.views.callback(): QP state is {}, processing".format(qp_state))
-    else:
-        logging.debug("payment_quickpay.views.callback(): QP state is {}, skipping".format(qp_state))
-        return HttpResponse("OK")
+
+    logging.debug("payment_quickpay.views.callback(): got data %s", data)
 
     # Get the order
     order_id_payment_id_string = data.get('order_id','')
-    logging.debug('order_id_payment_id_string: {}'.format(order_id_payment_id_string))
     order_id = re.sub('_\d+', '', order_id_payment_id_string)
-    logging.debug('order_id: {}'.format(order_id))
+    logging.debug('order_id_payment_id_string: %s, order_id: %s', order_id_payment_id_string, order_id)
     try:
-        order = Order.objects.filter(pk=order_id).select_for_update()[0]  # Lock order to prevent race condition
+        with metrics.lock_wait.time(site='callback'):
+            order = Order.objects.filter(pk=order_id).select_for_update()[0]  # Lock order to prevent race condition
     except IndexError:
         # Order not found, ignore
-        logging.warning("payment_quickpay.views.callback(): order id {} not found, skipping".format(order_id))
-        return HttpResponse("OK")
+        logging.warning("payment_quickpay.views.callback(): order id %s not found, skipping", order_id)
+        metrics.callbacks.inc(outcome='order_not_found')
+        return
 
-    # Check checksum. If we have multiple agreements, we need the order currency to get the right one
-    checksum = sign(request.body, get_private_key(order_currency(order)))
-    logging.debug("Request checksum = {}".format(request.META['HTTP_QUICKPAY_CHECKSUM_SHA256']))
-    logging.debug("Calculated checksum = {}".format(checksum))
-    if checksum != request.META['HTTP_QUICKPAY_CHECKSUM_SHA256']:
-        logging.error('Quickpay callback: checksum failed {}'.format(data))
-        return HttpResponseBadRequest()
+    logging.debug("payment_quickpay.views.callback(): order.status = %s", order.status)
 
-    logging.debug("payment_quickpay.views.callback(): order.status = {}".format(order.status))
+    payment: Optional[QuickpayPayment] = QuickpayPayment.get_order_payment(order)
+    if (payment is not None and data.get('type') == 'Payment' and payment.qp_id == data['id']
+            and payment.callback_processed(data) and not (data['accepted'] and not order.transaction_id)):
+        # The same callback was processed while waiting for the lock
+        logging.debug("payment_quickpay.views.callback(): state of payment %s already applied", data['id'])
+        metrics.callbacks.inc(outcome='stale')
+        return
 
     if data['state'] == 'rejected':
         update_payment()
+        metrics.callbacks.inc(outcome='rejected')
 
     elif data['type'] == 'Subscription' and Subscription is not None:
         # Starting a NEW subscription. The Subscription is created in order_handler
-        logging.error("payment_quickpay.views.callback(): starting subscription, order {}".format(order.id))
+        logging.error("payment_quickpay.views.callback(): starting subscription, order %s", order.id)
 
-        # Capture the initial subscription payment
-        capture_subscription_order(order)  # Starts async capture, next callback is 'accepted'
+        # Capture the initial subscription payment when the callback transaction has been committed so the
+        # Order lock isn't held during the Quickpay call
+        transaction.on_commit(lambda: capture_subscription_order(order))  # Next callback is 'accepted'
+        metrics.callbacks.inc(outcome='subscription')
 
     elif data['accepted']:
         # Normal or subscription payment
@@ -322,13 +471,30 @@ def callback(request: HttpRequest) -> HttpResponse:
 
         # -- The order can be considered paid (reserved or captured) if and only if we get here.
         # -- An order is paid if and only if it has a transaction_id
-        logging.info("payment_quickpay.views.callback(): accepted payment, order {}".format(order.id))
-        payment = update_payment()
+        logging.info("payment_quickpay.views.callback(): accepted payment, order %s", order.id)
+        update_payment()
         order.transaction_id = data['id']
-        logging.debug("payment_quickpay.views.callback(): calling order_handler, qp subscription = {}"
-                      .format(data.get('subscription_id', '-')))
+        logging.debug("payment_quickpay.views.callback(): calling order_handler, qp subscription = %s",
+                      data.get('subscription_id', '-'))
         order_handler(request=None, order_form=None, order=order, payment=payment)
+        metrics.callbacks.inc(outcome='accepted')
 
-    logging.debug("payment_quickpay.views.callback(): final order.status: {}".format(order.status))
+    else:
+        metrics.callbacks.inc(outcome='not_accepted')
 
-    return HttpResponse("OK")
+    logging.debug("payment_quickpay.views.callback(): final order.status: %s", order.status)
+
+
+def quickpay_metrics(request: HttpRequest) -> HttpResponse:
+    """Metrics in Prometheus' text format. For staff users, or with QUICKPAY_METRICS_TOKEN as ?token=... or
+    "Authorization: Bearer ..." header"""
+    token = getattr(settings, 'QUICKPAY_METRICS_TOKEN', None)
+    if token:
+        auth = request.META.get('HTTP_AUTHORIZATION', '')
+        given = auth[7:] if auth.startswith('Bearer ') else request.GET.get('token', '')
+        allowed = hmac.compare_digest(given.encode('utf-8'), token.encode('utf-8'))
+    else:
+        allowed = False
+    if not allowed and not (request.user.is_authenticated and request.user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')